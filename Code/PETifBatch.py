@@ -0,0 +1,8 @@
+from multiprocessing import freeze_support
+
+from app.cli import main
+
+if __name__ == "__main__":
+    # headless conversion of the files without the Tango server, see python PETifBatch.py --help
+    freeze_support()
+    raise SystemExit(main())
@@ -1,5 +1,6 @@
 from app.common.imports import *
 from app.starter import *
+from app.common.lanes import LANE_HIGH, LANE_LOW, LaneException, check_lane
 from app.tango_server import *
 
 class PETifConverter(TangoServer):
@@ -11,17 +12,46 @@ class PETifConverter(TangoServer):
     # Attributes
 
     NumProcessed = attribute(label="Number of processed elements (dir+file alike)", dtype=int, fget="getNumProcessed", description="Number of processes doing file conversion")
-    NumWorkers = attribute(label="Number of workers", dtype=int, fget="getConfNWorkers", description="Number of workers set by properties (higher priority) or configuration (lower priority)")
+    ForceReconvert = attribute(label="Force reconversion", dtype=bool, access=AttrWriteType.READ_WRITE, fget="getForceReconvert", fset="setForceReconvert", description="Convert the added files even if the ledger reports them as converted")
+    LogLevel = attribute(label="Level of the logs", dtype=str, access=AttrWriteType.READ_WRITE, fget="getLogLevel", fset="setLogLevel", description="Level of the logs of the server and of the workers (DEBUG, INFO, WARNING, ERROR), applied by the workers after their current file")
+    NumWorkers = attribute(label="Number of workers", dtype=int, access=AttrWriteType.READ_WRITE, fget="getConfNWorkers", fset="setConfNWorkers", description="Number of running workers, initially set by properties (higher priority) or configuration (lower priority)")
 
         # configuration related
     ConfRotation = attribute(label="Rotation of the image", dtype=int, fget="getConfRotation", description="Desired rotation of the frame (config file, mult. of 90 Degrees)")
     ConfFlip = attribute(label="Flip of the image axis", dtype=str, fget="getConfFlip", description="Flip configuration (config file, numpy.ndarray.flip type)")
     ConfType = attribute(label="Pixel type of the conversion", dtype=str, fget="getConfNType", description="Numeric type of the pixel in terms of numpy (config file)")
+    ConfCompression = attribute(label="Compression of the output", dtype=str, fget="getConfCompression", description="Compression of the written files - none, deflate, lzw or zstd (config file)")
 
         # statistic related
     StatisticsTotalFrames = attribute(label="Total frames", dtype=int, fget="getStatTotalConverted", description="Total frames converted")
     StatisticsTotalTime = attribute(label="Total time (s)", dtype=float, fget="getStatTotalTime", description="Total time of conversion (s)")
     StatisticsAverageTime = attribute(label="Average time (s)", dtype=float, fget="getStatAverageTime", description="Average time of conversion (s)")
+    StatisticsLatencyReady = attribute(label="Latency - ready (s)", dtype=(float,), max_dim_x=3, fget="getStatLatencyReady", description="p50, p95, p99 of the stage duration (s) - readiness tests")
+    StatisticsLatencyQueue = attribute(label="Latency - queue (s)", dtype=(float,), max_dim_x=3, fget="getStatLatencyQueue", description="p50, p95, p99 of the stage duration (s) - waiting in the queue for a worker")
+    StatisticsLatencyOpen = attribute(label="Latency - open (s)", dtype=(float,), max_dim_x=3, fget="getStatLatencyOpen", description="p50, p95, p99 of the stage duration (s) - fabio open/decode")
+    StatisticsLatencyMakedirs = attribute(label="Latency - makedirs (s)", dtype=(float,), max_dim_x=3, fget="getStatLatencyMakedirs", description="p50, p95, p99 of the stage duration (s) - output path and directory creation")
+    StatisticsLatencyTransform = attribute(label="Latency - transform (s)", dtype=(float,), max_dim_x=3, fget="getStatLatencyTransform", description="p50, p95, p99 of the stage duration (s) - clamp/cast fused with the orientation")
+    StatisticsLatencyWrite = attribute(label="Latency - write (s)", dtype=(float,), max_dim_x=3, fget="getStatLatencyWrite", description="p50, p95, p99 of the stage duration (s) - header and write of the output")
+    StatisticsLatencyUpload = attribute(label="Latency - upload (s)", dtype=(float,), max_dim_x=3, fget="getStatLatencyUpload", description="p50, p95, p99 of the stage duration (s) - from the staging folder till the destination (write-behind)")
+    StatisticsLatencyTotal = attribute(label="Latency - total (s)", dtype=(float,), max_dim_x=3, fget="getStatLatencyTotal", description="p50, p95, p99 of the stage duration (s) - from AddFileOrDir till the written output")
+    StatisticsFrameRate10s = attribute(label="Frame rate, 10s (frames/s)", dtype=float, fget="getStatFrameRate10s", description="Converted frames per second over the last 10s")
+    StatisticsFrameRate1min = attribute(label="Frame rate, 1min (frames/s)", dtype=float, fget="getStatFrameRate1min", description="Converted frames per second over the last 1min")
+    StatisticsFrameRate10min = attribute(label="Frame rate, 10min (frames/s)", dtype=float, fget="getStatFrameRate10min", description="Converted frames per second over the last 10min")
+    StatisticsMBRate10s = attribute(label="Input rate, 10s (MB/s)", dtype=float, fget="getStatMBRate10s", description="Source data read per second over the last 10s (MB/s)")
+    StatisticsMBRate1min = attribute(label="Input rate, 1min (MB/s)", dtype=float, fget="getStatMBRate1min", description="Source data read per second over the last 1min (MB/s)")
+    StatisticsMBRate10min = attribute(label="Input rate, 10min (MB/s)", dtype=float, fget="getStatMBRate10min", description="Source data read per second over the last 10min (MB/s)")
+    StatisticsBytesRead = attribute(label="Bytes read", dtype=int, fget="getStatBytesRead", description="Total size of the converted source files (bytes)")
+    StatisticsBytesWritten = attribute(label="Bytes written", dtype=int, fget="getStatBytesWritten", description="Total size of the written files (bytes)")
+    StatisticsSkips = attribute(label="Skipped files", dtype=int, fget="getStatSkips", description="Placeholders written for the missing or incomplete files")
+    StatisticsErrors = attribute(label="Errors", dtype=int, fget="getStatErrors", description="Files which could not be read or written")
+    StatisticsScanRate = attribute(label="Scan rate (files/s)", dtype=float, fget="getStatScanRate", description="Enumeration rate of the last scanned directory (files/s)")
+    StagingBacklog = attribute(label="Staging backlog (files)", dtype=int, fget="getStagingBacklog", description="Files in the staging folder waiting for the upload (write-behind)")
+    StagingBacklogSize = attribute(label="Staging backlog (MB)", dtype=float, fget="getStagingBacklogSize", description="Size of the files in the staging folder waiting for the upload (MB)")
+    StagingUploadErrors = attribute(label="Failed uploads", dtype=int, fget="getStagingUploadErrors", description="Files kept in the staging folder after the retries of the upload")
+    LaneHighDepth = attribute(label="High lane (files)", dtype=int, fget="getLaneHighDepth", description="Ready files of the high priority lane waiting for a worker")
+    LaneLowDepth = attribute(label="Low lane (files)", dtype=int, fget="getLaneLowDepth", description="Ready files of the low priority lane (backlog) waiting for a worker")
+    StatisticsLatencyLaneHigh = attribute(label="Latency - high lane (s)", dtype=(float,), max_dim_x=3, fget="getStatLatencyLaneHigh", description="p50, p95, p99 of the stage duration (s) - ready files waiting in the high priority lane")
+    StatisticsLatencyLaneLow = attribute(label="Latency - low lane (s)", dtype=(float,), max_dim_x=3, fget="getStatLatencyLaneLow", description="p50, p95, p99 of the stage duration (s) - ready files waiting in the low priority lane")
 
     # device property - number of workers
     numworkers = device_property(dtype=int, default_value=3, update_db=True)
@@ -71,7 +101,31 @@ class PETifConverter(TangoServer):
         return self.num_processed
 
     def getConfNWorkers(self):
-        return self.numworkers
+        if self.s is None:
+            return self.numworkers
+        return self.s.getNumWorkers()
+
+    def setConfNWorkers(self, value):
+        self.debug("Changing the number of workers to ({})".format(value))
+        if self.s is not None:
+            self.s.setNumWorkers(value)
+
+    def getLogLevel(self):
+        return logging.getLevelName(self.s.getLogLevel())
+
+    def setLogLevel(self, value):
+        level = logging.getLevelName(str(value).strip().upper())
+        if not isinstance(level, int):
+            self.error("Unknown level of the logs ({})".format(value))
+            return
+        self.s.setLogLevel(level)
+
+    def getForceReconvert(self):
+        return self.s.getConfigInstance().getProcLedgerForce()
+
+    def setForceReconvert(self, value):
+        self.debug("Changing the forced reconversion to ({})".format(value))
+        self.s.getConfigInstance().setProcLedgerForce(bool(value))
 
     def getConfRotation(self):
         return self.s.getConfigInstance().getProcFileRotation()
@@ -82,22 +136,105 @@ class PETifConverter(TangoServer):
     def getConfNType(self):
         return str(self.s.getConfigInstance().getProcFileConvType())
 
+    def getConfCompression(self):
+        return str(self.s.getConfigInstance().getProcFileCompression())
+
     def getStatTotalConverted(self):
-        v = self.s.value_frames.value
+        v = int(self.s.getCounters()["frames"])
         return v
 
     def getStatTotalTime(self):
-        v = self.s.value_time.value
+        v = self.s.getCounters()["time"]
         return v
 
     def getStatAverageTime(self):
         res = 0
-        t = self.s.value_time.value
-        v = float(self.s.value_frames.value)
+        # consistent snapshot of both counters
+        counters = self.s.getCounters()
+        t = counters["time"]
+        v = float(counters["frames"])
         if v != 0:
             res = t/v
         return res
 
+    def getStatLatencyReady(self):
+        return self.s.getLatency("ready")
+
+    def getStatLatencyQueue(self):
+        return self.s.getLatency("queue")
+
+    def getStatLatencyOpen(self):
+        return self.s.getLatency("open")
+
+    def getStatLatencyMakedirs(self):
+        return self.s.getLatency("makedirs")
+
+    def getStatLatencyTransform(self):
+        return self.s.getLatency("transform")
+
+    def getStatLatencyWrite(self):
+        return self.s.getLatency("write")
+
+    def getStatLatencyUpload(self):
+        return self.s.getLatency("upload")
+
+    def getStatLatencyTotal(self):
+        return self.s.getLatency("total")
+
+    def getStatFrameRate10s(self):
+        return self.s.getRate("frames", 10)
+
+    def getStatFrameRate1min(self):
+        return self.s.getRate("frames", 60)
+
+    def getStatFrameRate10min(self):
+        return self.s.getRate("frames", 600)
+
+    def getStatMBRate10s(self):
+        return self.s.getRate("bytes_read", 10) / 1e6
+
+    def getStatMBRate1min(self):
+        return self.s.getRate("bytes_read", 60) / 1e6
+
+    def getStatMBRate10min(self):
+        return self.s.getRate("bytes_read", 600) / 1e6
+
+    def getStatBytesRead(self):
+        return int(self.s.getCounters()["bytes_read"])
+
+    def getStatBytesWritten(self):
+        return int(self.s.getCounters()["bytes_written"])
+
+    def getStatSkips(self):
+        return int(self.s.getCounters()["skips"])
+
+    def getStatErrors(self):
+        return int(self.s.getCounters()["errors"])
+
+    def getStatScanRate(self):
+        return self.s.value_scan_rate.value
+
+    def getStagingBacklog(self):
+        return self.s.getStagingBacklog()[0]
+
+    def getStagingBacklogSize(self):
+        return self.s.getStagingBacklog()[1] / 1e6
+
+    def getStagingUploadErrors(self):
+        return int(self.s.getCounters()["upload_errors"])
+
+    def getLaneHighDepth(self):
+        return self.s.getLaneDepth(LANE_HIGH)
+
+    def getLaneLowDepth(self):
+        return self.s.getLaneDepth(LANE_LOW)
+
+    def getStatLatencyLaneHigh(self):
+        return self.s.getLatency("lane_high")
+
+    def getStatLatencyLaneLow(self):
+        return self.s.getLatency("lane_low")
+
     def delete_device(self):
         """
         Cleanup function
@@ -130,10 +267,27 @@ class PETifConverter(TangoServer):
         self.debug("Adding ({}) path for processing".format(path))
 
         if self.s is not None:
-            self.s.getPreprocessQueue().put(path)
+            self.s.addElement(path)
             self.num_processed += 1
         return
 
+    @command(dtype_in=(str,))
+    def AddFileOrDirWithPriority(self, argin):
+        """
+        Adds new files for processing into a priority lane - [lane ("high" or "low"), path, ...]
+        :return:
+        """
+        if len(argin) < 2:
+            raise LaneException("Expected the lane and at least one path, got ({})".format(argin))
+
+        lane, paths = check_lane(argin[0]), list(argin[1:])
+        self.debug("Adding ({}) paths for processing, lane ({})".format(paths, lane))
+
+        if self.s is not None:
+            self.s.addElement(paths, lane=lane)
+            self.num_processed += len(paths)
+        return
+
     @command()
     def ResetStats(self):
         """
@@ -0,0 +1,304 @@
+"""
+Headless batch conversion - the Starter and its worker processes without the Tango layer
+Directories, glob patterns and lists of files are converted at full speed, the progress is printed until the queue drains
+
+Usage (from the Code directory):
+    python PETifBatch.py <dir|file|pattern> [...] [--list files.txt] [--workers 8] [--recursive] [--force]
+"""
+import argparse
+import glob
+import logging
+import os
+import sys
+import time
+import threading
+
+import app.config.main_config as config
+from app.config.keys import *
+from app.common.scanner import scan_files, SCAN_EXTENSIONS, SCAN_EXCLUDE
+from app.starter import Starter
+
+# interval of the progress output (s)
+PROGRESS_INTERVAL = 2.
+
+# window of the rate used for the estimated time of arrival (s)
+ETA_WINDOW = 10.
+
+
+def set_console_level(level):
+    """
+    Sets the level of the console output of the loggers, the log files keep their levels
+    The handler is created before the Starter, the worker processes inherit it
+    :return:
+    """
+    c = config.get_instance()
+    logging.basicConfig(level=logging.DEBUG, format=c.getLoggingMainFormat(), datefmt=c.getLoggingMainDate())
+
+    for h in logging.getLogger().handlers:
+        if isinstance(h, logging.StreamHandler) and not isinstance(h, logging.FileHandler):
+            h.setLevel(level)
+
+
+def is_convertible(fn):
+    """
+    Tests the filename the same way the scanned directories are filtered
+    :return:
+    """
+    lpath = fn.lower()
+    return lpath.endswith(SCAN_EXTENSIONS) and not any(el in lpath for el in SCAN_EXCLUDE)
+
+
+def read_lists(fns):
+    """
+    Returns the paths of the list files, one path per line, empty lines and # comments are ignored
+    :param fns: list files, - for the standard input
+    :return: list
+    """
+    res = []
+    for fn in fns:
+        fh = sys.stdin if fn == "-" else open(fn, "r")
+        try:
+            for line in fh:
+                line = line.strip()
+                if len(line) > 0 and not line.startswith("#"):
+                    res.append(line)
+        finally:
+            if fh is not sys.stdin:
+                fh.close()
+    return res
+
+
+def iter_inputs(paths, recursive=False, logger=None):
+    """
+    Yields the files of the inputs - directories are scanned, glob patterns are expanded
+    :param paths: absolute paths of directories, files or glob patterns
+    :param recursive: scan the subdirectories
+    :return: paths of the files, overlapping inputs yield a file several times
+    """
+    t = logger
+
+    for path in paths:
+        if os.path.isdir(path):
+            for fn in scan_files(path, recursive=recursive, logger=t):
+                yield fn
+        elif os.path.isfile(path):
+            if is_convertible(path):
+                yield path
+        else:
+            matches = sorted(glob.glob(path, recursive=True))
+            if len(matches) == 0 and t is not None:
+                t.error("Nothing matches the input ({})".format(path))
+
+            for match in matches:
+                if os.path.isdir(match):
+                    for fn in scan_files(match, recursive=recursive, logger=t):
+                        yield fn
+                elif is_convertible(match):
+                    yield match
+
+
+def expand_inputs(paths, recursive=False, logger=None):
+    """
+    Yields the files of the inputs once - e.g. a directory and a pattern of its files, a path repeated in a list
+    :param paths: absolute paths of directories, files or glob patterns
+    :param recursive: scan the subdirectories
+    :return: paths of the files
+    """
+    seen = set()
+    for fn in iter_inputs(paths, recursive=recursive, logger=logger):
+        path = os.path.abspath(fn)
+        if path not in seen:
+            seen.add(path)
+            yield fn
+
+
+def add_inputs(s, paths, recursive, evdone):
+    """
+    Thread function - passes the files of the inputs to the Starter in chunks, the conversion starts with the first chunk
+    :param s: app.starter.Starter
+    :param evdone: set when all the inputs are passed
+    :return:
+    """
+    chunk = max(int(s.getConfigInstance().getProcScanChunk()), 1)
+
+    try:
+        tfiles = []
+        for fn in expand_inputs(paths, recursive=recursive, logger=s):
+            tfiles.append(fn)
+            if len(tfiles) >= chunk:
+                s.addFilenames(tfiles)
+                tfiles = []
+
+        if len(tfiles) > 0:
+            s.addFilenames(tfiles)
+    finally:
+        evdone.set()
+
+
+def format_duration(value):
+    """
+    Returns the duration as 0h00m00s
+    :param value: duration (s)
+    :return:
+    """
+    value = int(round(max(value, 0)))
+    return "{}h{:02d}m{:02d}s".format(value // 3600, (value // 60) % 60, value % 60)
+
+
+def get_done(counters):
+    """
+    Returns the number of the finished files - converted, replaced by placeholders or failed
+    :param counters: dict of app.starter.Starter.getCounters()
+    :return:
+    """
+    return int(counters["files"] + counters["skips"] + counters["errors"])
+
+
+def print_progress(s, scanning, tstart, stream=sys.stdout):
+    """
+    Prints a line of the progress
+    :param s: app.starter.Starter
+    :param scanning: the inputs are still being enumerated, the total grows
+    :return:
+    """
+    counters = s.getCounters()
+    done, total = get_done(counters), s.getNumAccepted()
+
+    rate = sum(s.getRate(k, ETA_WINDOW) for k in ("files", "skips", "errors"))
+    eta = "-"
+    if not scanning and rate > 0:
+        eta = format_duration((total - done) / rate)
+
+    line = "[{:5.1f}%] {}/{}{} files, {} errors, {} placeholders | {:.1f} frames/s, {:.1f} MB/s | {} elapsed, ETA {}".format(
+        100. * done / total if total > 0 else 0., done, total, "+" if scanning else "", int(counters["errors"]),
+        int(counters["skips"]), s.getRate("frames", ETA_WINDOW), s.getRate("bytes_read", ETA_WINDOW) / 1e6,
+        format_duration(time.time() - tstart), eta)
+
+    if stream.isatty():
+        stream.write("\r{}".format(line))
+    else:
+        stream.write("{}\n".format(line))
+    stream.flush()
+
+
+def print_summary(s, tconversion, stream=sys.stdout):
+    """
+    Prints the summary of the conversion
+    :param s: app.starter.Starter
+    :param tconversion: duration of the conversion (s)
+    :return:
+    """
+    counters = s.getCounters()
+    latency = s.getLatency("total")
+
+    lines = [
+        "Converted files  : {} ({} frames)".format(int(counters["files"]), int(counters["frames"])),
+        "Up to date       : {}".format(s.getNumUpToDate()),
+        "Placeholders     : {}".format(int(counters["skips"])),
+        "Errors           : {}".format(int(counters["errors"])),
+        "Read / written   : {:.1f} MB / {:.1f} MB".format(counters["bytes_read"] / 1e6, counters["bytes_written"] / 1e6),
+        "Elapsed          : {} ({:.1f} frames/s, {:.1f} MB/s)".format(
+            format_duration(tconversion), counters["frames"] / tconversion if tconversion > 0 else 0.,
+            counters["bytes_read"] / 1e6 / tconversion if tconversion > 0 else 0.),
+        "Latency          : p50 {:.3f}s, p95 {:.3f}s, p99 {:.3f}s (added till written)".format(*latency),
+    ]
+    if counters["staged"] > 0:
+        lines.append("Uploaded         : {} ({} kept in the staging folder)".format(int(counters["uploaded"]),
+                                                                             int(counters["upload_errors"])))
+    stream.write("\n".join(lines) + "\n")
+    stream.flush()
+
+
+def parse_args(argv=None):
+    parser = argparse.ArgumentParser(description=__doc__.strip().split("\n")[0])
+    parser.add_argument("paths", nargs="*", help="directories, files or glob patterns (quoted, ** for the subdirectories)")
+    parser.add_argument("--list", action="append", default=[], help="file with a path per line, - for the standard input")
+    parser.add_argument("--workers", type=int, default=None, help="number of the worker processes (configuration by default)")
+    parser.add_argument("--start-method", default=None, choices=("fork", "spawn", "forkserver"),
+                        help="start method of the worker processes (configuration by default)")
+    parser.add_argument("--recursive", action="store_true", help="scan the subdirectories of the directories")
+    parser.add_argument("--min-size", type=int, default=None, help="readiness test - minimal size of a complete file (configuration by default)")
+    parser.add_argument("--force", action="store_true", help="convert the files even if the ledger reports them as converted")
+    parser.add_argument("--ledger", action="store_true", help="skip the files recorded by the conversion ledger as converted")
+    parser.add_argument("--no-ledger", action="store_true", help="do not use and do not update the conversion ledger")
+    parser.add_argument("--interval", type=float, default=PROGRESS_INTERVAL, help="interval of the progress output (s)")
+    parser.add_argument("--verbose", action="store_true", help="log messages of the server on the console")
+    return parser.parse_args(argv)
+
+
+def main(argv=None, script=None):
+    """
+    Converts the inputs and waits until the queue drains
+    :param argv: command line arguments
+    :param script: path of the starting script, its folder keeps the log folder
+    :return: exit code - 0 if every file was converted, 1 if placeholders were written or conversions failed
+    """
+    args = parse_args(argv)
+
+    # the Starter changes the working directory - the inputs are resolved before
+    paths = [os.path.abspath(path) for path in args.paths + read_lists(args.list)]
+    if len(paths) == 0:
+        sys.stderr.write("Nothing to convert, no inputs were given\n")
+        return 2
+
+    if script is None:
+        script = os.path.abspath(sys.argv[0])
+
+    set_console_level(logging.DEBUG if args.verbose else logging.ERROR)
+
+    # the context of the workers is created by the Starter
+    if args.start_method is not None:
+        config.get_instance().setConfiguration(PROC_START_METHOD, args.start_method)
+
+    s = Starter([script])
+
+    c = s.getConfigInstance()
+    if args.workers is not None:
+        c.setProcMaxNum(args.workers)
+    if args.min_size is not None:
+        c.setConfiguration(PROC_FILE_TEST_SIZE, args.min_size)
+    if args.force:
+        c.setProcLedgerForce(True)
+    if args.ledger:
+        c.setConfiguration(PROC_LEDGER, True)
+    if args.no_ledger:
+        c.setConfiguration(PROC_LEDGER, False)
+
+    recursive = args.recursive or c.getProcScanRecursive()
+
+    s.startTiffApplication()
+    tstart = time.time()
+
+    evscan = threading.Event()
+    thscan = threading.Thread(target=add_inputs, args=(s, paths, recursive, evscan))
+    thscan.daemon = True
+    thscan.start()
+
+    res = 0
+    try:
+        tprogress = tstart
+        while True:
+            scanning = not evscan.is_set()
+            if not scanning and get_done(s.getCounters()) >= s.getNumAccepted():
+                break
+
+            time.sleep(0.05)
+            if time.time() - tprogress >= args.interval:
+                tprogress = time.time()
+                print_progress(s, scanning, tstart)
+    except KeyboardInterrupt:
+        sys.stdout.write("\nInterrupted, the pending files are not converted\n")
+        res = 130
+
+    tconversion = time.time() - tstart
+    print_progress(s, False, tstart)
+    if sys.stdout.isatty():
+        sys.stdout.write("\n")
+
+    s.quit()
+    print_summary(s, tconversion)
+
+    counters = s.getCounters()
+    if res == 0 and counters["skips"] + counters["errors"] > 0:
+        res = 1
+    return res
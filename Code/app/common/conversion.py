@@ -0,0 +1,124 @@
+__author__ = 'Konstantin Glazyrin'
+
+import numpy as np
+
+# per process buffers for the converted frames - (shape, dtype) -> numpy.ndarray
+CONVERSION_BUFFERS = {}
+CONVERSION_BUFFERS_MAX = 8
+
+# size of the blocks used for the transposing orientations
+ORIENTATION_TILE = 256
+
+
+def get_conversion_buffer(shape, dtype, slot=0):
+    """
+    Returns a reusable output buffer of the given shape and type
+    :param shape:
+    :param dtype:
+    :param slot: index of the buffer, several buffers of the same kind are used while the frames are written in background
+    :return:
+    """
+    key = (tuple(shape), np.dtype(dtype), slot)
+
+    res = CONVERSION_BUFFERS.get(key)
+    if res is None:
+        # scan with a new detector geometry - do not keep the old buffers
+        if len(CONVERSION_BUFFERS) >= CONVERSION_BUFFERS_MAX:
+            CONVERSION_BUFFERS.clear()
+
+        res = np.empty(key[0], dtype=key[1])
+        CONVERSION_BUFFERS[key] = res
+    return res
+
+
+def convert_data(data, conv_type, out=None):
+    """
+    Conversion kernel - removes the negative values (unsigned output types only) and casts the data in one pass
+    :param data: numpy.ndarray, could be a strided view
+    :param conv_type: numpy type of the output
+    :param out: output buffer, per process reusable buffer is used if None
+    :return: out
+    """
+    if out is None:
+        out = get_conversion_buffer(data.shape, conv_type)
+
+    if np.issubdtype(out.dtype, np.unsignedinteger) and data.dtype.kind in "fi":
+        np.maximum(data, 0, out=out, casting="unsafe")
+    else:
+        np.copyto(out, data, casting="unsafe")
+    return out
+
+
+class OrientationPlan(object):
+    """
+    Rotation (multiple of 90 degrees, PROC_FILE_ROTATE) followed by the flip (PROC_FILE_FLIP) resolved into
+    one of the 8 orientations of a frame - optional transposition followed by optional reversal of the rows and columns
+    """
+    def __init__(self, rot=0., flip=None):
+        self.rot = rot
+        self.flip = flip
+
+        self.transpose, self.step0, self.step1 = self._resolve(rot, flip)
+
+    @staticmethod
+    def _resolve(rot, flip):
+        """
+        Applies the configured operations to a probe array and finds the matching orientation
+        :return: (transpose, row step, column step)
+        """
+        probe = np.arange(6).reshape(2, 3)
+
+        res = probe
+        if rot % 90. == 0 and rot != 0:
+            res = np.rot90(res, int(rot/90.))
+        if flip is not None:
+            res = np.flip(res, axis=flip)
+
+        for transpose in (False, True):
+            for step0 in (1, -1):
+                for step1 in (1, -1):
+                    cand = probe.T if transpose else probe
+                    cand = cand[::step0, ::step1]
+                    if cand.shape == res.shape and np.array_equal(cand, res):
+                        return transpose, step0, step1
+
+        raise ValueError("Unsupported orientation (rotation: {}, flip: {})".format(rot, flip))
+
+    def isIdentity(self):
+        return not self.transpose and self.step0 == 1 and self.step1 == 1
+
+    def view(self, data):
+        """
+        Returns the oriented strided view of the data, the last two axes are used
+        :param data: numpy.ndarray
+        :return:
+        """
+        if self.transpose:
+            data = data.swapaxes(-1, -2)
+        return data[..., ::self.step0, ::self.step1]
+
+    def apply(self, data, conv_type, out=None):
+        """
+        Orientation fused with the conversion - one pass into a contiguous (reusable) buffer
+        :param data: numpy.ndarray
+        :param conv_type: numpy type of the output
+        :param out: output buffer, per process reusable buffer is used if None
+        :return:
+        """
+        view = self.view(data)
+        if not self.transpose:
+            return convert_data(view, conv_type, out=out)
+
+        if out is None:
+            out = get_conversion_buffer(view.shape, conv_type)
+
+        # transposition - the blocks keep the strided reads in cache
+        tile = ORIENTATION_TILE
+        for i in range(0, view.shape[-2], tile):
+            for j in range(0, view.shape[-1], tile):
+                convert_data(view[..., i:i+tile, j:j+tile], conv_type, out=out[..., i:i+tile, j:j+tile])
+        return out
+
+    def __repr__(self):
+        return "{}(rot={}, flip={}: transpose={}, steps=({}, {}))".format(self.__class__.__name__, self.rot, self.flip,
+                                                                          self.transpose, self.step0, self.step1)
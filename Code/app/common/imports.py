@@ -9,14 +9,11 @@ import ctypes
 import subprocess
 import threading
 import re
-
-from tango import AttrQuality, AttrWriteType, DispLevel, DevState
-from tango.server import Device, attribute, command
-from tango.server import class_property, device_property
+import sqlite3
 
 import numpy as np
 
-from multiprocessing import Queue, Process, Value, freeze_support, current_process, active_children
+from multiprocessing import Queue, Process, Value, freeze_support, current_process, active_children, get_context, get_all_start_methods
 from queue import Empty
 from copy import deepcopy
 
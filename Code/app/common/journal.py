@@ -0,0 +1,208 @@
+__author__ = 'Konstantin Glazyrin'
+
+import os
+import threading
+
+# journal records - accepted file, finished file (converted, skipped or failed),
+# received request (file, directory or pattern not expanded yet), expanded request (its files are accepted)
+JOURNAL_ACCEPTED = "A"
+JOURNAL_DONE = "D"
+JOURNAL_REQUEST = "R"
+JOURNAL_EXPANDED = "E"
+
+
+def get_request_paths(request):
+    """
+    Returns the paths of a request - a file, directory or pattern, or a list of them
+    :return: list
+    """
+    if isinstance(request, (list, tuple)):
+        return [str(path) for path in request]
+    return [str(request)]
+
+
+class PendingJournal(object):
+    """
+    Append-only journal of the files accepted for conversion and of the finished ones
+    Records are only buffered when added, sync() writes them with a single fsync (group commit) -
+    the files which were accepted and not finished are replayed after a restart of the server
+    The requests are recorded before they are queued and marked expanded once their files are accepted,
+    the requests which were not expanded (e.g. a directory scanned partially) are replayed as well
+    """
+    def __init__(self, fn, logger=None):
+        self.fn = fn
+        self.t = logger
+
+        self._lock = threading.Lock()
+
+        # accepted and not finished files in the order of acceptance, number of the records in the journal
+        self._pending = {}
+        self._records = 0
+
+        # requests which were not expanded -> number of the requests
+        self._requests = {}
+        self._dirty = False
+
+        self._replay()
+        self._fh = open(self.fn, "a", encoding="utf-8", errors="surrogateescape")
+
+    def _replay(self):
+        """
+        Reads the existing journal, the last incomplete record of a crashed server is ignored
+        :return:
+        """
+        if not os.path.isfile(self.fn):
+            return
+
+        with open(self.fn, "r", encoding="utf-8", errors="surrogateescape") as fh:
+            for line in fh:
+                if not line.endswith("\n"):
+                    break
+
+                self._records += 1
+                record, path = line[0], line[2:-1]
+                if record == JOURNAL_ACCEPTED:
+                    self._pending[path] = None
+                elif record == JOURNAL_DONE:
+                    self._pending.pop(path, None)
+                elif record == JOURNAL_REQUEST:
+                    self._requests[path] = self._requests.get(path, 0) + 1
+                elif record == JOURNAL_EXPANDED:
+                    self._expand(path)
+
+        if self.t is not None:
+            self.t.debug("Journal ({}) is replayed - ({}) records, ({}) pending files, ({}) pending requests".format(
+                self.fn, self._records, len(self._pending), sum(self._requests.values())))
+
+    def __len__(self):
+        return len(self._pending)
+
+    def pending(self):
+        """
+        Returns the accepted files which were not finished
+        :return:
+        """
+        with self._lock:
+            return list(self._pending.keys())
+
+    def requests(self):
+        """
+        Returns the requests which were not expanded, a path requested several times is returned several times
+        :return:
+        """
+        with self._lock:
+            return [path for (path, cnt) in self._requests.items() for i in range(cnt)]
+
+    def _expand(self, path):
+        cnt = self._requests.get(path, 0)
+        if cnt > 1:
+            self._requests[path] = cnt - 1
+        else:
+            self._requests.pop(path, None)
+        return cnt > 0
+
+    def _append(self, record, path):
+        self._fh.write("{} {}\n".format(record, path))
+        self._records += 1
+        self._dirty = True
+
+    def accept(self, fns):
+        """
+        Records the files accepted for conversion, the files which are already pending are not recorded again
+        :param fns: filenames
+        :return:
+        """
+        with self._lock:
+            for fn in fns:
+                if fn not in self._pending:
+                    self._pending[fn] = None
+                    self._append(JOURNAL_ACCEPTED, fn)
+
+    def request(self, paths):
+        """
+        Records the received requests before they are queued
+        :param paths: files, directories or patterns
+        :return:
+        """
+        with self._lock:
+            for path in paths:
+                self._requests[path] = self._requests.get(path, 0) + 1
+                self._append(JOURNAL_REQUEST, path)
+
+    def expanded(self, paths):
+        """
+        Records the requests whose files were accepted (accept())
+        :param paths: files, directories or patterns
+        :return:
+        """
+        with self._lock:
+            for path in paths:
+                if self._expand(path):
+                    self._append(JOURNAL_EXPANDED, path)
+
+    def done(self, fns):
+        """
+        Records the finished files
+        :param fns: filenames
+        :return:
+        """
+        with self._lock:
+            for fn in fns:
+                if fn in self._pending:
+                    del self._pending[fn]
+                    self._append(JOURNAL_DONE, fn)
+
+    def sync(self):
+        """
+        Group commit - writes the buffered records, a single fsync for all of them
+        :return:
+        """
+        with self._lock:
+            if not self._dirty or self._fh is None:
+                return
+            self._fh.flush()
+            self._dirty = False
+            fd = os.dup(self._fh.fileno())
+
+        try:
+            os.fsync(fd)
+        finally:
+            os.close(fd)
+
+    def compact(self, threshold=0):
+        """
+        Rewrites the journal with the pending files only, done if the journal has more than threshold records
+        and at least twice as many records as the pending files
+        :return: True if the journal was rewritten
+        """
+        with self._lock:
+            nrequests = sum(self._requests.values())
+            if self._fh is None or self._records <= max(threshold, 2 * (len(self._pending) + nrequests)):
+                return False
+
+            tfn = "{}.tmp".format(self.fn)
+            with open(tfn, "w", encoding="utf-8", errors="surrogateescape") as fh:
+                for (path, cnt) in self._requests.items():
+                    fh.write("{} {}\n".format(JOURNAL_REQUEST, path) * cnt)
+                for path in self._pending.keys():
+                    fh.write("{} {}\n".format(JOURNAL_ACCEPTED, path))
+                fh.flush()
+                os.fsync(fh.fileno())
+
+            self._fh.close()
+            os.replace(tfn, self.fn)
+            self._fh = open(self.fn, "a", encoding="utf-8", errors="surrogateescape")
+
+            if self.t is not None:
+                self.t.debug("Journal is compacted ({} -> {} records)".format(self._records, len(self._pending) + nrequests))
+
+            self._records = len(self._pending) + nrequests
+            self._dirty = False
+            return True
+
+    def close(self):
+        self.sync()
+        with self._lock:
+            if self._fh is not None:
+                self._fh.close()
+                self._fh = None
@@ -0,0 +1,208 @@
+__author__ = 'Konstantin Glazyrin'
+
+import time
+import threading
+from collections import deque
+
+# priority lanes of the ready files - live frames, backlog (reprocessing of the older data)
+LANE_HIGH = "high"
+LANE_LOW = "low"
+LANES = (LANE_HIGH, LANE_LOW)
+
+# interval of the tests of the queue of the workers while it is full (s)
+LANE_POLL = 0.005
+
+
+class LaneException(Exception):
+    """
+    Unknown lane or malformed rule of the lanes
+    """
+    pass
+
+
+def check_lane(lane):
+    """
+    Tests the name of the lane
+    :param lane: name of the lane or None (lane of the rules)
+    :return: lowercase name of the lane or None
+    """
+    if lane is None:
+        return None
+
+    res = str(lane).strip().lower()
+    if res not in LANES:
+        raise LaneException("Unknown priority lane ({}), expected one of {}".format(lane, LANES))
+    return res
+
+
+def get_lane_rules(conf):
+    """
+    Returns the default lanes per path prefix, the longest prefix is tested first
+    :param conf: app.config.main_config.Config
+    :return: tuple of (prefix, lane)
+    """
+    rules = conf.getProcPriorityPrefixes()
+    if rules is None:
+        return ()
+    return tuple(sorted(((prefix, check_lane(lane)) for (prefix, lane) in rules), key=lambda rule: -len(rule[0])))
+
+
+def resolve_lane(fn, rules, default=LANE_HIGH):
+    """
+    Returns the lane of the file - lane of the longest matching prefix, the default one otherwise
+    :param fn: filename
+    :param rules: tuple of (prefix, lane), see get_lane_rules()
+    :return:
+    """
+    for (prefix, lane) in rules:
+        if fn.startswith(prefix):
+            return lane
+    return default
+
+
+class PriorityLanes(object):
+    """
+    Ready files waiting for the workers - a queue per lane in the server, the queue of the workers is kept short,
+    so the files of the high lane overtake the backlog of the low lane
+    While both lanes have files, the low lane gets the reserved share of the dispatched files
+    """
+    def __init__(self, qfiles, conf, stats=None, logger=None):
+        """
+        :param qfiles: queue of the workers - (filename, timestamp of the request, timestamp of the dispatch) or lists of them
+        :param conf: app.config.main_config.Config
+        :param stats: app.common.stats.StageRecorder, time spent in the lanes is recorded if not None
+        """
+        self.qfiles = qfiles
+        self.c = conf
+        self.stats = stats
+        self.t = logger
+
+        # lane -> deque of (filename, timestamp of the request, timestamp of the readiness)
+        self._lanes = {lane: deque() for lane in LANES}
+
+        # files dispatched per lane while both lanes have files
+        self._sent = {lane: 0 for lane in LANES}
+
+        self._bounded = True
+        self._lock = threading.Lock()
+        self._event = threading.Event()
+
+    def add(self, lane, items, tstamp=None):
+        """
+        Adds the ready files to the lane
+        :param lane: LANE_HIGH or LANE_LOW
+        :param items: list of (filename, timestamp of the request)
+        :param tstamp: timestamp of the readiness
+        :return:
+        """
+        if tstamp is None:
+            tstamp = time.time()
+
+        with self._lock:
+            self._lanes[lane].extend((fn, tadded, tstamp) for (fn, tadded) in items)
+        self._event.set()
+
+    def getDepth(self, lane=None):
+        """
+        Returns the number of the files waiting in the lane
+        :param lane: name of the lane, all the lanes if None
+        :return:
+        """
+        with self._lock:
+            if lane is None:
+                return sum(len(el) for el in self._lanes.values())
+            return len(self._lanes[lane])
+
+    def _select(self):
+        """
+        Returns the lane of the next message, should be called with the lock acquired
+        :return: name of the lane or None if the lanes are empty
+        """
+        busy = [lane for lane in LANES if len(self._lanes[lane]) > 0]
+        if len(busy) < 2:
+            # the reserved share applies only while both lanes wait
+            for lane in LANES:
+                self._sent[lane] = 0
+            return busy[0] if len(busy) > 0 else None
+
+        share = min(max(float(self.c.getProcPriorityLowShare()), 0.), 1.)
+        if self._sent[LANE_LOW] + 1 <= share * (self._sent[LANE_HIGH] + self._sent[LANE_LOW] + 1):
+            return LANE_LOW
+        return LANE_HIGH
+
+    def _batch_size(self, lane, nready):
+        """
+        Number of files sent to a worker as one message - single files unless the lane is long,
+        the messages of the low lane are short, so a worker returns to the queue soon
+        :return:
+        """
+        nworkers = max(int(self.c.getProcMaxNumber()), 1)
+        max_batch = int(self.c.getProcDispatchMaxBatch() if lane == LANE_HIGH else self.c.getProcPriorityLowBatch())
+        return min(max(nready // (nworkers * 4), 1), max(max_batch, 1))
+
+    def _depth(self):
+        """
+        Returns the number of the messages in the queue of the workers, 0 if the platform does not report it
+        :return:
+        """
+        if not self._bounded:
+            return 0
+
+        try:
+            return self.qfiles.qsize()
+        except NotImplementedError:
+            self._bounded = False
+            if self.t is not None:
+                self.t.error("Queue size is not available on this platform, the lanes are dispatched without a limit")
+        return 0
+
+    def pump(self):
+        """
+        Moves the files of the lanes into the queue of the workers while the queue is short
+        :return: True if files are left in the lanes
+        """
+        limit = max(int(self.c.getProcPriorityQueueDepth()), 1) * max(int(self.c.getProcMaxNumber()), 1)
+
+        while True:
+            if self._bounded and self._depth() >= limit:
+                break
+
+            with self._lock:
+                lane = self._select()
+                if lane is None:
+                    return False
+
+                queue = self._lanes[lane]
+                items = [queue.popleft() for i in range(min(self._batch_size(lane, len(queue)), len(queue)))]
+                self._sent[lane] += len(items)
+
+            tstamp = time.time()
+            if self.stats is not None:
+                for item in items:
+                    self.stats.record("lane_" + lane, tstamp - item[2])
+
+            fns = [(fn, tadded, tstamp) for (fn, tadded, tready) in items]
+            self.qfiles.put(fns[0] if len(fns) == 1 else fns)
+        return True
+
+    def run(self, evstop):
+        """
+        Thread function - dispatches the files of the lanes as the workers take them
+        :param evstop: threading.Event stopping the thread
+        :return:
+        """
+        tdelay = min(self.c.getProcThreadSleepDelay(), 1)
+
+        while not evstop.is_set():
+            self._event.clear()
+            if self.pump():
+                evstop.wait(LANE_POLL)
+            else:
+                self._event.wait(tdelay)
+
+    def wake(self):
+        """
+        Wakes the thread, e.g. before stopping
+        :return:
+        """
+        self._event.set()
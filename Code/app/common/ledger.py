@@ -0,0 +1,141 @@
+__author__ = 'Konstantin Glazyrin'
+
+import os
+import time
+import sqlite3
+import hashlib
+import threading
+
+from app.common.pathmap import get_path_rules
+
+# status of the ledger records
+LEDGER_DONE = 1
+
+# number of paths in a single lookup query - sqlite limits the number of the query parameters
+LEDGER_QUERY_CHUNK = 500
+
+
+def get_settings_key(conf):
+    """
+    Returns the key of the settings changing the converted files - a file converted with other settings is converted again
+    :param conf: app.config.main_config.Config
+    :return: str
+    """
+    settings = (conf.getProcFileConvType(), conf.getProcFileRotation(), conf.getProcFileFlip(),
+                conf.getProcFileCompression(), conf.getProcFileCompressionLevel(), conf.getProcFileWriter(),
+                conf.getProcFileMultiframe(), get_path_rules(conf))
+    return hashlib.sha1(repr(settings).encode("utf-8")).hexdigest()
+
+
+class ConversionLedger(object):
+    """
+    Persistent record of the converted files (sqlite3), survives the restarts of the server
+    A record is keyed by the absolute source path and keeps the size and the modification time of the source,
+    the output path, the key of the conversion settings and the status - a file is up to date if its size, mtime and
+    the settings match (and its output exists if check_output is set)
+    """
+    SCHEMA = "CREATE TABLE IF NOT EXISTS ledger (src TEXT PRIMARY KEY, size INTEGER, mtime REAL, dst TEXT, " \
+             "status INTEGER, tstamp REAL, settings TEXT)"
+
+    def __init__(self, fn, logger=None, conf=None, check_output=False):
+        """
+        :param fn: database file
+        :param conf: app.config.main_config.Config, the key of its settings is kept with the records (get_settings_key())
+        :param check_output: an up to date file should have its output - a metadata call per recorded file
+        """
+        self.fn = fn
+        self.t = logger
+        self.c = conf
+        self.check_output = check_output
+
+        # the connection is shared by the sorting thread (lookups) and the recording thread (updates)
+        self._lock = threading.Lock()
+        self._db = sqlite3.connect(fn, check_same_thread=False)
+
+        with self._lock:
+            self._db.execute("PRAGMA journal_mode=WAL")
+            self._db.execute("PRAGMA synchronous=NORMAL")
+            self._db.execute(self.SCHEMA)
+
+            # databases of the earlier versions - the records without the settings are converted again once
+            columns = [row[1] for row in self._db.execute("PRAGMA table_info(ledger)")]
+            if "settings" not in columns:
+                self._db.execute("ALTER TABLE ledger ADD COLUMN settings TEXT")
+            self._db.commit()
+
+        if self.t is not None:
+            self.t.debug("Using the conversion ledger ({})".format(fn))
+
+    def __len__(self):
+        with self._lock:
+            return self._db.execute("SELECT COUNT(*) FROM ledger").fetchone()[0]
+
+    def getSettings(self):
+        """
+        Returns the key of the current conversion settings, None without a configuration
+        :return:
+        """
+        return get_settings_key(self.c) if self.c is not None else None
+
+    def filterConverted(self, fns):
+        """
+        Removes the up to date files from the list
+        The records are looked up first - only the recorded sources are tested (stat), new files cost no metadata calls
+        :param fns: filenames
+        :return: (files to convert, up to date files)
+        """
+        settings = self.getSettings()
+
+        # records converted with the current settings
+        records = {}
+        paths = list(set(os.path.abspath(fn) for fn in fns))
+        with self._lock:
+            for i in range(0, len(paths), LEDGER_QUERY_CHUNK):
+                chunk = paths[i:i + LEDGER_QUERY_CHUNK]
+                query = "SELECT src, size, mtime, dst FROM ledger WHERE status=? AND settings IS ? AND src IN ({})".format(
+                    ",".join("?" * len(chunk)))
+                for (src, size, mtime, dst) in self._db.execute(query, [LEDGER_DONE, settings] + chunk):
+                    records[src] = (size, mtime, dst)
+
+        res, skipped = [], []
+        for fn in fns:
+            record = records.get(os.path.abspath(fn))
+
+            bskip = False
+            if record is not None:
+                try:
+                    st = os.stat(fn)
+                    bskip = record[0] == st.st_size and record[1] == st.st_mtime
+                except OSError:
+                    pass
+                bskip = bskip and (not self.check_output or os.path.exists(record[2]))
+
+            if bskip:
+                skipped.append(fn)
+            else:
+                res.append(fn)
+
+        return res, skipped
+
+    def record(self, items):
+        """
+        Records the converted files in a single transaction
+        :param items: list of (source, size, mtime, output, ...), items without the output (failed files) are ignored
+        :return:
+        """
+        tstamp, settings = time.time(), self.getSettings()
+        rows = [(os.path.abspath(item[0]), item[1], item[2], item[3], LEDGER_DONE, tstamp, settings) for item in items
+                if item[3] is not None]
+        if len(rows) == 0:
+            return
+
+        with self._lock:
+            self._db.executemany("INSERT OR REPLACE INTO ledger (src, size, mtime, dst, status, tstamp, settings) "
+                                 "VALUES (?, ?, ?, ?, ?, ?, ?)", rows)
+            self._db.commit()
+
+    def close(self):
+        with self._lock:
+            if self._db is not None:
+                self._db.close()
+                self._db = None
@@ -0,0 +1,174 @@
+__author__ = 'Konstantin Glazyrin'
+
+import os
+import re
+import threading
+from collections import OrderedDict
+
+# kinds of the rules - (kind, source, destination)
+# "prefix" - the path starts with the source, "regex" - re.sub() of the first match,
+# "segment" - the first occurrence of the source made of whole path components (e.g. "raw" matches /data/raw/x.tif, not /data/raw_2/x.tif),
+# "replace" - every occurrence of the source anywhere in the path (str.replace, the legacy PROC_PATH_REPLACE,
+# e.g. "raw" maps /data/raw_data/x.tif to /data/processed_data/x.tif)
+RULE_PREFIX = "prefix"
+RULE_REGEX = "regex"
+RULE_SEGMENT = "segment"
+RULE_REPLACE = "replace"
+RULE_KINDS = (RULE_PREFIX, RULE_REGEX, RULE_SEGMENT, RULE_REPLACE)
+
+# compiled mappers of the process - rules -> PathMapper
+PATH_MAPPERS = {}
+
+# directory cache of the process
+DIR_CACHE = None
+DIR_CACHE_LOCK = threading.Lock()
+
+
+class PathMapException(Exception):
+    """
+    Rule cannot be compiled
+    """
+    pass
+
+
+class PathMapper(object):
+    """
+    Ordered rules mapping the source files to the converted files, compiled once - the first matching rule is applied
+    """
+    def __init__(self, rules):
+        """
+        :param rules: sequence of (kind, source, destination), see RULE_KINDS
+        """
+        self.rules = tuple(tuple(rule) for rule in rules)
+        self._compiled = [self._compile(*rule) for rule in self.rules]
+
+    def _compile(self, kind, source, destination):
+        """
+        Returns (kind, compiled pattern or prefix, destination or replacement function)
+        :return:
+        """
+        if kind == RULE_PREFIX:
+            return kind, source, destination
+        elif kind == RULE_REPLACE:
+            if len(source) == 0:
+                raise PathMapException("Path rule ({}) has an empty source".format(kind))
+            return kind, source, destination
+        elif kind == RULE_REGEX:
+            try:
+                return kind, re.compile(source), destination
+            except re.error as e:
+                raise PathMapException("Path rule ({}) cannot be compiled ({})".format(source, e))
+        elif kind == RULE_SEGMENT:
+            pattern = r"(?:^|(?<=[\\/])){}(?=[\\/]|$)".format(re.escape(source.rstrip("\\/")))
+            replacement = destination.rstrip("\\/")
+            return kind, re.compile(pattern), lambda match: replacement
+        raise PathMapException("Unknown kind of the path rule ({}), expected one of {}".format(kind, RULE_KINDS))
+
+    def map(self, fn):
+        """
+        Returns the mapped path
+        :param fn: source filename
+        :return: mapped filename, None if no rule matches
+        """
+        for (kind, source, destination) in self._compiled:
+            if kind == RULE_PREFIX:
+                if fn.startswith(source):
+                    return destination + fn[len(source):]
+            elif kind == RULE_REPLACE:
+                if source in fn:
+                    return fn.replace(source, destination)
+            else:
+                res, cnt = source.subn(destination, fn, count=1)
+                if cnt > 0:
+                    return res
+        return None
+
+    def __str__(self):
+        return ", ".join("{}: {} -> {}".format(*rule) for rule in self.rules)
+
+
+def get_path_rules(conf):
+    """
+    Returns the mapping rules of the configuration - PROC_PATH_RULES or the legacy (needle, replacement) of PROC_PATH_REPLACE
+    as a replace rule, the substring semantics of the earlier versions are kept
+    :param conf: app.config.main_config.Config
+    :return: tuple of rules
+    """
+    res = conf.getProcPathRules()
+    if res is None or len(res) == 0:
+        needle, replacement = conf.getProcPathReplacement()
+        res = ((RULE_REPLACE, needle, replacement),)
+    return tuple(tuple(rule) for rule in res)
+
+
+def get_path_mapper(conf):
+    """
+    Returns the compiled mapper of the configuration, compiled once per process and set of rules
+    :param conf: app.config.main_config.Config
+    :return: PathMapper
+    """
+    rules = get_path_rules(conf)
+
+    res = PATH_MAPPERS.get(rules)
+    if res is None:
+        res = PathMapper(rules)
+        PATH_MAPPERS[rules] = res
+    return res
+
+
+class DirectoryCache(object):
+    """
+    Least recently used directories known to exist - a directory is created (tested) once, not for every file
+    """
+    def __init__(self, size=4096):
+        self.size = max(int(size), 1)
+        self._dirs = OrderedDict()
+        self._lock = threading.Lock()
+
+    def makedirs(self, path):
+        """
+        Creates the directory unless it is known to exist
+        :param path: directory
+        :return: True if the file system was accessed
+        """
+        with self._lock:
+            if path in self._dirs:
+                self._dirs.move_to_end(path)
+                return False
+
+        os.makedirs(path, exist_ok=True)
+
+        with self._lock:
+            self._dirs[path] = None
+            while len(self._dirs) > self.size:
+                self._dirs.popitem(last=False)
+        return True
+
+    def discard(self, path):
+        """
+        Forgets the directory, e.g. after a failed write into a removed directory
+        :return:
+        """
+        with self._lock:
+            self._dirs.pop(path, None)
+
+    def clear(self):
+        with self._lock:
+            self._dirs.clear()
+
+    def __len__(self):
+        return len(self._dirs)
+
+
+def get_dir_cache(size=4096):
+    """
+    Returns the directory cache of the process, created on the first use
+    :param size: number of the kept directories
+    :return: DirectoryCache
+    """
+    global DIR_CACHE
+
+    with DIR_CACHE_LOCK:
+        if DIR_CACHE is None:
+            DIR_CACHE = DirectoryCache(size)
+    return DIR_CACHE
@@ -0,0 +1,200 @@
+__author__ = 'Konstantin Glazyrin'
+
+import os
+import zlib
+import errno
+import threading
+from collections import OrderedDict
+
+import numpy as np
+
+from app.common import tifwriter
+
+# cloning needs the ioctl of Linux
+try:
+    import fcntl
+except ImportError:
+    fcntl = None
+
+# ioctl cloning a file - the blocks are shared copy-on-write (btrfs, XFS, bcachefs), the files stay independent
+FICLONE = 0x40049409
+
+# errors of the file systems (or pairs of files on different devices) which cannot be cloned
+CLONE_ERRORS = (errno.EXDEV, errno.EOPNOTSUPP, errno.ENOTTY, errno.EINVAL, errno.ENOSYS, errno.EPERM)
+
+# folder of the encoded copies cloned into the placeholders, relative to the log folder
+PLACEHOLDER_FOLDER = "placeholders"
+
+# placeholder cache of the process
+PLACEHOLDER_CACHE = None
+PLACEHOLDER_CACHE_LOCK = threading.Lock()
+
+
+def clone_file(src, dst):
+    """
+    Clones the file (FICLONE), nothing is copied - the clone shares the blocks of the source until either is modified
+    :param src: source file
+    :param dst: created or truncated file
+    :return:
+    """
+    if fcntl is None:
+        raise OSError(errno.ENOSYS, "Cloning is not supported")
+
+    fd_src = os.open(src, os.O_RDONLY)
+    try:
+        fd = os.open(dst, os.O_WRONLY | os.O_CREAT | os.O_TRUNC, 0o666)
+        try:
+            fcntl.ioctl(fd, FICLONE, fd_src)
+        finally:
+            os.close(fd)
+    finally:
+        os.close(fd_src)
+
+
+class PlaceholderCache(object):
+    """
+    Placeholders of the files which have not arrived - empty images encoded once per (shape, type, compression)
+    The shape is learned from the last converted frame of the source directory, the configured shape is used before
+    """
+    def __init__(self, shape=(2048, 2048), learn=True, clone=True, templates=4, directories=4096, folder=None, logger=None):
+        """
+        :param shape: (rows, columns) of the placeholders of the directories without a converted frame
+        :param learn: shapes of the converted frames are used
+        :param clone: placeholders are cloned from an encoded copy in the folder if the file system allows
+        :param templates: number of the encoded placeholders kept in memory
+        :param directories: number of the directories with a learned shape
+        :param folder: folder of the encoded copies, no cloning if None
+        """
+        self.shape = tuple(int(el) for el in shape)
+        self.learning = learn
+        self.cloning = clone and fcntl is not None and folder is not None
+        self.size = max(int(templates), 1)
+        self.directories = max(int(directories), 1)
+        self.folder = folder
+        self.t = logger
+
+        # directory -> shape
+        self._shapes = OrderedDict()
+
+        # (shape, type, options) -> [buffers, size, path of the encoded copy, key]
+        self._templates = OrderedDict()
+
+        self._lock = threading.Lock()
+
+    def learn(self, fn, shape):
+        """
+        Records the shape of a converted frame
+        :param fn: source filename
+        :param shape: (rows, columns) of the converted frame, ignored if None
+        :return:
+        """
+        if not self.learning or shape is None or len(shape) != 2:
+            return
+
+        path = os.path.dirname(fn)
+        with self._lock:
+            self._shapes[path] = tuple(int(el) for el in shape)
+            self._shapes.move_to_end(path)
+            while len(self._shapes) > self.directories:
+                self._shapes.popitem(last=False)
+
+    def getShape(self, fn):
+        """
+        Returns the shape of the placeholder of the file
+        :param fn: source filename
+        :return: (rows, columns)
+        """
+        with self._lock:
+            return self._shapes.get(os.path.dirname(fn), self.shape)
+
+    def _template(self, shape, dtype, options):
+        """
+        Returns the encoded placeholder, the least recently used ones are dropped
+        :return: [buffers, size, path of the encoded copy, key]
+        """
+        key = (tuple(shape), np.dtype(dtype).str, tuple(sorted(options.items())))
+
+        with self._lock:
+            res = self._templates.get(key)
+            if res is not None:
+                self._templates.move_to_end(key)
+                return res
+
+        # zeros are allocated lazily - the untouched pages are not kept in memory
+        buffers = tifwriter.encode_tiff(np.zeros(shape, dtype=dtype), **options)
+        res = [buffers, sum(memoryview(b).nbytes for b in buffers), None, key]
+
+        with self._lock:
+            self._templates[key] = res
+            while len(self._templates) > self.size:
+                self._templates.popitem(last=False)
+        return res
+
+    def _copy(self, template):
+        """
+        Returns the encoded copy of the placeholder for the cloning, written on the first use
+        :return: path or None if cloning is not possible
+        """
+        buffers, size, path, key = template
+        if path is None:
+            (rows, cols), dtype, options = key
+            path = os.path.join(self.folder, "{}x{}_{}_{:08x}.tif".format(rows, cols, np.dtype(dtype).name,
+                                                                          zlib.crc32(repr(options).encode())))
+            try:
+                os.makedirs(self.folder, exist_ok=True)
+                if not os.path.isfile(path) or os.path.getsize(path) != size:
+                    tifwriter.write_buffers(path + ".part", buffers)
+                    os.replace(path + ".part", path)
+                template[2] = path
+            except OSError as e:
+                path = None
+                self.cloning = False
+                if self.t is not None:
+                    self.t.error("Cannot write the copy of the placeholder ({}), placeholders are written".format(e))
+        return path
+
+    def write(self, fn, shape, dtype, options):
+        """
+        Writes the placeholder - cloned from the encoded copy if the file system allows, the cached bytes are written otherwise
+        :param fn: filename
+        :param shape: (rows, columns)
+        :param dtype: type of the pixels
+        :param options: keyword arguments of app.common.tifwriter.encode_tiff()
+        :return: size of the placeholder (bytes)
+        """
+        template = self._template(shape, dtype, options)
+
+        if self.cloning:
+            path = self._copy(template)
+            if path is not None:
+                try:
+                    clone_file(path, fn)
+                    return template[1]
+                except OSError as e:
+                    if e.errno not in CLONE_ERRORS:
+                        raise
+
+                    # the destination file system does not share blocks - the bytes are written from now on
+                    self.cloning = False
+                    if self.t is not None:
+                        self.t.info("Placeholders cannot be cloned ({}), the placeholders are written".format(e))
+
+        return tifwriter.write_buffers(fn, template[0])
+
+
+def get_placeholder_cache(conf, logger=None):
+    """
+    Returns the placeholder cache of the process, created on the first use
+    :param conf: app.config.main_config.Config
+    :return: PlaceholderCache
+    """
+    global PLACEHOLDER_CACHE
+
+    with PLACEHOLDER_CACHE_LOCK:
+        if PLACEHOLDER_CACHE is None:
+            PLACEHOLDER_CACHE = PlaceholderCache(conf.getProcFileSkipShape(), learn=conf.getProcFileSkipLearn(),
+                                                 clone=conf.getProcFileSkipClone(), templates=conf.getProcFileSkipCache(),
+                                                 directories=conf.getProcPathDirCache(),
+                                                 folder=os.path.join(conf.getFolderLog(), PLACEHOLDER_FOLDER),
+                                                 logger=logger)
+    return PLACEHOLDER_CACHE
@@ -0,0 +1,46 @@
+__author__ = 'Konstantin Glazyrin'
+
+import os
+
+# extensions of the files to convert
+SCAN_EXTENSIONS = (".tif", ".tiff")
+
+# files with these parts of the path are not converted
+SCAN_EXCLUDE = ("dark",)
+
+
+def scan_files(path, recursive=False, extensions=SCAN_EXTENSIONS, exclude=SCAN_EXCLUDE, logger=None):
+    """
+    Yields the files of the directory as they are found
+    The type information of os.DirEntry is used, no additional stat is done for the regular entries
+    :param path: directory
+    :param recursive: scan the subdirectories
+    :param extensions: extensions of the files (lower case)
+    :param exclude: parts of the path (lower case) excluding the file
+    :return: paths of the files
+    """
+    t = logger
+
+    dirs = [path]
+    while len(dirs) > 0:
+        d = dirs.pop()
+        try:
+            with os.scandir(d) as it:
+                for entry in it:
+                    try:
+                        if entry.is_dir(follow_symlinks=False):
+                            if recursive:
+                                dirs.append(entry.path)
+                            continue
+
+                        if not entry.is_file():
+                            continue
+                    except OSError:
+                        continue
+
+                    lpath = entry.path.lower()
+                    if lpath.endswith(extensions) and not any(el in lpath for el in exclude):
+                        yield entry.path
+        except OSError as e:
+            if t is not None:
+                t.error("Cannot scan the directory ({}:{})".format(d, e))
@@ -0,0 +1,252 @@
+__author__ = 'Konstantin Glazyrin'
+
+import os
+import time
+import errno
+import shutil
+
+from app.common.stats import get_staging_backlog
+from app.common.pathmap import get_dir_cache
+
+# suffix of the files being written - in the staging folder and at the destination
+STAGING_PART = ".part"
+
+# first folder of the staged paths - absolute paths without a drive, UNC shares
+STAGING_ROOT = "root"
+STAGING_UNC = "unc"
+
+# interval of the tests of the staging backlog while a writing process waits (s)
+STAGING_WAIT = 0.02
+
+# maximal delay between the retries of an upload (s)
+STAGING_BACKOFF_MAX = 30.
+
+# staging area of the process, set by the processes writing the files (app.worker.start_staging)
+STAGING_AREA = None
+
+
+def set_staging(area):
+    """
+    Sets the staging area used by the writers of the process
+    :param area: StagingArea or None - files are written to their destination
+    :return:
+    """
+    global STAGING_AREA
+    STAGING_AREA = area
+
+
+def get_staging():
+    """
+    Returns the staging area of the process
+    :return: StagingArea or None
+    """
+    return STAGING_AREA
+
+
+def get_staging_path(folder, fn):
+    """
+    Returns the path of the destination file in the staging folder - the destination tree is mirrored
+    :param folder: staging folder
+    :param fn: destination filename
+    :return:
+    """
+    drive, tail = os.path.splitdrive(os.path.abspath(fn))
+    drive = drive.replace("\\", "/")
+
+    if drive.startswith("//"):
+        head = [STAGING_UNC] + [el for el in drive.split("/") if len(el) > 0]
+    elif len(drive) > 0:
+        head = [drive.rstrip(":")]
+    else:
+        head = [STAGING_ROOT]
+
+    tail = [el for el in tail.replace("\\", "/").split("/") if len(el) > 0]
+    return os.path.join(folder, *(head + tail))
+
+
+def get_destination_path(folder, path):
+    """
+    Returns the destination of a file in the staging folder, reverse of get_staging_path()
+    :param folder: staging folder
+    :param path: path of the staged file
+    :return: filename or None if the path does not belong to the staging folder
+    """
+    parts = os.path.relpath(path, folder).replace("\\", "/").split("/")
+    if len(parts) < 2 or parts[0] == "..":
+        return None
+
+    if parts[0] == STAGING_ROOT:
+        res = os.sep + os.path.join(*parts[1:])
+    elif parts[0] == STAGING_UNC and len(parts) > 3:
+        res = "\\\\" + "\\".join(parts[1:])
+    else:
+        res = parts[0] + ":" + os.sep + os.path.join(*parts[1:])
+    return res
+
+
+def recover_staged(folder, logger=None):
+    """
+    Returns the files left in the staging folder by the previous run, the incomplete files are removed
+    :param folder: staging folder
+    :return: list of (staged path, destination filename, size)
+    """
+    t = logger
+
+    res = []
+    if not os.path.isdir(folder):
+        return res
+
+    for (root, dirs, files) in os.walk(folder):
+        for el in files:
+            path = os.path.join(root, el)
+            try:
+                if el.endswith(STAGING_PART):
+                    os.remove(path)
+                    continue
+
+                fn = get_destination_path(folder, path)
+                if fn is not None:
+                    res.append((path, fn, os.path.getsize(path)))
+            except OSError as e:
+                if t is not None:
+                    t.error("Cannot recover the staged file ({}:{})".format(path, e))
+    return res
+
+
+def upload_file(staged, fn, retries=5, backoff=0.5, logger=None):
+    """
+    Moves the staged file to its destination - renamed if both are on the same device,
+    copied as <name>.part and renamed in place otherwise, readers never see an incomplete file
+    Failed attempts are retried with an exponential backoff, the staged file is removed after the upload
+    :param staged: path of the file in the staging folder
+    :param fn: destination filename
+    :param retries: number of the retries
+    :param backoff: delay before the first retry (s)
+    :return: size of the file (bytes)
+    """
+    t = logger
+
+    res = os.path.getsize(staged)
+    part = fn + STAGING_PART
+    dir_new = os.path.dirname(fn)
+
+    attempt = 0
+    while True:
+        try:
+            get_dir_cache().makedirs(dir_new)
+
+            if os.stat(staged).st_dev == os.stat(dir_new).st_dev:
+                os.replace(staged, fn)
+            else:
+                shutil.copyfile(staged, part)
+                os.replace(part, fn)
+                os.remove(staged)
+            break
+        except (IOError, OSError) as e:
+            get_dir_cache().discard(dir_new)
+            try:
+                if os.path.exists(part):
+                    os.remove(part)
+            except OSError:
+                pass
+
+            if attempt >= retries:
+                raise
+
+            delay = min(backoff * 2 ** attempt, STAGING_BACKOFF_MAX)
+            attempt += 1
+            if t is not None:
+                t.warning("Upload of ({}) has failed ({}), retry ({}/{}) in ({:.1f}s)".format(fn, e, attempt, retries, delay))
+            time.sleep(delay)
+    return res
+
+
+class StagingArea(object):
+    """
+    Local staging folder of a writing process - the files are written as <name>.part, renamed when complete and
+    passed to the uploader processes (app.uploader.uploader)
+    The writers wait while the backlog of the uploads exceeds the limits (back-pressure) - until the server stops
+    """
+    def __init__(self, folder, upload_queue, counters, recorder, max_files=256, max_bytes=4294967296, logger=None, stop=None):
+        """
+        :param folder: staging folder
+        :param upload_queue: queue of (staged path, destination filename, timestamp of the staging)
+        :param counters: app.common.stats.SharedCounters, the backlog is summed over all the processes
+        :param recorder: app.common.stats.CounterRecorder of the process
+        :param stop: multiprocessing.Event set by the Starter when it stops, the waiting writers give up
+        """
+        self.folder = folder
+        self.queue = upload_queue
+        self.counters = counters
+        self.recorder = recorder
+        self.max_files = max_files
+        self.max_bytes = max_bytes
+        self.t = logger
+        self.stop = stop
+
+    def getBacklog(self):
+        """
+        Returns the files waiting for the upload
+        :return: (files, bytes)
+        """
+        return get_staging_backlog(self.counters.snapshot())
+
+    def wait(self):
+        """
+        Waits until the backlog of the uploads is below the limits
+        The failed uploads stay in the backlog - with the destination unavailable the wait ends when the server stops,
+        the file fails (OSError) and the writing process can receive its stop signal
+        :return: time of waiting (s)
+        """
+        tstart = time.time()
+        files, nbytes = self.getBacklog()
+        if files < self.max_files and nbytes < self.max_bytes:
+            return 0.
+
+        if self.t is not None:
+            self.t.debug("Staging folder is full ({} files, {} bytes), waiting for the uploads", files, nbytes)
+
+        while files >= self.max_files or nbytes >= self.max_bytes:
+            if self.stop is not None and self.stop.is_set():
+                raise OSError(errno.ENOSPC, "Server is stopping and the staging folder is full ({} files, {} bytes)".format(
+                    files, nbytes))
+            time.sleep(STAGING_WAIT)
+            files, nbytes = self.getBacklog()
+        return time.time() - tstart
+
+    def reserve(self, fn):
+        """
+        Waits for the space in the staging folder and returns the path for the writer, see wait()
+        :param fn: destination filename
+        :return: path of the incomplete file in the staging folder
+        """
+        self.wait()
+
+        res = get_staging_path(self.folder, fn)
+        get_dir_cache().makedirs(os.path.dirname(res))
+        return res + STAGING_PART
+
+    def commit(self, part, fn):
+        """
+        Completes the written file and passes it to the uploaders
+        :param part: path returned by reserve()
+        :param fn: destination filename
+        :return:
+        """
+        staged = part[:-len(STAGING_PART)]
+        os.replace(part, staged)
+
+        if self.recorder is not None:
+            self.recorder.add(staged=1, staged_bytes=os.path.getsize(staged))
+        self.queue.put((staged, fn, time.time()))
+
+    def discard(self, part):
+        """
+        Removes an incomplete file after a failed write
+        :return:
+        """
+        try:
+            if os.path.exists(part):
+                os.remove(part)
+        except OSError:
+            pass
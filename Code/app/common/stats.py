@@ -0,0 +1,275 @@
+__author__ = 'Konstantin Glazyrin'
+
+import time
+import math
+import ctypes
+import threading
+from collections import deque
+from multiprocessing.sharedctypes import RawArray
+
+# measured stages - readiness tests, waiting in the high/low priority lane of the server, waiting in the queue for a worker, fabio open/decode, output path and directory,
+# clamp/cast fused with the orientation, header + write of the file, from the staging folder till the destination (write-behind),
+# from AddFileOrDir till the written output
+STAGES = ("ready", "lane_high", "lane_low", "queue", "open", "makedirs", "transform", "write", "upload", "total")
+
+# log-spaced buckets - HIST_STEPS per decade from 10us to 10000s, the first and the last buckets collect the outliers
+HIST_MIN = 1e-5
+HIST_DECADES = 9
+HIST_STEPS = 8
+HIST_BUCKETS = HIST_DECADES * HIST_STEPS + 2
+
+
+def get_bucket(value):
+    """
+    Returns the bucket of a duration
+    :param value: duration (s)
+    :return:
+    """
+    if value < HIST_MIN:
+        return 0
+    return min(int(math.log10(value / HIST_MIN) * HIST_STEPS) + 1, HIST_BUCKETS - 1)
+
+
+def get_bucket_edge(bucket):
+    """
+    Returns the upper edge of the bucket (s)
+    :return:
+    """
+    return HIST_MIN * 10 ** (float(min(bucket, HIST_BUCKETS - 2)) / HIST_STEPS)
+
+
+class StageHistograms(object):
+    """
+    Fixed bucket histograms of the stage durations shared by the processes
+    Every process writes only its own slot (a row of counters), no lock is shared between the processes -
+    the slots are summed up when the percentiles are requested
+    """
+    def __init__(self, slots):
+        self.slots = int(slots)
+        self.array = RawArray(ctypes.c_uint64, self.slots * len(STAGES) * HIST_BUCKETS)
+
+    def recorder(self, slot):
+        """
+        Returns the object updating the slot, should be created in the process using it
+        :param slot: index of the slot
+        :return: StageRecorder
+        """
+        return StageRecorder(self.array, slot % self.slots)
+
+    def counts(self, stage):
+        """
+        Returns the counts of the stage summed over the slots
+        :param stage: name of the stage
+        :return: list of counts per bucket
+        """
+        istage = STAGES.index(stage)
+
+        res = [0] * HIST_BUCKETS
+        for slot in range(self.slots):
+            offset = (slot * len(STAGES) + istage) * HIST_BUCKETS
+            row = self.array[offset:offset + HIST_BUCKETS]
+            for (i, v) in enumerate(row):
+                res[i] += v
+        return res
+
+    def percentiles(self, stage, values=(50, 95, 99), since=None):
+        """
+        Returns the percentiles of the stage duration - upper edges of the buckets (s), zeros if nothing was measured
+        :param stage: name of the stage
+        :param values: percentiles
+        :param since: counts of the stage returned by counts() before, only the durations recorded afterwards are used
+        :return: list
+        """
+        counts = self.counts(stage)
+        if since is not None:
+            # the histograms could be reset meanwhile
+            counts = [max(v - v0, 0) for (v, v0) in zip(counts, since)]
+        total = sum(counts)
+
+        res = []
+        for p in values:
+            if total == 0:
+                res.append(0.)
+                continue
+
+            target, cum = total * p / 100., 0
+            for (i, v) in enumerate(counts):
+                cum += v
+                if cum >= target:
+                    res.append(get_bucket_edge(i))
+                    break
+        return res
+
+    def reset(self):
+        ctypes.memset(self.array, 0, ctypes.sizeof(self.array))
+
+
+class StageRecorder(object):
+    """
+    Updates a single slot of the shared histograms, the threads of a process share the recorder
+    """
+    def __init__(self, array, slot):
+        self.array = array
+        self.offset = slot * len(STAGES) * HIST_BUCKETS
+        self._lock = threading.Lock()
+
+    def record(self, stage, value):
+        """
+        Adds the duration of the stage
+        :param stage: name of the stage
+        :param value: duration (s)
+        :return:
+        """
+        if value is None:
+            return
+
+        i = self.offset + STAGES.index(stage) * HIST_BUCKETS + get_bucket(value)
+        with self._lock:
+            self.array[i] += 1
+
+
+# counters of the processes - converted frames, conversion time (s), converted files, bytes of the source files,
+# bytes of the written files, placeholders written for the missing/incomplete files, failed conversions,
+# write-behind - files (bytes) written into the staging folder, moved to the destination, given up after the retries
+COUNTERS = ("frames", "time", "files", "bytes_read", "bytes_written", "skips", "errors",
+            "staged", "staged_bytes", "uploaded", "uploaded_bytes", "upload_errors", "upload_errors_bytes")
+
+# reads of a row being updated before its last copy is used - a process killed during an update leaves the row odd
+SEQLOCK_RETRIES = 100
+
+
+class SharedCounters(object):
+    """
+    Counters shared by the processes - a row per slot (sequence number followed by the counters) in a shared array
+    A row is written only by its process (seqlock - the sequence number is odd while the row is updated),
+    the readers sum up the consistent copies of the rows
+    """
+    def __init__(self, slots):
+        self.slots = int(slots)
+        self.width = len(COUNTERS) + 1
+        self.array = RawArray(ctypes.c_double, self.slots * self.width)
+
+    def recorder(self, slot):
+        """
+        Returns the object updating the slot, should be created in the process using it
+        :param slot: index of the slot
+        :return: CounterRecorder
+        """
+        return CounterRecorder(self.array, slot % self.slots, self.width)
+
+    def _read(self, slot):
+        """
+        Returns a consistent copy of the counters of the slot,
+        the last copy if the row stays odd (its process was killed during an update)
+        :return:
+        """
+        offset = slot * self.width
+        for i in range(SEQLOCK_RETRIES):
+            seq = self.array[offset]
+            row = self.array[offset + 1:offset + self.width]
+            if seq % 2 == 0 and self.array[offset] == seq:
+                break
+            time.sleep(0)
+        return row
+
+    def reset(self, slot):
+        """
+        Makes the sequence number of the slot even again, should be called before the slot is given to a new process -
+        the previous process could have been killed during an update
+        :param slot: index of the slot
+        :return:
+        """
+        offset = (slot % self.slots) * self.width
+        if self.array[offset] % 2 != 0:
+            self.array[offset] += 1
+
+    def snapshot(self):
+        """
+        Returns the counters summed over the slots
+        :return: dict
+        """
+        res = [0.] * len(COUNTERS)
+        for slot in range(self.slots):
+            for (i, v) in enumerate(self._read(slot)):
+                res[i] += v
+        return dict(zip(COUNTERS, res))
+
+
+def get_staging_backlog(snapshot):
+    """
+    Returns the files waiting in the staging folder for the upload
+    :param snapshot: dict of SharedCounters.snapshot(), the counters are not reset
+    :return: (files, bytes)
+    """
+    files = snapshot["staged"] - snapshot["uploaded"] - snapshot["upload_errors"]
+    nbytes = snapshot["staged_bytes"] - snapshot["uploaded_bytes"] - snapshot["upload_errors_bytes"]
+    return int(max(files, 0)), int(max(nbytes, 0))
+
+
+class CounterRecorder(object):
+    """
+    Updates a single slot of the shared counters, the threads of a process share the recorder
+    """
+    def __init__(self, array, slot, width):
+        self.array = array
+        self.offset = slot * width
+        self._lock = threading.Lock()
+
+    def add(self, **kwargs):
+        """
+        Adds the values to the counters, e.g. add(frames=1, time=0.1)
+        :return:
+        """
+        with self._lock:
+            self.array[self.offset] += 1
+            for (k, v) in kwargs.items():
+                self.array[self.offset + 1 + COUNTERS.index(k)] += v
+            self.array[self.offset] += 1
+
+
+class CounterWindow(object):
+    """
+    Samples of the shared counters for the sliding window rates
+    """
+    def __init__(self, counters, length=600.):
+        self.counters = counters
+        self.length = length
+        self._samples = deque()
+        self._lock = threading.Lock()
+
+    def sample(self, tstamp=None):
+        """
+        Adds a sample of the counters, the samples older than the longest window are removed
+        :return:
+        """
+        if tstamp is None:
+            tstamp = time.time()
+
+        snapshot = self.counters.snapshot()
+        with self._lock:
+            self._samples.append((tstamp, snapshot))
+            while len(self._samples) > 2 and tstamp - self._samples[1][0] >= self.length:
+                self._samples.popleft()
+
+    def rate(self, name, window):
+        """
+        Returns the rate of the counter over the last window (1/s)
+        :param name: name of the counter
+        :param window: length of the window (s)
+        :return:
+        """
+        res = 0.
+        with self._lock:
+            if len(self._samples) < 2:
+                return res
+
+            tlast, last = self._samples[-1]
+            tfirst, first = self._samples[0]
+            for (tstamp, snapshot) in reversed(self._samples):
+                if tlast - tstamp > window:
+                    break
+                tfirst, first = tstamp, snapshot
+
+        if tlast > tfirst:
+            res = (last[name] - first[name]) / (tlast - tfirst)
+        return res
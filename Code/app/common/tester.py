@@ -3,12 +3,116 @@ __author__ = 'Konstantin Glazyrin'
 import os
 import time
 import glob
+import signal
 import logging
+import logging.handlers
 
 import app.config.main_config as config
 
 DEBUG_LEVEL = config.GLOBAL_DEBUG_LEVEL
 
+# queue of the log records written by the listener process (log_listener), None - every logger writes its own file
+LOG_QUEUE = None
+
+
+def set_log_queue(queue):
+    """
+    Sets the queue of the log records, used by the loggers created afterwards
+    :param queue: multiprocessing.Queue read by log_listener(), None - file handler per logger
+    :return:
+    """
+    global LOG_QUEUE
+    LOG_QUEUE = queue
+
+
+def rotate_file(fn, backups):
+    """
+    Keeps the file as the first backup (fn.1), the previous backups are shifted, the oldest one is removed
+    Same naming as logging.handlers.RotatingFileHandler
+    :param fn: filename
+    :param backups: number of the kept backups, the file is removed if 0
+    :return:
+    """
+    if backups <= 0:
+        os.unlink(fn)
+        return
+
+    for i in range(backups - 1, 0, -1):
+        src = "{}.{}".format(fn, i)
+        if os.path.exists(src):
+            os.replace(src, "{}.{}".format(fn, i + 1))
+    os.replace(fn, "{}.1".format(fn))
+
+
+def get_file_handler(fn, conf=None):
+    """
+    Returns the rotating handler of the log file
+    :param fn: filename
+    :return: logging.Handler
+    """
+    c = conf
+    if c is None:
+        c = config.get_instance()
+
+    if c.getLoggingRotate() == "time":
+        res = logging.handlers.TimedRotatingFileHandler(fn, when=c.getLoggingRotateWhen(), backupCount=c.getLoggingRotateBackups())
+    else:
+        res = logging.handlers.RotatingFileHandler(fn, maxBytes=c.getLoggingRotateSize(), backupCount=c.getLoggingRotateBackups())
+
+    res.setFormatter(logging.Formatter(c.getLoggingFileFormat(), c.getLoggingFileDate()))
+    return res
+
+
+def log_listener(queue, storage=None):
+    """
+    Function serving as a process - writes the log records of all the processes into the rotating files of their loggers
+    :param queue: records marked by LogFileFilter, None stops the listener
+    :param storage: configuration of the Starter (app.config.main_config.Config.getStorage())
+    :return:
+    """
+    c = config.get_instance()
+    if storage is not None:
+        c.updateStorage(storage)
+
+    # the listener is stopped by the Starter after the other processes - the records of the stopping processes are kept
+    signal.signal(signal.SIGINT, signal.SIG_IGN)
+
+    default = os.path.join(c.getFolderLog(), "{}.log".format(c.getMainLogFile()))
+
+    handlers = {}
+    while True:
+        try:
+            record = queue.get()
+        except (EOFError, OSError):
+            break
+
+        if record is None:
+            break
+
+        fn = getattr(record, "logfile", default)
+        h = handlers.get(fn)
+        if h is None:
+            h = get_file_handler(fn, conf=c)
+            handlers[fn] = h
+        h.handle(record)
+
+    for h in handlers.values():
+        h.close()
+
+
+class LogFileFilter(logging.Filter):
+    """
+    Marks the records with the log file of their logger, the listener process writes them into this file
+    """
+    def __init__(self, filename):
+        logging.Filter.__init__(self)
+        self.filename = filename
+
+    def filter(self, record):
+        record.logfile = self.filename
+        return True
+
+
 # Logger class
 class Logger(object):
     DEFAULTLEVEL = logging.DEBUG
@@ -111,28 +215,37 @@ class Logger(object):
             self.debug("Using the DEBUG_LEVEL ({})".format(self.debug_level))
 
     def setDebugLevel(self, level):
+        self.debug_level = level
         self.logger.setLevel(level)
 
         for h in self.logger.handlers:
             h.setLevel(level)
 
-    def info(self, msg):
-        msg = self._check_msg(msg)
-        self._logger.info(msg)
+    def isDebug(self):
+        """
+        Tests if the debug messages are logged - expensive debug information is prepared only if True
+        :return:
+        """
+        return self._logger.isEnabledFor(logging.DEBUG)
+
+    # messages are formatted only if they pass the level - msg.format(*args), e.g. debug("File ({})", fn)
+    def info(self, msg, *args):
+        if self._logger.isEnabledFor(logging.INFO):
+            self._logger.info(self._check_msg(msg, args))
 
-    def debug(self, msg):
-        msg = self._check_msg(msg)
-        self._logger.debug(msg)
+    def debug(self, msg, *args):
+        if self._logger.isEnabledFor(logging.DEBUG):
+            self._logger.debug(self._check_msg(msg, args))
 
-    def error(self, msg):
-        msg = self._check_msg(msg)
-        self._logger.error(msg)
+    def error(self, msg, *args):
+        if self._logger.isEnabledFor(logging.ERROR):
+            self._logger.error(self._check_msg(msg, args))
 
-    def warning(self, msg):
-        msg = self._check_msg(msg)
-        self._logger.error(msg)
+    def warning(self, msg, *args):
+        if self._logger.isEnabledFor(logging.ERROR):
+            self._logger.error(self._check_msg(msg, args))
 
-    def _check_msg(self, msg):
+    def _check_msg(self, msg, args=()):
         if msg is not None:
             if isinstance(msg, str):
                 pass
@@ -140,6 +253,9 @@ class Logger(object):
                 msg = str(msg)
         else:
             msg = str(msg)
+
+        if len(args) > 0:
+            msg = msg.format(*args)
         return msg
 
     def confError(self, key, def_value, e=None):
@@ -161,6 +277,14 @@ class Logger(object):
 
         self.debug("Using default filename for logging ({})".format(filename))
 
+        if LOG_QUEUE is not None:
+            # the records are written by the listener process
+            fh = logging.handlers.QueueHandler(LOG_QUEUE)
+            fh.addFilter(LogFileFilter(filename))
+            fh.setLevel(self.debug_level)
+            self.logger.addHandler(fh)
+            return
+
         fh = logging.FileHandler(filename, "w+")
         fh.setLevel(self.debug_level)
 
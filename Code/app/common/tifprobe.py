@@ -0,0 +1,168 @@
+__author__ = 'Konstantin Glazyrin'
+
+import struct
+
+# first bytes of the classic and BigTIFF files
+TIFF_MAGIC = (b"II*\0", b"MM\0*", b"II+\0", b"MM\0+")
+
+# tags locating the image data - (offsets, byte counts)
+TAG_STRIPS = (273, 279)
+TAG_TILES = (324, 325)
+
+# sizes of the field types (bytes), unknown types are not supported
+FIELD_SIZES = {1: 1, 2: 1, 3: 2, 4: 4, 5: 8, 6: 1, 7: 1, 8: 2, 9: 4, 10: 8, 11: 4, 12: 8, 13: 4, 16: 8, 17: 8, 18: 8}
+
+# struct codes of the field types holding offsets and counts - SHORT, LONG, IFD, LONG8, IFD8
+FIELD_CODES = {3: "H", 4: "I", 13: "I", 16: "Q", 18: "Q"}
+
+# bytes read at once - the header and the first IFD of the usual files
+PROBE_READ = 4096
+
+# IFDs followed at most, a loop of IFDs ends the probe
+PROBE_MAX_PAGES = 65536
+
+
+class _Reader(object):
+    """
+    Reads the parts of the file, the first block is kept
+    """
+    def __init__(self, fh, size):
+        self.fh = fh
+        self.size = size
+        self.head = fh.read(PROBE_READ)
+
+    def read(self, offset, n):
+        """
+        Returns n bytes at the offset, None if the file ends before
+        :return:
+        """
+        if offset + n > self.size:
+            return None
+        if offset + n <= len(self.head):
+            return self.head[offset:offset + n]
+
+        self.fh.seek(offset)
+        res = self.fh.read(n)
+        return res if len(res) == n else None
+
+
+def _values(reader, order, ftype, count, field, inline):
+    """
+    Returns the integer values of an entry - kept in the entry or at the offset stored in it
+    :param field: bytes of the value field of the entry
+    :param inline: size of the value field (bytes)
+    :return: (tuple of values or None if the file ends before them, end of the out of line values)
+    """
+    code = FIELD_CODES.get(ftype)
+    nbytes = FIELD_SIZES[ftype] * count
+    fmt = "{}{}{}".format(order, count, code)
+
+    if nbytes <= inline:
+        return struct.unpack_from(fmt, field), 0
+
+    offset = struct.unpack_from(order + ("I" if inline == 4 else "Q"), field)[0]
+    buf = reader.read(offset, nbytes)
+    if buf is None:
+        return None, offset + nbytes
+    return struct.unpack(fmt, buf), offset + nbytes
+
+
+def get_tiff_end(fh, size):
+    """
+    Returns the size of the complete TIFF file - the end of the last IFD, tag value, strip or tile
+    Only the header and the IFDs are read, the file is complete once its size reaches the returned value
+    A multi-page file is complete up to its last written page - a writer appending pages may still set the next IFD
+    offset (0 until then), preallocated files are complete from the start (see PROC_FILE_TEST_PROBE_SETTLE)
+    :param fh: file opened for binary reading
+    :param size: current size of the file (bytes)
+    :return: expected size (bytes), larger than the size while the structures are incomplete,
+    None if the file is not a TIFF file or its structure is not supported
+    """
+    reader = _Reader(fh, size)
+
+    head = reader.head[:8]
+    if not any(magic.startswith(head[:4]) for magic in TIFF_MAGIC):
+        return None
+    if len(head) < 8:
+        return 8
+
+    order = "<" if head[:2] == b"II" else ">"
+    bigtiff = head[2:4] in (b"+\0", b"\0+")
+
+    # header, size of the IFD entry count, entry and offset
+    if bigtiff:
+        buf = reader.read(8, 8)
+        if buf is None:
+            return 16
+        nhead, ncount, nentry, inline, fcount, foffset = 16, 8, 20, 8, "Q", "Q"
+        ifd = struct.unpack(order + "Q", buf)[0]
+    else:
+        nhead, ncount, nentry, inline, fcount, foffset = 8, 2, 12, 4, "H", "I"
+        ifd = struct.unpack_from(order + "I", head, 4)[0]
+
+    # the first IFD is not written yet
+    if ifd == 0:
+        return size + 1
+
+    res = nhead
+    visited = set()
+    while ifd != 0:
+        if ifd in visited or len(visited) >= PROBE_MAX_PAGES:
+            return None
+        visited.add(ifd)
+
+        buf = reader.read(ifd, ncount)
+        if buf is None:
+            return ifd + ncount
+        count = struct.unpack(order + fcount, buf)[0]
+
+        nbytes = count * nentry + inline
+        buf = reader.read(ifd + ncount, nbytes)
+        if buf is None:
+            return ifd + ncount + nbytes
+        res = max(res, ifd + ncount + nbytes)
+
+        data = {}
+        for i in range(count):
+            tag, ftype, n = struct.unpack_from(order + "HH" + fcount.replace("H", "I"), buf, i * nentry)
+            field = buf[i * nentry + 4 + (8 if bigtiff else 4):(i + 1) * nentry]
+            if ftype not in FIELD_SIZES:
+                return None
+
+            if tag in TAG_STRIPS or tag in TAG_TILES:
+                if ftype not in FIELD_CODES:
+                    return None
+                values, end = _values(reader, order, ftype, n, field, inline)
+                if values is None:
+                    return end
+                data[tag] = values
+            else:
+                # values placed out of the entry
+                end = FIELD_SIZES[ftype] * n
+                if end > inline:
+                    end += struct.unpack_from(order + foffset, field)[0]
+            res = max(res, end)
+
+        tags = TAG_STRIPS if TAG_STRIPS[0] in data else TAG_TILES
+        offsets, counts = data.get(tags[0]), data.get(tags[1])
+        if offsets is None or counts is None or len(offsets) != len(counts):
+            return None
+        for (offset, n) in zip(offsets, counts):
+            res = max(res, offset + n)
+
+        ifd = struct.unpack_from(order + foffset, buf, count * nentry)[0]
+    return res
+
+
+def probe_tiff(fn, size):
+    """
+    Returns the expected size of the TIFF file, see get_tiff_end()
+    :param fn: filename
+    :param size: current size of the file (bytes)
+    :return: expected size (bytes) or None if the file cannot be probed
+    """
+    try:
+        with open(fn, "rb") as fh:
+            return get_tiff_end(fh, size)
+    except (OSError, struct.error):
+        return None
@@ -0,0 +1,534 @@
+__author__ = 'Konstantin Glazyrin'
+
+import os
+import sys
+import time
+import zlib
+import struct
+import threading
+from concurrent.futures import ThreadPoolExecutor
+
+import numpy as np
+
+# optional codecs of the compressed output
+try:
+    import imagecodecs
+except ImportError:
+    imagecodecs = None
+
+try:
+    import zstandard
+except ImportError:
+    zstandard = None
+
+# TIFF field types
+TIFF_ASCII = 2
+TIFF_SHORT = 3
+TIFF_LONG = 4
+
+# SampleFormat values by numpy kind
+SAMPLE_FORMATS = {"u": 1, "i": 2, "f": 3}
+
+SOFTWARE = b"PETifConverter\0"
+
+# classic TIFF offsets are 32 bit
+TIFF_MAX_SIZE = 2**32 - 1
+
+# data offset alignment
+DATA_ALIGNMENT = 16
+
+# buffers passed to a single vectored write, below the IOV_MAX of the systems
+WRITEV_MAX = 512
+
+# per process header templates - (shape, dtype) -> (bytearray, offset of the DateTime value)
+TIFF_TEMPLATES = {}
+
+# compression modes - value of the Compression tag
+COMPRESSION_NONE = "none"
+COMPRESSION_CODES = {COMPRESSION_NONE: 1, "lzw": 5, "deflate": 8, "zstd": 50000}
+
+# default levels of the codecs
+COMPRESSION_LEVELS = {"deflate": 3, "zstd": 3}
+
+# Predictor tag - horizontal differencing of the integer samples
+PREDICTOR_NONE = 1
+PREDICTOR_HORIZONTAL = 2
+
+# uncompressed size of a strip (bytes), strips are encoded in parallel
+STRIP_SIZE = 262144
+
+# per process thread pool encoding the strips, the codecs release the GIL
+STRIP_EXECUTOR = None
+STRIP_EXECUTOR_LOCK = threading.Lock()
+
+# zstandard compressors are not thread safe - a compressor per thread and level
+ZSTD_LOCAL = threading.local()
+
+
+class TiffWriterException(Exception):
+    """
+    Data cannot be written by the native writer - fabio should be used instead
+    """
+    pass
+
+
+def as_written(data):
+    """
+    Returns the data in the type of the file - 64 bit floats are written as 32 bit floats, the same as fabio writes them
+    :param data: numpy.ndarray
+    :return: numpy.ndarray
+    """
+    if data.dtype.kind == "f" and data.dtype.itemsize == 8:
+        return data.astype(np.float32)
+    return data
+
+
+def is_supported(data):
+    """
+    Tests if the native writer supports the data - 2D, contiguous, little endian, 8-32 bit integers or 32/64 bit floats,
+    64 bit floats are written as 32 bit floats (as_written())
+    :param data: numpy.ndarray
+    :return:
+    """
+    res = False
+    if isinstance(data, np.ndarray) and data.ndim == 2 and data.flags.c_contiguous and data.size > 0:
+        dt = data.dtype
+        if dt.kind in "ui" and dt.itemsize <= 4 or dt.kind == "f" and dt.itemsize in (4, 8):
+            res = (dt.byteorder == "<" or dt.byteorder in "=|" and sys.byteorder == "little")
+            res = res and 8 + data.nbytes + 512 < TIFF_MAX_SIZE
+    return res
+
+
+def _build_ifd(shape, dtype, offset, compression=1, predictor=PREDICTOR_NONE, rows_per_strip=None, counts=None):
+    """
+    Prepares the IFD of an image placed at the given offset, mirroring the tags written by fabio
+    The block contains the IFD, the tag values and the padding up to the image data, the strips follow one by one
+    :param compression: value of the Compression tag (COMPRESSION_CODES)
+    :param predictor: value of the Predictor tag, the tag is written if it is not PREDICTOR_NONE
+    :param rows_per_strip: rows of a strip, a single strip if None
+    :param counts: sizes of the (compressed) strips, a single uncompressed strip if None
+    :return: (bytearray, offset of the DateTime value, offset of the next IFD pointer) - offsets are relative to the block
+    """
+    rows, cols = shape
+    dtype = np.dtype(dtype)
+
+    if counts is None:
+        counts = [rows * cols * dtype.itemsize]
+    if rows_per_strip is None:
+        rows_per_strip = rows
+    nstrips = len(counts)
+
+    # tags, extra values are placed after the IFD - strip offsets and sizes if they do not fit into the entries
+    ntags = 12 + int(predictor != PREDICTOR_NONE)
+    ifd_size = 2 + 12 * ntags + 4
+    offset_software = offset + ifd_size
+    offset_datetime = offset_software + len(SOFTWARE)
+    offset_strips = offset_datetime + 20
+    offset_counts = offset_strips + (4 * nstrips if nstrips > 1 else 0)
+    offset_data = offset_counts + (4 * nstrips if nstrips > 1 else 0)
+    offset_data += (-offset_data) % DATA_ALIGNMENT
+
+    strips, position = [], offset_data
+    for count in counts:
+        strips.append(position)
+        position += count
+
+    entries = [
+        (256, TIFF_LONG, 1, cols),                          # ImageWidth
+        (257, TIFF_LONG, 1, rows),                          # ImageLength
+        (258, TIFF_SHORT, 1, dtype.itemsize * 8),           # BitsPerSample
+        (259, TIFF_SHORT, 1, compression),                  # Compression
+        (262, TIFF_SHORT, 1, 1),                            # PhotometricInterpretation - BlackIsZero
+        (270, TIFF_ASCII, 4, struct.unpack("<I", b"   \0")[0]),  # ImageDescription
+        (273, TIFF_LONG, nstrips, strips[0] if nstrips == 1 else offset_strips),    # StripOffsets
+        (278, TIFF_LONG, 1, rows_per_strip),                # RowsPerStrip
+        (279, TIFF_LONG, nstrips, counts[0] if nstrips == 1 else offset_counts),    # StripByteCounts
+        (305, TIFF_ASCII, len(SOFTWARE), offset_software),  # Software
+        (306, TIFF_ASCII, 20, offset_datetime),             # DateTime
+    ]
+    if predictor != PREDICTOR_NONE:
+        entries.append((317, TIFF_SHORT, 1, predictor))    # Predictor
+    entries.append((339, TIFF_SHORT, 1, SAMPLE_FORMATS[dtype.kind]))   # SampleFormat
+
+    res = bytearray(offset_data - offset)
+    struct.pack_into("<H", res, 0, ntags)
+    for (i, (tag, ftype, count, value)) in enumerate(entries):
+        if ftype == TIFF_SHORT:
+            struct.pack_into("<HHIHH", res, 2 + 12 * i, tag, ftype, count, value, 0)
+        else:
+            struct.pack_into("<HHII", res, 2 + 12 * i, tag, ftype, count, value)
+    struct.pack_into("<I", res, 2 + 12 * ntags, 0)
+    res[offset_software - offset:offset_datetime - offset] = SOFTWARE
+    if nstrips > 1:
+        struct.pack_into("<{}I".format(nstrips), res, offset_strips - offset, *strips)
+        struct.pack_into("<{}I".format(nstrips), res, offset_counts - offset, *counts)
+
+    return res, offset_datetime - offset, 2 + 12 * ntags
+
+
+def _build_template(shape, dtype):
+    """
+    Prepares the file header followed by the IFD of the image
+    :return: (bytearray, offset of the DateTime value)
+    """
+    ifd, offset_datetime, offset_next = _build_ifd(shape, dtype, 8)
+    return bytearray(struct.pack("<2sHI", b"II", 42, 8)) + ifd, 8 + offset_datetime
+
+
+def _datetime(tstamp=None):
+    return time.strftime("%Y:%m:%d %H:%M:%S", time.localtime(tstamp)).encode("ascii")
+
+
+def get_header(shape, dtype, tstamp=None):
+    """
+    Returns the header bytes for the image, the template is built once per (shape, dtype)
+    :return: bytearray
+    """
+    key = (tuple(shape), np.dtype(dtype))
+
+    template = TIFF_TEMPLATES.get(key)
+    if template is None:
+        template = _build_template(*key)
+        TIFF_TEMPLATES[key] = template
+
+    header, offset_datetime = template
+    header = bytearray(header)
+    header[offset_datetime:offset_datetime + 19] = _datetime(tstamp)
+    return header
+
+
+def _write_all(fd, buffers):
+    """
+    Writes the buffers with a vectored write if possible
+    :return:
+    """
+    buffers = [memoryview(b).cast("B") for b in buffers]
+
+    if hasattr(os, "writev"):
+        while len(buffers) > 0:
+            n = os.writev(fd, buffers[:WRITEV_MAX])
+            while len(buffers) > 0 and n >= len(buffers[0]):
+                n -= len(buffers[0])
+                buffers.pop(0)
+            if n > 0:
+                buffers[0] = buffers[0][n:]
+    else:
+        for b in buffers:
+            while len(b) > 0:
+                n = os.write(fd, b)
+                b = b[n:]
+
+
+def is_compression_supported(compression):
+    """
+    Tests if the compression mode is known and its codec is installed
+    lzw needs imagecodecs, zstd needs imagecodecs or zstandard, deflate uses zlib
+    :param compression: none, deflate, lzw, zstd
+    :return:
+    """
+    res = False
+    if compression == COMPRESSION_NONE or compression == "deflate":
+        res = True
+    elif compression == "lzw":
+        res = imagecodecs is not None
+    elif compression == "zstd":
+        res = imagecodecs is not None or zstandard is not None
+    return res
+
+
+def _get_executor(threads):
+    """
+    Returns the thread pool encoding the strips, created on the first use in the process
+    :param threads: number of the threads, the pool is recreated if it changes
+    :return: concurrent.futures.ThreadPoolExecutor
+    """
+    global STRIP_EXECUTOR
+
+    with STRIP_EXECUTOR_LOCK:
+        if STRIP_EXECUTOR is None or STRIP_EXECUTOR._max_workers != threads:
+            if STRIP_EXECUTOR is not None:
+                STRIP_EXECUTOR.shutdown(wait=False)
+            STRIP_EXECUTOR = ThreadPoolExecutor(max_workers=threads)
+    return STRIP_EXECUTOR
+
+
+def _zstd_encode(buf, level):
+    """
+    Encodes the buffer with zstd, zstandard compressors are kept per thread
+    :return: bytes
+    """
+    if imagecodecs is not None:
+        return imagecodecs.zstd_encode(buf, level=level)
+
+    compressors = getattr(ZSTD_LOCAL, "compressors", None)
+    if compressors is None:
+        compressors = ZSTD_LOCAL.compressors = {}
+
+    compressor = compressors.get(level)
+    if compressor is None:
+        compressor = compressors[level] = zstandard.ZstdCompressor(level=level)
+    return compressor.compress(buf)
+
+
+def _encode_strip(strip, compression, level, predictor):
+    """
+    Encodes the rows of a strip - the horizontal differences are taken first if the predictor is used
+    :param strip: numpy.ndarray, rows of the image
+    :return: bytes
+    """
+    if predictor == PREDICTOR_HORIZONTAL:
+        diff = np.empty_like(strip)
+        diff[:, 0] = strip[:, 0]
+        np.subtract(strip[:, 1:], strip[:, :-1], out=diff[:, 1:])
+        strip = diff
+
+    buf = memoryview(strip).cast("B")
+    if compression == "deflate":
+        res = zlib.compress(buf, level)
+    elif compression == "lzw":
+        res = imagecodecs.lzw_encode(buf)
+    else:
+        res = _zstd_encode(buf, level)
+    return res
+
+
+def encode_strips(data, compression, level=None, threads=1, strip_size=STRIP_SIZE):
+    """
+    Splits the image into strips and encodes them in parallel
+    The integer types use the horizontal predictor, the float types are encoded as they are
+    :param data: numpy.ndarray, see is_supported()
+    :param compression: deflate, lzw, zstd, see is_compression_supported()
+    :param level: level of the codec, the default level of the codec if None
+    :param threads: number of the encoding threads, the strips are encoded in the calling thread if 1
+    :param strip_size: uncompressed size of a strip (bytes)
+    :return: (rows per strip, predictor, list of the encoded strips)
+    """
+    if not is_compression_supported(compression) or compression == COMPRESSION_NONE:
+        raise TiffWriterException("Compression is not supported ({})".format(compression))
+
+    if level is None:
+        level = COMPRESSION_LEVELS.get(compression)
+
+    rows = data.shape[0]
+    rows_per_strip = min(max(int(strip_size // max(data.strides[0], 1)), 1), rows)
+    predictor = PREDICTOR_HORIZONTAL if data.dtype.kind in "ui" else PREDICTOR_NONE
+
+    strips = [data[i:i + rows_per_strip] for i in range(0, rows, rows_per_strip)]
+    if threads is None or threads <= 1 or len(strips) == 1:
+        res = [_encode_strip(strip, compression, level, predictor) for strip in strips]
+    else:
+        executor = _get_executor(int(threads))
+        res = list(executor.map(lambda strip: _encode_strip(strip, compression, level, predictor), strips))
+    return rows_per_strip, predictor, res
+
+
+def _build_compressed(data, offset, compression, level, threads, strip_size):
+    """
+    Encodes the image and prepares its IFD placed at the given offset
+    :return: (IFD block, offset of the next IFD pointer, list of the encoded strips)
+    """
+    rows_per_strip, predictor, strips = encode_strips(data, compression, level=level, threads=threads,
+                                                      strip_size=strip_size)
+
+    ifd, offset_datetime, offset_next = _build_ifd(data.shape, data.dtype, offset,
+                                                   compression=COMPRESSION_CODES[compression], predictor=predictor,
+                                                   rows_per_strip=rows_per_strip, counts=[len(b) for b in strips])
+    ifd[offset_datetime:offset_datetime + 19] = _datetime()
+    return ifd, offset_next, strips
+
+
+def encode_tiff(data, compression=COMPRESSION_NONE, level=None, threads=1, strip_size=STRIP_SIZE):
+    """
+    Returns the buffers of a TIFF file - the header and the image as a single strip, or the header and the encoded strips
+    :param data: numpy.ndarray, see is_supported()
+    :param compression: none, deflate, lzw, zstd
+    :param level: level of the codec, the default level of the codec if None
+    :param threads: number of the encoding threads
+    :param strip_size: uncompressed size of a strip (bytes)
+    :return: list of the buffers in the order of the file
+    """
+    if not is_supported(data):
+        raise TiffWriterException("Data is not supported by the native writer ({}, {})".format(data.shape, data.dtype))
+    data = as_written(data)
+
+    if compression != COMPRESSION_NONE:
+        ifd, offset_next, strips = _build_compressed(data, 8, compression, level, threads, strip_size)
+        return [struct.pack("<2sHI", b"II", 42, 8), ifd] + strips
+
+    return [get_header(data.shape, data.dtype), data]
+
+
+def write_buffers(fn, buffers):
+    """
+    Writes the buffers returned by encode_tiff() as a file
+    :param fn: filename
+    :return: number of the written bytes
+    """
+    fd = os.open(fn, os.O_WRONLY | os.O_CREAT | os.O_TRUNC | getattr(os, "O_BINARY", 0), 0o666)
+    try:
+        _write_all(fd, buffers)
+    finally:
+        os.close(fd)
+
+    return sum(memoryview(b).nbytes for b in buffers)
+
+
+def write_tiff(fn, data, compression=COMPRESSION_NONE, level=None, threads=1, strip_size=STRIP_SIZE):
+    """
+    Writes a TIFF image - uncompressed as a single strip, compressed as strips encoded in parallel
+    :param fn: filename
+    :param data: numpy.ndarray, see is_supported()
+    :param compression: none, deflate, lzw, zstd
+    :param level: level of the codec, the default level of the codec if None
+    :param threads: number of the encoding threads
+    :param strip_size: uncompressed size of a strip (bytes)
+    :return: number of the written bytes
+    """
+    return write_buffers(fn, encode_tiff(data, compression=compression, level=level, threads=threads,
+                                         strip_size=strip_size))
+
+
+def _decode_strip(buf, compression):
+    """
+    Decodes a strip of a file written by this module
+    :param buf: bytes of the strip
+    :param compression: value of the Compression tag
+    :return: bytes
+    """
+    if compression == COMPRESSION_CODES[COMPRESSION_NONE]:
+        return buf
+    elif compression == COMPRESSION_CODES["deflate"]:
+        return zlib.decompress(buf)
+    elif compression == COMPRESSION_CODES["lzw"] and imagecodecs is not None:
+        return imagecodecs.lzw_decode(buf)
+    elif compression == COMPRESSION_CODES["zstd"]:
+        if imagecodecs is not None:
+            return imagecodecs.zstd_decode(buf)
+        elif zstandard is not None:
+            return zstandard.ZstdDecompressor().decompress(buf)
+    raise TiffWriterException("Compression ({}) cannot be decoded".format(compression))
+
+
+def read_tiff(fn):
+    """
+    Reads the pages of a file written by this module (little endian classic TIFF, strips) - the round trip check of the writer,
+    the compressed files are not read by every reader (fabio falls back to PIL, which changes uint32 to int32 and reads
+    only the first page)
+    :param fn: filename
+    :return: list of numpy.ndarray
+    """
+    with open(fn, "rb") as fh:
+        buf = fh.read()
+
+    if buf[:4] != b"II*\0":
+        raise TiffWriterException("Not a little endian classic TIFF file ({})".format(fn))
+
+    res = []
+    ifd, visited = struct.unpack_from("<I", buf, 4)[0], set()
+    while ifd != 0 and ifd not in visited:
+        visited.add(ifd)
+
+        tags = {}
+        ntags = struct.unpack_from("<H", buf, ifd)[0]
+        for i in range(ntags):
+            entry = ifd + 2 + 12 * i
+            tag, ftype, count = struct.unpack_from("<HHI", buf, entry)
+            code = {TIFF_SHORT: "H", TIFF_LONG: "I"}.get(ftype)
+            if code is None:
+                continue
+
+            # values longer than 4 bytes are stored at the offset kept in the entry
+            offset = entry + 8
+            if struct.calcsize(code) * count > 4:
+                offset = struct.unpack_from("<I", buf, entry + 8)[0]
+            tags[tag] = struct.unpack_from("<{}{}".format(count, code), buf, offset)
+
+        rows, cols = tags[257][0], tags[256][0]
+        kind = dict((v, k) for (k, v) in SAMPLE_FORMATS.items())[tags.get(339, (1,))[0]]
+        dtype = np.dtype("<{}{}".format(kind, tags[258][0] // 8))
+
+        data = b"".join(_decode_strip(buf[offset:offset + count], tags.get(259, (1,))[0])
+                        for (offset, count) in zip(tags[273], tags[279]))
+        data = np.frombuffer(data, dtype=dtype).reshape(rows, cols)
+
+        # horizontal differences are summed up, the integer types wrap around as in the encoder
+        if tags.get(317, (PREDICTOR_NONE,))[0] == PREDICTOR_HORIZONTAL:
+            data = np.cumsum(data, axis=1, dtype=dtype)
+        res.append(data)
+
+        ifd = struct.unpack_from("<I", buf, ifd + 2 + 12 * ntags)[0]
+    return res
+
+
+class TiffStackWriter(object):
+    """
+    Writes the frames one by one as pages of a multi-page TIFF file, only the current frame is kept in memory
+    """
+    def __init__(self, fn, compression=COMPRESSION_NONE, level=None, threads=1, strip_size=STRIP_SIZE):
+        """
+        :param fn: filename
+        :param compression: none, deflate, lzw, zstd
+        :param level: level of the codec, the default level of the codec if None
+        :param threads: number of the encoding threads
+        :param strip_size: uncompressed size of a strip (bytes)
+        """
+        self.fn = fn
+        self.compression = compression
+        self.level = level
+        self.threads = threads
+        self.strip_size = strip_size
+        self.size = 8
+        self.pages = 0
+
+        # position of the pointer to be updated with the offset of the next IFD
+        self._next = 4
+
+        self._fd = os.open(fn, os.O_WRONLY | os.O_CREAT | os.O_TRUNC | getattr(os, "O_BINARY", 0), 0o666)
+        _write_all(self._fd, (struct.pack("<2sHI", b"II", 42, 0),))
+
+    def write(self, data):
+        """
+        Appends a frame
+        :param data: numpy.ndarray, see is_supported()
+        :return: number of the written bytes
+        """
+        if not is_supported(data):
+            raise TiffWriterException("Data is not supported by the native writer ({}, {})".format(data.shape, data.dtype))
+        data = as_written(data)
+
+        # IFD is word aligned
+        offset = self.size + self.size % 2
+        if self.compression != COMPRESSION_NONE:
+            ifd, offset_next, strips = _build_compressed(data, offset, self.compression, self.level, self.threads,
+                                                      self.strip_size)
+        else:
+            ifd, offset_datetime, offset_next = _build_ifd(data.shape, data.dtype, offset)
+            ifd[offset_datetime:offset_datetime + 19] = _datetime()
+            strips = [data]
+
+        nbytes = sum(memoryview(b).nbytes for b in strips)
+        if offset + len(ifd) + nbytes > TIFF_MAX_SIZE:
+            raise TiffWriterException("Multi-page file exceeds the TIFF size limit ({})".format(self.fn))
+
+        os.lseek(self._fd, self.size, os.SEEK_SET)
+        _write_all(self._fd, [b"\0" * (offset - self.size), ifd] + strips)
+
+        # link the previous IFD (or the header) to the new one
+        os.lseek(self._fd, self._next, os.SEEK_SET)
+        _write_all(self._fd, (struct.pack("<I", offset),))
+
+        self._next = offset + offset_next
+        self.size = offset + len(ifd) + nbytes
+        self.pages += 1
+        return len(ifd) + nbytes
+
+    def close(self):
+        if self._fd is not None:
+            os.close(self._fd)
+            self._fd = None
+
+    def __enter__(self):
+        return self
+
+    def __exit__(self, *args):
+        self.close()
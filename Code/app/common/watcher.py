@@ -0,0 +1,171 @@
+__author__ = 'Konstantin Glazyrin'
+
+import os
+import sys
+import errno
+import select
+import struct
+import ctypes
+import ctypes.util
+from collections import OrderedDict
+
+# inotify flags (linux/inotify.h)
+IN_CLOSE_WRITE = 0x00000008
+IN_MOVED_TO = 0x00000080
+IN_Q_OVERFLOW = 0x00004000
+IN_IGNORED = 0x00008000
+IN_NONBLOCK = 0o4000
+IN_CLOEXEC = 0o2000000
+
+# struct inotify_event - wd, mask, cookie, len + name
+EVENT_STRUCT = struct.Struct("iIII")
+
+
+class InotifyWatcher(object):
+    """
+    Minimal ctypes wrapper around the Linux inotify API
+    Reports files which were closed after writing or moved into the watched directories
+    At most max_dirs directories are watched, the watch of the least recently used directory is removed for a new one
+    """
+    MASK = IN_CLOSE_WRITE | IN_MOVED_TO
+
+    def __init__(self, logger=None, max_dirs=1024):
+        self.t = logger
+        self.max_dirs = max(int(max_dirs), 1)
+
+        self._libc = ctypes.CDLL(ctypes.util.find_library("c"), use_errno=True)
+        self._fd = self._libc.inotify_init1(IN_NONBLOCK | IN_CLOEXEC)
+        if self._fd < 0:
+            e = ctypes.get_errno()
+            raise OSError(e, os.strerror(e))
+
+        # watch descriptor -> directory, directory -> watch descriptor ordered from the least recently used
+        self._wds = {}
+        self._dirs = OrderedDict()
+
+    @staticmethod
+    def isSupported():
+        """
+        Tests if inotify can be used on the current platform
+        :return:
+        """
+        res = False
+        if sys.platform.startswith("linux"):
+            name = ctypes.util.find_library("c")
+            if name is not None:
+                res = hasattr(ctypes.CDLL(name), "inotify_init1")
+        return res
+
+    def watch(self, path):
+        """
+        Adds a directory to the watch list, returns False if the directory cannot be watched
+        The least recently used directories are released above max_dirs or when the limit of the system is reached
+        (fs.inotify.max_user_watches)
+        :param path: directory
+        :return:
+        """
+        path = os.path.abspath(path)
+        if path in self._dirs:
+            self._dirs.move_to_end(path)
+            return True
+
+        while len(self._dirs) >= self.max_dirs:
+            self.unwatch(next(iter(self._dirs)))
+
+        wd = self._libc.inotify_add_watch(self._fd, os.fsencode(path), self.MASK)
+        while wd < 0 and ctypes.get_errno() == errno.ENOSPC and len(self._dirs) > 0:
+            self.unwatch(next(iter(self._dirs)))
+            wd = self._libc.inotify_add_watch(self._fd, os.fsencode(path), self.MASK)
+
+        if wd < 0:
+            e = ctypes.get_errno()
+            if self.t is not None:
+                self.t.debug("Cannot watch directory ({}:{})".format(path, os.strerror(e)))
+            return False
+
+        if self.t is not None:
+            self.t.debug("Watching directory ({})".format(path))
+
+        self._wds[wd] = path
+        self._dirs[path] = wd
+        return True
+
+    def unwatch(self, path):
+        """
+        Removes the directory from the watch list
+        :param path: directory
+        :return:
+        """
+        wd = self._dirs.pop(os.path.abspath(path), None)
+        if wd is None:
+            return
+
+        self._wds.pop(wd, None)
+        if self._fd >= 0:
+            self._libc.inotify_rm_watch(self._fd, wd)
+
+        if self.t is not None:
+            self.t.debug("Directory is not watched anymore ({})".format(path))
+
+    def isWatched(self, path):
+        """
+        Tests if the directory is watched
+        :param path: directory
+        :return:
+        """
+        return os.path.abspath(path) in self._dirs
+
+    def read(self, timeout=None):
+        """
+        Waits for the events up to timeout (s), returns a list of absolute paths of the closed/moved files
+        :param timeout:
+        :return:
+        """
+        res = []
+
+        if self._fd < 0:
+            return res
+
+        rlist, _, _ = select.select([self._fd], [], [], timeout)
+        if not rlist:
+            return res
+
+        try:
+            buf = os.read(self._fd, 64 * 1024)
+        except OSError as e:
+            if e.errno in (errno.EAGAIN, errno.EINTR):
+                return res
+            raise
+
+        pos = 0
+        while pos + EVENT_STRUCT.size <= len(buf):
+            wd, mask, cookie, length = EVENT_STRUCT.unpack_from(buf, pos)
+            pos += EVENT_STRUCT.size
+            name = buf[pos:pos + length].rstrip(b"\0")
+            pos += length
+
+            if mask & IN_Q_OVERFLOW and self.t is not None:
+                self.t.error("Inotify queue overflow, some events were lost")
+
+            if mask & IN_IGNORED:
+                # directory was removed or unmounted
+                path = self._wds.pop(wd, None)
+                if path is not None:
+                    self._dirs.pop(path, None)
+                continue
+
+            if mask & self.MASK and wd in self._wds and len(name) > 0:
+                res.append(os.path.join(self._wds[wd], os.fsdecode(name)))
+
+        return res
+
+    def close(self):
+        """
+        Releases the inotify file descriptor
+        :return:
+        """
+        if self._fd >= 0:
+            os.close(self._fd)
+            self._fd = -1
+        self._wds.clear()
+        self._dirs.clear()
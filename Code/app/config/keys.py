@@ -4,15 +4,71 @@ FOLDER_LOG = "FOLDER_LOG"
 
 # process related
 PROC_MAX_NUM = "PROC_MAX_NUM"
+PROC_AUTOSCALE = "PROC_AUTOSCALE"
+PROC_AUTOSCALE_MIN = "PROC_AUTOSCALE_MIN"
+PROC_AUTOSCALE_MAX = "PROC_AUTOSCALE_MAX"
+PROC_AUTOSCALE_BACKLOG = "PROC_AUTOSCALE_BACKLOG"
+PROC_AUTOSCALE_LATENCY = "PROC_AUTOSCALE_LATENCY"
+PROC_AUTOSCALE_IDLE = "PROC_AUTOSCALE_IDLE"
+PROC_AUTOSCALE_INTERVAL = "PROC_AUTOSCALE_INTERVAL"
 PROC_SLEEP_DELAY = "PROC_SLEEP_DELAY"
 PROC_THREAD_SLEEP_DELAY = "PROC_THREAD_SLEEP_DELAY"
 PROC_FILE_TIMEOUT = "PROC_FILE_TIMEOUT"
+PROC_DISPATCH_MAX_BATCH = "PROC_DISPATCH_MAX_BATCH"
+PROC_PRIORITY_DEFAULT = "PROC_PRIORITY_DEFAULT"
+PROC_PRIORITY_PREFIXES = "PROC_PRIORITY_PREFIXES"
+PROC_PRIORITY_LOW_SHARE = "PROC_PRIORITY_LOW_SHARE"
+PROC_PRIORITY_LOW_BATCH = "PROC_PRIORITY_LOW_BATCH"
+PROC_PRIORITY_QUEUE_DEPTH = "PROC_PRIORITY_QUEUE_DEPTH"
+PROC_PREFETCH_DEPTH = "PROC_PREFETCH_DEPTH"
+PROC_PIPELINE_MODE = "PROC_PIPELINE_MODE"
+PROC_PIPELINE_READERS = "PROC_PIPELINE_READERS"
+PROC_PIPELINE_WRITERS = "PROC_PIPELINE_WRITERS"
+PROC_PIPELINE_SLOTS = "PROC_PIPELINE_SLOTS"
+PROC_PIPELINE_SLOT_SIZE = "PROC_PIPELINE_SLOT_SIZE"
 PROC_FILE_ROTATE = "PROC_FILE_ROTATE"
 PROC_FILE_FLIP = "PROC_FILE_FLIP"
 PROC_FILE_CONVERSION_TYPE = "PROC_FILE_CONVERSION_TYPE"
+PROC_FILE_COMPRESSION = "PROC_FILE_COMPRESSION"
+PROC_FILE_COMPRESSION_LEVEL = "PROC_FILE_COMPRESSION_LEVEL"
+PROC_FILE_COMPRESSION_THREADS = "PROC_FILE_COMPRESSION_THREADS"
+PROC_FILE_COMPRESSION_STRIP = "PROC_FILE_COMPRESSION_STRIP"
+PROC_FILE_WRITER = "PROC_FILE_WRITER"
+PROC_FILE_MULTIFRAME = "PROC_FILE_MULTIFRAME"
+PROC_FILE_SKIP_SHAPE = "PROC_FILE_SKIP_SHAPE"
+PROC_FILE_SKIP_LEARN = "PROC_FILE_SKIP_LEARN"
+PROC_FILE_SKIP_CLONE = "PROC_FILE_SKIP_CLONE"
+PROC_FILE_SKIP_CACHE = "PROC_FILE_SKIP_CACHE"
 PROC_FILE_TEST_MOD_TIME = "PROC_FILE_TEST_EXISTS"
 PROC_FILE_TEST_SIZE = "PROC_FILE_TEST_SIZE"
+PROC_FILE_TEST_PROBE = "PROC_FILE_TEST_PROBE"
+PROC_FILE_TEST_PROBE_SETTLE = "PROC_FILE_TEST_PROBE_SETTLE"
 PROC_PATH_REPLACE = "PROC_PATH_REPLACE"
+PROC_PATH_RULES = "PROC_PATH_RULES"
+PROC_PATH_DIR_CACHE = "PROC_PATH_DIR_CACHE"
+PROC_SCAN_RECURSIVE = "PROC_SCAN_RECURSIVE"
+PROC_SCAN_CHUNK = "PROC_SCAN_CHUNK"
+PROC_WATCH_MODE = "PROC_WATCH_MODE"
+PROC_WATCH_FALLBACK_DELAY = "PROC_WATCH_FALLBACK_DELAY"
+PROC_WATCH_MAX_DIRS = "PROC_WATCH_MAX_DIRS"
+PROC_LEDGER = "PROC_LEDGER"
+PROC_LEDGER_FILE = "PROC_LEDGER_FILE"
+PROC_LEDGER_FORCE = "PROC_LEDGER_FORCE"
+PROC_LEDGER_CHECK_OUTPUT = "PROC_LEDGER_CHECK_OUTPUT"
+PROC_JOURNAL = "PROC_JOURNAL"
+PROC_JOURNAL_FILE = "PROC_JOURNAL_FILE"
+PROC_JOURNAL_SYNC_INTERVAL = "PROC_JOURNAL_SYNC_INTERVAL"
+PROC_JOURNAL_COMPACT = "PROC_JOURNAL_COMPACT"
+PROC_STATS_SLOTS = "PROC_STATS_SLOTS"
+PROC_START_METHOD = "PROC_START_METHOD"
+PROC_START_PRELOAD = "PROC_START_PRELOAD"
+PROC_STAGING = "PROC_STAGING"
+PROC_STAGING_FOLDER = "PROC_STAGING_FOLDER"
+PROC_STAGING_UPLOADERS = "PROC_STAGING_UPLOADERS"
+PROC_STAGING_MAX_FILES = "PROC_STAGING_MAX_FILES"
+PROC_STAGING_MAX_BYTES = "PROC_STAGING_MAX_BYTES"
+PROC_STAGING_RETRIES = "PROC_STAGING_RETRIES"
+PROC_STAGING_BACKOFF = "PROC_STAGING_BACKOFF"
 
 
 # logging
@@ -20,4 +76,9 @@ LOGGING_MAIN_FILE = "LOGGING_MAIN_FILE"
 LOGGING_MAIN_FORMAT = "LOGGING_MAIN_FORMAT"
 LOGGING_MAIN_DATE = "LOGGING_MAIN_DATE"
 LOGGING_FILE_FORMAT = "LOGGING_FILE_FORMAT"
-LOGGING_FILE_DATE = "LOGGING_FILE_DATE"
\ No newline at end of file
+LOGGING_FILE_DATE = "LOGGING_FILE_DATE"
+LOGGING_QUEUE = "LOGGING_QUEUE"
+LOGGING_ROTATE = "LOGGING_ROTATE"
+LOGGING_ROTATE_SIZE = "LOGGING_ROTATE_SIZE"
+LOGGING_ROTATE_WHEN = "LOGGING_ROTATE_WHEN"
+LOGGING_ROTATE_BACKUPS = "LOGGING_ROTATE_BACKUPS"
\ No newline at end of file
@@ -13,15 +13,71 @@ CONFIG_STORAGE = {
 
     # process related
     PROC_MAX_NUM : 5,                       # maximum number of processes
+    PROC_AUTOSCALE: False,                  # autoscaling - number of workers follows the backlog of the file queue
+    PROC_AUTOSCALE_MIN: 1,                  # autoscaling - minimal number of workers
+    PROC_AUTOSCALE_MAX: 8,                  # autoscaling - maximal number of workers
+    PROC_AUTOSCALE_BACKLOG: 4,              # autoscaling - a worker is added if the queue holds more messages per worker
+    PROC_AUTOSCALE_LATENCY: 2.,             # autoscaling - a worker is added if the p95 wait for a worker (lanes + queue) of the last period is longer (s), None - backlog only
+    PROC_AUTOSCALE_IDLE: 60.,               # autoscaling - a worker is retired after this idle period (s)
+    PROC_AUTOSCALE_INTERVAL: 2.,            # autoscaling - period of the tests (s)
     PROC_SLEEP_DELAY: 1.,                   # delay to sleep between process tact
     PROC_THREAD_SLEEP_DELAY: 0.5,                   # delay to sleep between file sorting thread tacts
     PROC_FILE_TEST_MOD_TIME: 3.,            # test - file is considered to be existing if its modified flag is older than 3s
     PROC_FILE_TEST_SIZE: 16000000,          # test - file is considerd to be existing if its size is greater than .. 16777000
+    PROC_FILE_TEST_PROBE: True,             # test - TIFF file is ready once its size reaches the end of its IFDs and strips, the size and time tests are used for other files
+    PROC_FILE_TEST_PROBE_SETTLE: False,     # test - a probed TIFF file should not be modified for PROC_FILE_TEST_MOD_TIME as well, for the writers appending pages
     PROC_FILE_TIMEOUT: 30.,                 # timeout after which we consider the file as non existing
+    PROC_DISPATCH_MAX_BATCH: 64,            # maximum number of files passed to a worker as one queue message
+    PROC_PRIORITY_DEFAULT: "high",          # priority lane of the added files - "high" (live frames) or "low" (backlog)
+    PROC_PRIORITY_PREFIXES: None,           # default lanes per path prefix ((prefix, lane), ...), the longest matching prefix is used
+    PROC_PRIORITY_LOW_SHARE: 0.1,           # share of the dispatched files reserved for the low lane while the high lane has files
+    PROC_PRIORITY_LOW_BATCH: 4,             # maximum number of files of the low lane passed to a worker as one queue message
+    PROC_PRIORITY_QUEUE_DEPTH: 2,           # messages per worker kept in the queue of the workers, the other ready files wait in the lanes
+    PROC_PREFETCH_DEPTH: 0,                 # number of files opened in advance by the threads of a worker, 0 - sequential processing
+    PROC_PIPELINE_MODE: False,              # staged pipeline - reader processes decode frames into shared memory, writer processes convert them
+    PROC_PIPELINE_READERS: 2,               # staged pipeline - number of reader processes
+    PROC_PIPELINE_WRITERS: 3,               # staged pipeline - number of writer processes
+    PROC_PIPELINE_SLOTS: 8,                 # staged pipeline - number of frame slots in shared memory
+    PROC_PIPELINE_SLOT_SIZE: 67108864,      # staged pipeline - size of a slot (bytes), larger frames are converted by the readers
     PROC_FILE_ROTATE: 0.,                  # angle of image rotation - should be multiple of 90, otherwise, won't be used
     PROC_FILE_FLIP: None,                      # axis direction of numpy.ndarray.flip - None - no operation, flip is applied after the rotation
     PROC_FILE_CONVERSION_TYPE: np.uint32,    # conversion type  - numpy format
+    PROC_FILE_COMPRESSION: "none",          # compression of the output - "none", "deflate", "lzw" (imagecodecs) or "zstd" (imagecodecs or zstandard)
+    PROC_FILE_COMPRESSION_LEVEL: None,      # level of the codec, None - default of the codec (deflate 3, zstd 3)
+    PROC_FILE_COMPRESSION_THREADS: 4,       # threads encoding the strips of a frame in a worker/writer process
+    PROC_FILE_COMPRESSION_STRIP: 262144,    # uncompressed size of a strip (bytes)
+    PROC_FILE_WRITER: "native",             # TIFF writer - "native" (cached headers, fabio for unsupported data) or "fabio"
+    PROC_FILE_MULTIFRAME: "split",          # multi-frame input - "split" (file per frame, <name>_<frame>.tif) or "stack" (multi-page file)
+    PROC_FILE_SKIP_SHAPE: (2048, 2048),     # placeholders - (rows, columns) used until a frame of the directory is converted
+    PROC_FILE_SKIP_LEARN: True,             # placeholders - the shape of the last converted frame of the directory is used
+    PROC_FILE_SKIP_CLONE: True,             # placeholders - cloned (reflink) from an encoded copy where the file system allows, written otherwise
+    PROC_FILE_SKIP_CACHE: 4,                # placeholders - number of the encoded (shape, type, compression) kept in memory
     PROC_PATH_REPLACE: ("raw", "processed"),                  # path replacement info, do not overwrite files - create new (needle, replacement)
+    PROC_PATH_RULES: None,                  # ordered rules (kind, source, destination) - "prefix", "regex", "segment" or "replace", the first match is used; None - PROC_PATH_REPLACE as a replace rule
+    PROC_PATH_DIR_CACHE: 4096,              # destination directories known to exist per process, created once
+    PROC_SCAN_RECURSIVE: False,             # added directories are scanned including their subdirectories
+    PROC_SCAN_CHUNK: 256,                   # files found in a directory are passed for processing in chunks of this size
+    PROC_WATCH_MODE: False,                 # use inotify events (Linux) to detect closed files, stat polling is used otherwise
+    PROC_WATCH_FALLBACK_DELAY: 10.,         # watch mode - files without close/move events are passed to stat polling after this delay (s)
+    PROC_WATCH_MAX_DIRS: 1024,              # watch mode - watched directories, the watch of the least recently used one is removed above it
+    PROC_LEDGER: False,                     # record the converted files, up to date files (same source and settings) are not converted again
+    PROC_LEDGER_FILE: "ledger.sqlite",      # ledger database placed in the log folder
+    PROC_LEDGER_FORCE: False,               # convert all added files regardless of the ledger records
+    PROC_LEDGER_CHECK_OUTPUT: False,        # ledger - an up to date file should have its output, a metadata call per recorded file
+    PROC_JOURNAL: False,                    # journal of the pending files, unfinished files are converted after a restart
+    PROC_JOURNAL_FILE: "pending.journal",   # journal placed in the log folder
+    PROC_JOURNAL_SYNC_INTERVAL: 1.,         # journal records are written to disk (fsync) with this interval (s)
+    PROC_JOURNAL_COMPACT: 100000,           # journal is rewritten with the pending files once it has more records
+    PROC_STATS_SLOTS: 64,                   # slots of the shared statistics - one per process, slot 0 is used by the server
+    PROC_START_METHOD: None,                # start method of the workers - None (platform default), "fork", "spawn" or "forkserver"
+    PROC_START_PRELOAD: ("numpy", "fabio", "app.worker", "app.pipeline", "app.uploader"),  # forkserver - modules imported once, the workers are forked from this warm state
+    PROC_STAGING: False,                    # write-behind - files are written into a local staging folder and moved to their destination by uploader processes
+    PROC_STAGING_FOLDER: None,              # write-behind - local staging folder, None - "staging" in the startup folder
+    PROC_STAGING_UPLOADERS: 2,              # write-behind - number of uploader processes
+    PROC_STAGING_MAX_FILES: 256,            # write-behind - files waiting for the upload, the writing processes wait above it
+    PROC_STAGING_MAX_BYTES: 4294967296,     # write-behind - bytes waiting for the upload, the writing processes wait above it
+    PROC_STAGING_RETRIES: 5,                # write-behind - retries of a failed upload, the file is requeued afterwards
+    PROC_STAGING_BACKOFF: 0.5,              # write-behind - delay before the first retry (s), doubled with every retry
 
 
     # logging
@@ -31,6 +87,11 @@ CONFIG_STORAGE = {
 
     LOGGING_FILE_FORMAT: '%(asctime)s %(levelname)-8s %(process)-8d %(thread)-10d %(threadName)-16s %(name)-12s: %(message)s',
     LOGGING_FILE_DATE: '%Y-%m-%d %H:%M:%S',
+    LOGGING_QUEUE: True,                    # records of all the processes are written by a single listener process, False - a file handler per process
+    LOGGING_ROTATE: "size",                 # rotation of the log files - "size" or "time"
+    LOGGING_ROTATE_SIZE: 16777216,          # size rotation - maximal size of a log file (bytes)
+    LOGGING_ROTATE_WHEN: "midnight",        # time rotation - interval of logging.handlers.TimedRotatingFileHandler
+    LOGGING_ROTATE_BACKUPS: 5,              # number of the kept previous log files, the logs of the previous run are rotated at the startup
 }
 
 CONFIG_INSTANCE = None
@@ -57,6 +118,23 @@ class Config(object):
         # print("Retrieving configuration value ({}:{})".format(key, CONFIG_STORAGE[key]))
         return CONFIG_STORAGE[key]
 
+    def getStorage(self):
+        """
+        Returns a copy of the configuration - passed to the processes which do not inherit the modified values (spawn, forkserver)
+        :return: dict
+        """
+        global CONFIG_STORAGE
+        return dict(CONFIG_STORAGE)
+
+    def updateStorage(self, storage):
+        """
+        Sets the configuration values of a copy made by getStorage()
+        :param storage: dict
+        :return:
+        """
+        global CONFIG_STORAGE
+        CONFIG_STORAGE.update(storage)
+
     def setFolderStartup(self, v):
         self.setConfiguration(FOLDER_STARTUP, v)
 
@@ -103,9 +181,45 @@ class Config(object):
     def getLoggingFileDate(self):
         return self.getConfiguration(LOGGING_FILE_DATE)
 
+    def getLoggingQueue(self):
+        return self.getConfiguration(LOGGING_QUEUE)
+
+    def getLoggingRotate(self):
+        return self.getConfiguration(LOGGING_ROTATE)
+
+    def getLoggingRotateSize(self):
+        return self.getConfiguration(LOGGING_ROTATE_SIZE)
+
+    def getLoggingRotateWhen(self):
+        return self.getConfiguration(LOGGING_ROTATE_WHEN)
+
+    def getLoggingRotateBackups(self):
+        return self.getConfiguration(LOGGING_ROTATE_BACKUPS)
+
     def getProcMaxNumber(self):
         return self.getConfiguration(PROC_MAX_NUM)
 
+    def getProcAutoscale(self):
+        return self.getConfiguration(PROC_AUTOSCALE)
+
+    def getProcAutoscaleMin(self):
+        return self.getConfiguration(PROC_AUTOSCALE_MIN)
+
+    def getProcAutoscaleMax(self):
+        return self.getConfiguration(PROC_AUTOSCALE_MAX)
+
+    def getProcAutoscaleBacklog(self):
+        return self.getConfiguration(PROC_AUTOSCALE_BACKLOG)
+
+    def getProcAutoscaleLatency(self):
+        return self.getConfiguration(PROC_AUTOSCALE_LATENCY)
+
+    def getProcAutoscaleIdle(self):
+        return self.getConfiguration(PROC_AUTOSCALE_IDLE)
+
+    def getProcAutoscaleInterval(self):
+        return self.getConfiguration(PROC_AUTOSCALE_INTERVAL)
+
     def getProcSleepDelay(self):
         return self.getConfiguration(PROC_SLEEP_DELAY)
 
@@ -115,6 +229,42 @@ class Config(object):
     def getProcFileTimeout(self):
         return self.getConfiguration(PROC_FILE_TIMEOUT)
 
+    def getProcDispatchMaxBatch(self):
+        return self.getConfiguration(PROC_DISPATCH_MAX_BATCH)
+
+    def getProcPriorityDefault(self):
+        return self.getConfiguration(PROC_PRIORITY_DEFAULT)
+
+    def getProcPriorityPrefixes(self):
+        return self.getConfiguration(PROC_PRIORITY_PREFIXES)
+
+    def getProcPriorityLowShare(self):
+        return self.getConfiguration(PROC_PRIORITY_LOW_SHARE)
+
+    def getProcPriorityLowBatch(self):
+        return self.getConfiguration(PROC_PRIORITY_LOW_BATCH)
+
+    def getProcPriorityQueueDepth(self):
+        return self.getConfiguration(PROC_PRIORITY_QUEUE_DEPTH)
+
+    def getProcPrefetchDepth(self):
+        return self.getConfiguration(PROC_PREFETCH_DEPTH)
+
+    def getProcPipelineMode(self):
+        return self.getConfiguration(PROC_PIPELINE_MODE)
+
+    def getProcPipelineReaders(self):
+        return self.getConfiguration(PROC_PIPELINE_READERS)
+
+    def getProcPipelineWriters(self):
+        return self.getConfiguration(PROC_PIPELINE_WRITERS)
+
+    def getProcPipelineSlots(self):
+        return self.getConfiguration(PROC_PIPELINE_SLOTS)
+
+    def getProcPipelineSlotSize(self):
+        return self.getConfiguration(PROC_PIPELINE_SLOT_SIZE)
+
     def getProcFileRotation(self):
         return self.getConfiguration(PROC_FILE_ROTATE)
 
@@ -124,15 +274,132 @@ class Config(object):
     def getProcFileConvType(self):
         return self.getConfiguration(PROC_FILE_CONVERSION_TYPE)
 
+    def getProcFileCompression(self):
+        return self.getConfiguration(PROC_FILE_COMPRESSION)
+
+    def getProcFileCompressionLevel(self):
+        return self.getConfiguration(PROC_FILE_COMPRESSION_LEVEL)
+
+    def getProcFileCompressionThreads(self):
+        return self.getConfiguration(PROC_FILE_COMPRESSION_THREADS)
+
+    def getProcFileCompressionStrip(self):
+        return self.getConfiguration(PROC_FILE_COMPRESSION_STRIP)
+
+    def getProcFileWriter(self):
+        return self.getConfiguration(PROC_FILE_WRITER)
+
+    def getProcFileMultiframe(self):
+        return self.getConfiguration(PROC_FILE_MULTIFRAME)
+
+    def getProcFileSkipShape(self):
+        return self.getConfiguration(PROC_FILE_SKIP_SHAPE)
+
+    def getProcFileSkipLearn(self):
+        return self.getConfiguration(PROC_FILE_SKIP_LEARN)
+
+    def getProcFileSkipClone(self):
+        return self.getConfiguration(PROC_FILE_SKIP_CLONE)
+
+    def getProcFileSkipCache(self):
+        return self.getConfiguration(PROC_FILE_SKIP_CACHE)
+
     def getProcFileTestSize(self):
         return self.getConfiguration(PROC_FILE_TEST_SIZE)
 
     def getProcFileTestModTime(self):
         return self.getConfiguration(PROC_FILE_TEST_MOD_TIME)
 
+    def getProcFileTestProbe(self):
+        return self.getConfiguration(PROC_FILE_TEST_PROBE)
+
+    def getProcFileTestProbeSettle(self):
+        return self.getConfiguration(PROC_FILE_TEST_PROBE_SETTLE)
+
     def getProcPathReplacement(self):
         return self.getConfiguration(PROC_PATH_REPLACE)
 
+    def getProcPathRules(self):
+        return self.getConfiguration(PROC_PATH_RULES)
+
+    def getProcPathDirCache(self):
+        return self.getConfiguration(PROC_PATH_DIR_CACHE)
+
+    def getProcScanRecursive(self):
+        return self.getConfiguration(PROC_SCAN_RECURSIVE)
+
+    def getProcScanChunk(self):
+        return self.getConfiguration(PROC_SCAN_CHUNK)
+
+    def getProcWatchMode(self):
+        return self.getConfiguration(PROC_WATCH_MODE)
+
+    def getProcWatchFallbackDelay(self):
+        return self.getConfiguration(PROC_WATCH_FALLBACK_DELAY)
+
+    def getProcWatchMaxDirs(self):
+        return self.getConfiguration(PROC_WATCH_MAX_DIRS)
+
+    def getProcLedger(self):
+        return self.getConfiguration(PROC_LEDGER)
+
+    def getProcLedgerFile(self):
+        return self.getConfiguration(PROC_LEDGER_FILE)
+
+    def getProcLedgerForce(self):
+        return self.getConfiguration(PROC_LEDGER_FORCE)
+
+    def getProcLedgerCheckOutput(self):
+        return self.getConfiguration(PROC_LEDGER_CHECK_OUTPUT)
+
+    def setProcLedgerForce(self, v):
+        self.setConfiguration(PROC_LEDGER_FORCE, v)
+
+    def getProcJournal(self):
+        return self.getConfiguration(PROC_JOURNAL)
+
+    def getProcJournalFile(self):
+        return self.getConfiguration(PROC_JOURNAL_FILE)
+
+    def getProcJournalSyncInterval(self):
+        return self.getConfiguration(PROC_JOURNAL_SYNC_INTERVAL)
+
+    def getProcJournalCompact(self):
+        return self.getConfiguration(PROC_JOURNAL_COMPACT)
+
+    def getProcStatsSlots(self):
+        return self.getConfiguration(PROC_STATS_SLOTS)
+
+    def getProcStartMethod(self):
+        return self.getConfiguration(PROC_START_METHOD)
+
+    def getProcStartPreload(self):
+        return self.getConfiguration(PROC_START_PRELOAD)
+
+    def getProcStaging(self):
+        return self.getConfiguration(PROC_STAGING)
+
+    def getProcStagingFolder(self):
+        res = self.getConfiguration(PROC_STAGING_FOLDER)
+        if res is None and self.getConfiguration(FOLDER_STARTUP) is not None:
+            res = os.path.join(self.getConfiguration(FOLDER_STARTUP), "staging")
+        return res
+
+    def getProcStagingUploaders(self):
+        return self.getConfiguration(PROC_STAGING_UPLOADERS)
+
+    def getProcStagingMaxFiles(self):
+        return self.getConfiguration(PROC_STAGING_MAX_FILES)
+
+    def getProcStagingMaxBytes(self):
+        return self.getConfiguration(PROC_STAGING_MAX_BYTES)
+
+    def getProcStagingRetries(self):
+        return self.getConfiguration(PROC_STAGING_RETRIES)
+
+    def getProcStagingBackoff(self):
+        return self.getConfiguration(PROC_STAGING_BACKOFF)
+
     def printHeaderMsg(self, msg):
         """
         Prints message aas a header
@@ -0,0 +1,384 @@
+import time
+import multiprocessing
+from collections import deque
+from multiprocessing import Queue, current_process
+from queue import Empty
+
+import numpy as np
+import fabio
+
+import app.config.main_config as config
+from app.common.tester import Tester, set_log_queue
+from app.common.conversion import OrientationPlan
+from app.worker import convert_file, get_output_path, get_frame_path, get_nframes, iter_frames, \
+    get_next_file, test_stop, write_frame, report_stats, report_done, open_file, check_compression, \
+    start_staging
+
+try:
+    from multiprocessing import shared_memory
+except ImportError:
+    # python < 3.8
+    shared_memory = None
+
+
+def is_supported():
+    """
+    Staged pipeline relies on multiprocessing.shared_memory
+    :return:
+    """
+    return shared_memory is not None
+
+
+def attach_ring(name):
+    """
+    Attaches the shared memory of the frame ring created by the Starter
+    :param name: name of the shared memory block
+    :return: multiprocessing.shared_memory.SharedMemory
+    """
+    try:
+        # python >= 3.13 - the creator is responsible for the cleanup
+        return shared_memory.SharedMemory(name=name, track=False)
+    except TypeError:
+        return shared_memory.SharedMemory(name=name)
+
+
+class FrameRing(object):
+    """
+    Frame slots in a single shared memory block, owned by the Starter process
+    Free slot indices are passed through free_queue, filled slots through filled_queue
+    """
+    def __init__(self, slots, slot_size, queue_class=Queue):
+        self.slots = int(slots)
+        self.slot_size = int(slot_size)
+
+        self.shm = shared_memory.SharedMemory(create=True, size=self.slots * self.slot_size)
+
+        self.free_queue = queue_class()
+        self.filled_queue = queue_class()
+        for i in range(self.slots):
+            self.free_queue.put(i)
+
+    @property
+    def name(self):
+        return self.shm.name
+
+    def close(self):
+        if self.shm is not None:
+            self.shm.close()
+            self.shm.unlink()
+            self.shm = None
+
+
+class FileTracker(object):
+    """
+    Frames of the source files passed through the ring, shared by the readers and the writers
+    A file takes a slot holding the number of its frames still to be written - the frames can be written by different
+    writers, the process finishing the last frame counts the file once and reports it (finish_frames())
+    """
+    def __init__(self, slots, ctx=None):
+        """
+        :param slots: files in the ring at once, the readers wait for a free slot
+        :param ctx: multiprocessing context of the processes
+        """
+        if ctx is None:
+            ctx = multiprocessing.get_context()
+
+        self.slots = int(slots)
+        self.lock = ctx.Lock()
+
+        # frames to be written and the failure flag of the files
+        self.pending = ctx.RawArray("i", self.slots)
+        self.failed = ctx.RawArray("b", self.slots)
+
+        self.free_queue = ctx.Queue()
+        for i in range(self.slots):
+            self.free_queue.put(i)
+
+    def start(self, slot, nframes):
+        """
+        Assigns the slot to a file
+        :param slot: index taken from free_queue
+        :param nframes: number of the frames of the file
+        :return:
+        """
+        with self.lock:
+            self.pending[slot] = nframes
+            self.failed[slot] = 0
+
+    def release(self, slot, nframes=1, ok=True):
+        """
+        Finishes frames of the file, the slot is freed after the last one
+        :param nframes: number of the finished frames
+        :param ok: the frames were written
+        :return: None while frames are pending, True if all the frames were written, False otherwise
+        """
+        with self.lock:
+            self.pending[slot] -= nframes
+            if not ok:
+                self.failed[slot] = 1
+            if self.pending[slot] > 0:
+                return None
+            res = not self.failed[slot]
+
+        self.free_queue.put(slot)
+        return res
+
+
+def finish_frames(tracker, fslot, nframes, fn, fn_new, counters=None, done_queue=None, logger=None, shape=None):
+    """
+    Finishes frames of a file passed through the ring - written or dropped
+    The process finishing the last frame counts the file (converted or failed) and reports it,
+    without an output if any of its frames has failed
+    :param tracker: FileTracker
+    :param fslot: slot of the file in the tracker
+    :param nframes: number of the finished frames
+    :param fn: source filename
+    :param fn_new: path of the last frame of the file, None if the frames have failed
+    :param counters: app.common.stats.CounterRecorder
+    :return: True if the file is finished
+    """
+    res = tracker.release(fslot, nframes, ok=fn_new is not None)
+    if res is None:
+        return False
+
+    if not res:
+        fn_new = None
+    if counters is not None:
+        counters.add(files=int(fn_new is not None), errors=int(fn_new is None))
+    report_done(done_queue, fn, fn_new, logger=logger, shape=shape)
+    return True
+
+
+def wait_free(free_queue, stop_queue, timeout):
+    """
+    Waits for a free slot
+    :return: index of the slot, None if the stop signal was received
+    """
+    while True:
+        try:
+            return free_queue.get(True, timeout)
+        except Empty:
+            if test_stop(stop_queue):
+                return None
+
+
+def slot_view(shm, slot, slot_size, shape, dtype):
+    """
+    Returns numpy.ndarray placed in the slot of the ring
+    :return:
+    """
+    return np.ndarray(shape, dtype=np.dtype(dtype), buffer=shm.buf, offset=slot * slot_size)
+
+
+def reader(file_queue, stop_queue, free_queue, filled_queue, tracker, ring_name, slot_size, log_folder, counters,
+           done_queue=None, histograms=None, stats_slot=0, storage=None, log_queue=None, log_level=None, upload_queue=None,
+           staging_stop=None):
+    """
+    Function serving as a process - decodes the frames into the free slots of the ring
+    Frames larger than a slot are converted by the reader itself
+    :param file_queue: ready files (app.scheduler.ReadinessScheduler)
+    :param stop_queue:
+    :param free_queue: indices of the free slots
+    :param filled_queue: (slot, filename, frame, number of frames, shape, dtype, decoding time, announcement timestamp,
+                         slot of the file in the tracker)
+    :param tracker: FileTracker, a file is counted and reported once all its frames are finished
+    :param counters: app.common.stats.SharedCounters, the counters are updated in the given slot
+    :param done_queue: files converted or dropped by the reader are reported to the Starter
+    :param histograms: app.common.stats.StageHistograms, durations of the stages are recorded in the given slot
+    :param storage: configuration of the Starter, needed unless the process is forked
+    :param log_queue: records are written by the listener process of the Starter
+    :param log_level: shared level of the logs, changed at runtime by the Starter
+    :param upload_queue: write-behind - files are written into the staging folder and passed to the uploaders
+    :param staging_stop: multiprocessing.Event set when the Starter stops, a full staging folder fails the file instead of waiting
+    :return:
+    """
+    local_name = current_process().name
+
+    c = config.get_instance()
+    if storage is not None:
+        c.updateStorage(storage)
+    tdelay = max(float(c.getProcSleepDelay())/10., 0.01)
+
+    if log_queue is not None:
+        set_log_queue(log_queue)
+
+    t = Tester(def_file=local_name, log_folder=log_folder)
+    if log_level is not None:
+        t.setDebugLevel(log_level.value)
+    t.debug("Reader {} has started, slot size ({})", local_name, slot_size)
+
+    # large frames and multi-frame files are converted by the readers
+    check_compression(logger=t, conf=c)
+
+    shm = attach_ring(ring_name)
+    plan = OrientationPlan(c.getProcFileRotation(), c.getProcFileFlip())
+
+    local = deque()
+    bstop = False
+
+    stats = None
+    if histograms is not None:
+        stats = histograms.recorder(stats_slot)
+
+    tcounters = None
+    if counters is not None:
+        tcounters = counters.recorder(stats_slot)
+
+    start_staging(upload_queue, counters, tcounters, logger=t, conf=c, stop=staging_stop)
+
+    while not bstop:
+        item = get_next_file(file_queue, local, tdelay, logger=t, stats=stats)
+
+        if item is not None:
+            fn, tadded = item
+            fh, fslot, nframes, queued = None, None, 0, 0
+            try:
+                tstart = time.time()
+                fh = open_file(fn, stats, tcounters)
+                nframes = get_nframes(fh)
+
+                if fh.data is None or fh.data.nbytes > slot_size:
+                    t.debug("Frame does not fit into a slot, converting the file directly ({})", fn)
+                    convert_file(fn, fh, tcounters, logger=t, conf=c, plan=plan, stats=stats, tadded=tadded,
+                                 done_queue=done_queue)
+                else:
+                    fslot = wait_free(tracker.free_queue, stop_queue, tdelay)
+                    bstop = fslot is None
+                    if fslot is not None:
+                        tracker.start(fslot, nframes)
+
+                    for (i, data) in enumerate(iter_frames(fh, nframes) if fslot is not None else ()):
+                        slot = wait_free(free_queue, stop_queue, tdelay)
+                        if slot is None:
+                            bstop = True
+                            break
+
+                        np.copyto(slot_view(shm, slot, slot_size, data.shape, data.dtype), data)
+                        filled_queue.put((slot, fn, i, nframes, data.shape, data.dtype.str, time.time() - tstart, tadded,
+                                          fslot))
+                        queued += 1
+                        tstart = time.time()
+            except (IOError, OSError):
+                t.error("File ({}) was not recognized by fabio. Skipping..".format(fn))
+                if fslot is None:
+                    report_done(done_queue, fn, None, logger=t)
+                    report_stats(tcounters, 0., 0, files=0, errors=1, logger=t)
+            finally:
+                # frames which will not be written - the file fails once its queued frames are finished
+                if fslot is not None and queued < nframes:
+                    finish_frames(tracker, fslot, nframes - queued, fn, None, counters=tcounters, done_queue=done_queue,
+                                  logger=t)
+                if fh is not None:
+                    fh.close()
+
+        if log_level is not None and log_level.value != t.debug_level:
+            t.setDebugLevel(log_level.value)
+
+        if not bstop:
+            bstop = test_stop(stop_queue)
+
+    t.info("Process ({}) has received the stop signal".format(local_name))
+    shm.close()
+
+
+def writer(stop_queue, free_queue, filled_queue, tracker, ring_name, slot_size, log_folder, counters,
+           done_queue=None, histograms=None, stats_slot=0, storage=None, log_queue=None, log_level=None, upload_queue=None,
+           staging_stop=None):
+    """
+    Function serving as a process - transforms and encodes the frames from the filled slots of the ring
+    Multi-frame files are written as a file per frame, the frames of a file can be written by different writers
+    :param tracker: FileTracker, the writer finishing the last frame of a file counts the file and reports it
+    :param done_queue: a file is reported to the Starter once all its frames are written
+    :param histograms: app.common.stats.StageHistograms, durations of the stages are recorded in the given slot
+    :param storage: configuration of the Starter, needed unless the process is forked
+    :param log_queue: records are written by the listener process of the Starter
+    :param log_level: shared level of the logs, changed at runtime by the Starter
+    :param upload_queue: write-behind - files are written into the staging folder and passed to the uploaders
+    :param staging_stop: multiprocessing.Event set when the Starter stops, a full staging folder fails the file instead of waiting
+    :return:
+    """
+    local_name = current_process().name
+
+    c = config.get_instance()
+    if storage is not None:
+        c.updateStorage(storage)
+    tdelay = max(float(c.getProcSleepDelay())/10., 0.01)
+    conv_type = c.getProcFileConvType()
+
+    if log_queue is not None:
+        set_log_queue(log_queue)
+
+    t = Tester(def_file=local_name, log_folder=log_folder)
+    if log_level is not None:
+        t.setDebugLevel(log_level.value)
+    t.debug("Writer {} has started, slot size ({})", local_name, slot_size)
+
+    compression = check_compression(logger=t, conf=c)
+    t.debug("Using the compression ({})", compression)
+
+    shm = attach_ring(ring_name)
+    plan = OrientationPlan(c.getProcFileRotation(), c.getProcFileFlip())
+    t.debug("Using the orientation plan ({})", plan)
+
+    stats = None
+    if histograms is not None:
+        stats = histograms.recorder(stats_slot)
+
+    tcounters = None
+    if counters is not None:
+        tcounters = counters.recorder(stats_slot)
+
+    start_staging(upload_queue, counters, tcounters, logger=t, conf=c, stop=staging_stop)
+
+    while True:
+        item = None
+        try:
+            item = filled_queue.get(True, tdelay)
+        except Empty:
+            pass
+
+        if item is not None:
+            slot, fn, frame, nframes, shape, dtype, tread, tadded, fslot = item
+            tstart = time.time()
+
+            # slot is released as soon as the frame is in the conversion buffer
+            try:
+                tdata = plan.apply(slot_view(shm, slot, slot_size, shape, dtype), conv_type)
+            finally:
+                free_queue.put(slot)
+
+            ttransform = time.time()
+            fn_out = get_output_path(fn, logger=t, conf=c)
+            tpath = time.time()
+            nbytes, fn_last = 0, None
+            if fn_out is not None:
+                fn_new = get_frame_path(fn_out, frame, nframes)
+                try:
+                    nbytes = write_frame(fn_new, tdata, logger=t, conf=c)
+                    fn_last = get_frame_path(fn_out, nframes - 1, nframes)
+                except (OSError, IOError) as e:
+                    t.error("Error while writing new data ({}:{})".format(fn_new, e))
+
+            tstop = time.time()
+            if tcounters is not None:
+                tcounters.add(time=tread + tstop - tstart, frames=1, bytes_written=nbytes)
+
+            # the file is counted and reported by the writer of its last pending frame
+            bdone = finish_frames(tracker, fslot, 1, fn, fn_last, counters=tcounters, done_queue=done_queue, logger=t,
+                                  shape=tdata.shape)
+
+            if stats is not None:
+                stats.record("transform", ttransform - tstart)
+                stats.record("makedirs", tpath - ttransform)
+                stats.record("write", tstop - tpath)
+                if bdone and tadded is not None:
+                    stats.record("total", tstop - tadded)
+
+        if log_level is not None and log_level.value != t.debug_level:
+            t.setDebugLevel(log_level.value)
+
+        if test_stop(stop_queue):
+            t.info("Process ({}) has received the stop signal".format(local_name))
+            break
+
+    shm.close()
@@ -0,0 +1,269 @@
+import os
+import time
+import heapq
+import threading
+
+import app.config.main_config as config
+from app.worker import create_skip, report_done
+from app.common.tifprobe import probe_tiff
+from app.common.lanes import LANES, get_lane_rules, resolve_lane, check_lane
+
+
+class ReadinessScheduler(object):
+    """
+    Keeps the announced files until they are ready for conversion
+    Pending files are kept in a heap ordered by the time of their next check (never later than their deadline),
+    the due files are checked in bulk, ready files are passed to their priority lane (app.common.lanes.PriorityLanes),
+    expired ones are replaced by skip files
+    """
+    # states of the check
+    READY, WAIT, MISSING = range(3)
+
+    def __init__(self, lanes, logger=None, conf=None, watcher=None, done_queue=None, stats=None, counters=None):
+        self.t = logger
+
+        self.c = conf
+        if self.c is None:
+            self.c = config.get_instance()
+
+        # ready files wait in the lanes for the workers, default lanes of the added files per path prefix
+        self.lanes = lanes
+        self.rules = get_lane_rules(self.c)
+        self.default_lane = check_lane(self.c.getProcPriorityDefault())
+
+        self.watcher = watcher
+
+        # skipped files are reported as finished
+        self.done_queue = done_queue
+
+        # app.common.stats.StageRecorder - time spent in the readiness tests, app.common.stats.CounterRecorder - skips
+        self.stats = stats
+        self.counters = counters
+
+        # heap of (due time, sequence, path),
+        # path -> [filename, timestamp of the announcement, deadline, sequence, timestamp of AddFileOrDir, lane]
+        self._heap = []
+        self._pending = {}
+        self._seq = 0
+        self._lock = threading.Lock()
+
+    def __len__(self):
+        return len(self._pending)
+
+    def add(self, fn, tstart=None, tadded=None, lane=None):
+        """
+        Adds a file for the readiness tests, the first check is done on the next tact
+        :param fn: filename
+        :param tstart: timestamp of the announcement
+        :param tadded: timestamp of the request (AddFileOrDir), used for the end-to-end latency
+        :param lane: priority lane (app.common.lanes.LANES), the lane of the path prefix if None
+        :return: 1 if the file was added, 0 if it is already pending
+        """
+        return self.addMany([fn], tstart=tstart, tadded=tadded, lane=lane)
+
+    def addMany(self, fns, tstart=None, tadded=None, lane=None):
+        """
+        Adds a list of files for the readiness tests, the entry of a file already pending is replaced
+        :param fns: filenames
+        :param tstart: timestamp of the announcement
+        :param tadded: timestamp of the request (AddFileOrDir), used for the end-to-end latency
+        :param lane: priority lane (app.common.lanes.LANES), the lane of the path prefix if None
+        :return: number of the added files, the duplicates are not counted
+        """
+        if tstart is None:
+            tstart = time.time()
+        if tadded is None:
+            tadded = tstart
+
+        deadline = tstart + self.c.getProcFileTimeout()
+        paths = [os.path.abspath(fn) for fn in fns]
+
+        if self.watcher is not None:
+            for d in set(os.path.dirname(path) for path in paths):
+                self.watcher.watch(d)
+
+        res = 0
+        with self._lock:
+            for (path, fn) in zip(paths, fns):
+                # the same file given twice (overlapping inputs) replaces its entry and is converted once
+                res += int(path not in self._pending)
+
+                tlane = lane if lane is not None else resolve_lane(path, self.rules, self.default_lane)
+                self._push(path, [fn, tstart, deadline, None, tadded, tlane], tstart)
+        return res
+
+    def _push(self, path, entry, due):
+        """
+        Schedules the next check of the entry, should be called with the lock acquired
+        :return:
+        """
+        self._seq += 1
+        entry[3] = self._seq
+        self._pending[path] = entry
+        heapq.heappush(self._heap, (min(due, entry[2]), self._seq, path))
+
+    def _pop_due(self, tstamp):
+        """
+        Returns the entries which should be checked at the timestamp
+        :return:
+        """
+        res = []
+        with self._lock:
+            while len(self._heap) > 0 and self._heap[0][0] <= tstamp:
+                due, seq, path = heapq.heappop(self._heap)
+                entry = self._pending.get(path)
+
+                # outdated heap record - the entry was rescheduled or dispatched
+                if entry is None or entry[3] != seq:
+                    continue
+
+                del self._pending[path]
+                res.append((path, entry))
+        return res
+
+    def _test(self, fn, tstamp):
+        """
+        Readiness test, returns the state and the time of the next check
+        TIFF files are ready once their size reaches the end of the structures (app.common.tifprobe) - and once they were
+        not modified for the given time with PROC_FILE_TEST_PROBE_SETTLE, the next page of a multi-page file can still be
+        appended; the size and the modification time are tested for the files which cannot be probed
+        :return:
+        """
+        ftestsize = self.c.getProcFileTestSize()
+        ftestmod = self.c.getProcFileTestModTime()
+        tdelay = self.c.getProcThreadSleepDelay()
+
+        try:
+            st = os.stat(fn)
+        except OSError:
+            return self.MISSING, tstamp + tdelay
+
+        if self.c.getProcFileTestProbe():
+            end = probe_tiff(fn, st.st_size)
+            if end is not None:
+                if st.st_size >= end:
+                    # complete so far - a writer appending pages has not finished until the file settles
+                    if self.c.getProcFileTestProbeSettle() and tstamp - st.st_mtime < ftestmod:
+                        return self.WAIT, max(st.st_mtime + ftestmod, tstamp + tdelay / 10.)
+                    return self.READY, tstamp
+
+                # file is being written - checked again soon
+                return self.WAIT, tstamp + (tdelay / 10. if st.st_size > 0 else tdelay)
+
+        if st.st_size < ftestsize:
+            return self.WAIT, tstamp + tdelay
+
+        # file becomes ready once it was not modified for the given time
+        if tstamp - st.st_mtime < ftestmod:
+            return self.WAIT, max(st.st_mtime + ftestmod, tstamp + tdelay / 10.)
+
+        return self.READY, tstamp
+
+    def _dispatch(self, entries):
+        """
+        Passes the ready files to their lanes as (filename, timestamp of the request)
+        :param entries: list of the pending entries
+        :return:
+        """
+        if len(entries) == 0:
+            return
+
+        tstamp = time.time()
+
+        if self.t is not None and self.t.isDebug():
+            self.t.debug("Files are ready, adding them to the lanes ({})", [entry[0] for entry in entries])
+
+        if self.stats is not None:
+            for entry in entries:
+                self.stats.record("ready", tstamp - entry[1])
+
+        for lane in LANES:
+            items = [(entry[0], entry[4]) for entry in entries if entry[5] == lane]
+            if len(items) > 0:
+                self.lanes.add(lane, items, tstamp)
+
+    def _skip(self, fn, state):
+        if self.t is not None:
+            if state == self.MISSING:
+                self.t.error("Timeout ({}), file ({}) does not exist. Skipping..".format(self.c.getProcFileTimeout(), fn))
+            else:
+                self.t.error("Timeout ({}), file ({}) is not complete. Skipping..".format(self.c.getProcFileTimeout(), fn))
+        create_skip(fn, logger=self.t, conf=self.c, counters=self.counters)
+        report_done(self.done_queue, fn, None, logger=self.t)
+
+    def _closed(self, paths):
+        """
+        Watch mode - dispatches the files reported closed by the watcher
+        :return:
+        """
+        res = []
+        with self._lock:
+            for path in paths:
+                entry = self._pending.pop(path, None)
+                if entry is not None:
+                    res.append(entry)
+
+        self._dispatch(res)
+
+    def process(self, tstamp=None):
+        """
+        Checks all due files in bulk
+        :return: number of the dispatched files
+        """
+        if tstamp is None:
+            tstamp = time.time()
+
+        ready = []
+        fallback = self.c.getProcWatchFallbackDelay()
+
+        for (path, entry) in self._pop_due(tstamp):
+            fn, tstart, deadline = entry[:3]
+
+            state, due = self._test(fn, tstamp)
+            if state == self.READY:
+                ready.append(entry)
+                continue
+
+            if tstamp >= deadline:
+                self._skip(fn, state)
+                continue
+
+            # watch mode - wait for the close event, use the stat polling after the fallback delay,
+            # the files of the directories which are not watched (released or over the system limit) are polled
+            if self.watcher is not None and self.watcher.isWatched(os.path.dirname(path)):
+                due = max(due, tstart + fallback)
+
+            with self._lock:
+                self._push(path, entry, due)
+
+        self._dispatch(ready)
+        return len(ready)
+
+    def run(self, evstop):
+        """
+        Thread function - waits for the watcher events or the next due check
+        :param evstop: threading.Event stopping the thread
+        :return:
+        """
+        tdelay = min(self.c.getProcThreadSleepDelay(), 1)
+
+        while not evstop.is_set():
+            # time till the next due check
+            timeout = tdelay
+            with self._lock:
+                if len(self._heap) > 0:
+                    timeout = min(tdelay, max(self._heap[0][0] - time.time(), 0))
+
+            if self.watcher is not None:
+                try:
+                    self._closed(self.watcher.read(timeout=timeout))
+                except OSError as e:
+                    if self.t is not None:
+                        self.t.error("Error while reading inotify events ({})".format(e))
+            elif timeout > 0:
+                evstop.wait(timeout)
+
+            self.process()
+
+        if self.watcher is not None:
+            self.watcher.close()
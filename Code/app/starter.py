@@ -1,6 +1,19 @@
 from app.common.imports import *
 import app.config.main_config as config
 from app.worker import *
+from app.common.watcher import InotifyWatcher
+from app.common.scanner import scan_files
+from app.scheduler import ReadinessScheduler
+from app.common.ledger import ConversionLedger
+from app.common.journal import PendingJournal, get_request_paths
+from app.common.stats import StageHistograms, SharedCounters, CounterWindow, get_staging_backlog
+from app.common.staging import recover_staged
+from app.common.pathmap import get_path_mapper, PathMapException
+from app.common.placeholder import get_placeholder_cache
+from app.common.lanes import PriorityLanes, LaneException, LANE_HIGH, check_lane, get_lane_rules
+from app.common.tester import log_listener, set_log_queue, rotate_file, DEBUG_LEVEL
+import app.pipeline as pipeline
+from app.uploader import uploader
 
 class StarterException(Exception):
     pass
@@ -10,6 +23,9 @@ class Starter(Tester):
     NUM_PROC = None
     STOP_SIGNAL = "Stop"
 
+    # stages of the histograms measuring the wait of the ready files for a worker, used by the autoscaling
+    AUTOSCALE_STAGES = ("lane_high", "queue")
+
     def __init__(self, argv):
         # preparation
         argv = self.prepare_additional_arguments(argv)
@@ -18,34 +34,97 @@ class Starter(Tester):
         # cleaning logs
         self.cleanLogs()
 
+        # start method of the processes, the queues passed to the processes belong to the same context
+        self.ctx = self.getProcessContext()
+
+        # logs of all the processes are written by a listener process, the level is shared with the workers
+        self.qlog = None
+        self.proclog = None
+        self.log_level = Value(ctypes.c_int, DEBUG_LEVEL, lock=False)
+        self.startLogListener()
+
         # class relies on logs
         Tester.__init__(self, def_file="{}".format(self.__class__.__name__.lower()))
 
         # vars
         self.procs = []
 
+        # staged pipeline - shared memory ring of frames, frames of the files pending in the writers
+        self.ring = None
+        self.tracker = None
+
+        # write-behind - uploader processes, files of the staging folder, stop signals of the uploaders
+        self.uploaders = []
+        self.qupload = self.ctx.Queue()
+        self.qupload_quit = self.ctx.Queue()
+
+        # set when the server stops - the writing processes stop waiting for the uploads of a full staging folder
+        self.evstaging = self.ctx.Event()
+
+        # runtime resizing of the worker pool - signals retiring single workers, autoscaling thread
+        self.qretire = self.ctx.Queue()
+        self.lprocs = threading.RLock()
+        self.evscale = threading.Event()
+        self.thscale = threading.Thread(target=self.autoscaleWorkers, args=[self.evscale])
+
         # quite queue
-        self.qquit = Queue()
-        self.qfiles = Queue()
+        self.qquit = self.ctx.Queue()
+        self.qfiles = self.ctx.Queue()
         self.qunsorted = Queue()
 
-        # value of total conversion time (s)
-        self.value_time = Value(ctypes.c_double, 0.0)
-        # value of total conversion files
-        self.value_frames = Value(ctypes.c_uint32, 0)
+        # enumeration rate of the last scanned directory (files/s)
+        self.value_scan_rate = Value(ctypes.c_double, 0.0)
+
+        # histograms of the stage durations, counters (frames, conversion time, bytes, ...) -
+        # a slot per process, slot 0 is used by the threads of the server
+        slots = self.getConfigInstance().getProcStatsSlots()
+        self.histograms = StageHistograms(slots)
+        self.counters = SharedCounters(slots)
+        self.proc_slots = {}
+
+        # counters at the last reset, samples of the counters for the sliding window rates
+        self.counters_reset = self.counters.snapshot()
+        self.window = CounterWindow(self.counters, length=600.)
+        self.evrates = threading.Event()
+        self.thrates = threading.Thread(target=self.sampleCounters, args=[self.evrates])
 
         # sorting thread - gets its own queue with strings,
         # sorts out files, directories
         # starts processing accordingly
         self.thsort = threading.Thread(target=self.sortFilesDirs, args=[self.qunsorted, self.qfiles, self.qquit])
 
+        # ledger of the converted files, journal of the pending files -
+        # workers report the finished files, a single thread records them
+        self.ledger = None
+        self.journal = None
+        self.evjournal = threading.Event()
+        self.thjournal = threading.Thread(target=self.syncJournal, args=[self.evjournal])
+        self.qdone = self.ctx.Queue()
+        self.evdone = threading.Event()
+        self.thdone = threading.Thread(target=self.recordConverted, args=[self.qdone, self.evdone])
+
+        # numbers of the files passed to the readiness stage and of the up to date files skipped by the ledger
+        self.num_accepted = 0
+        self.num_uptodate = 0
+
+        # readiness stage - keeps the files until they are complete, passes them to the workers
+        self.scheduler = None
+        self.evready = threading.Event()
+        self.thready = None
+
+        # priority lanes - ready files wait in the server, the queue of the workers is kept short
+        self.lanes = None
+        self.evlanes = threading.Event()
+        self.thlanes = None
 
-    def _process_element(self, el):
+    def _process_element(self, el, tadded=None, lane=None):
         """
         Internal function preparing and testing the files
         Directory gets the file system elements parsed for .tif
         Files also pass through a temporary analysis - darks are ignored
         :param el:
+        :param tadded: timestamp of the request
+        :param lane: priority lane, the lane of the path prefix if None
         :return:
         """
         tfiles = None
@@ -53,11 +132,9 @@ class Starter(Tester):
         rpatt = re.compile(".*(\.tif|\.tiff)$", re.IGNORECASE)
 
         if os.path.isdir(el):
-            # check that the element is a directory, find all tif files, check that they are files
+            # check that the element is a directory, the found tif files are passed for processing in chunks
             self.debug("New element is a directory ({})".format(el))
-
-            telements = glob.glob(os.path.join(el, "*.tif"))
-            tfiles = list(filter(lambda tel: os.path.isfile(tel) and not "dark" in tel.lower(), telements))
+            self._process_directory(el, tadded=tadded, lane=lane)
 
         elif os.path.isfile(el) and not "dark" in el.lower():
             self.debug("New element is a file ({})".format(el))
@@ -73,7 +150,35 @@ class Starter(Tester):
         # process files if needed
         if tfiles is not None:
             self.debug("Adding new elements for processing ({})".format(tfiles))
-            self.addFilenames(tfiles)
+            self.addFilenames(tfiles, tadded=tadded, lane=lane)
+
+    def _process_directory(self, el, tadded=None, lane=None):
+        """
+        Streams the files of the directory into the processing while the directory is being scanned
+        :param el:
+        :param tadded: timestamp of the request
+        :param lane: priority lane, the lane of the path prefix if None
+        :return:
+        """
+        c = self.getConfigInstance()
+        chunk = max(int(c.getProcScanChunk()), 1)
+
+        tstart, cnt, tfiles = time.time(), 0, []
+        for fn in scan_files(el, recursive=c.getProcScanRecursive(), logger=self):
+            tfiles.append(fn)
+            if len(tfiles) >= chunk:
+                cnt += len(tfiles)
+                self.addFilenames(tfiles, tadded=tadded, lane=lane)
+                tfiles = []
+
+        if len(tfiles) > 0:
+            cnt += len(tfiles)
+            self.addFilenames(tfiles, tadded=tadded, lane=lane)
+
+        tscan = time.time() - tstart
+        if tscan > 0:
+            self.value_scan_rate.value = cnt / tscan
+        self.info("Directory ({}) is scanned: ({}) files in ({:.3f}s), ({:.1f}) files/s".format(el, cnt, tscan, self.value_scan_rate.value))
 
     def sortFilesDirs(self, qunsorted, qfiles, qquit):
         """
@@ -86,13 +191,23 @@ class Starter(Tester):
 
                 paths = qunsorted.get(False)
                 self.debug("Got an element to sort ({})".format(paths))
+
+                # elements added by addElement() keep the timestamp of the request and their lane
+                tadded, lane = None, None
+                if isinstance(paths, dict):
+                    paths, tadded, lane = paths["path"], paths["tstamp"], paths.get("lane")
+
                 if isinstance(paths, list) or isinstance(paths, tuple):
                     self.debug("Sotring a list")
                     for el in paths:
-                        self._process_element(el)
+                        self._process_element(el, tadded=tadded, lane=lane)
                 else:
                     self.debug("Sorting a single entry")
-                    self._process_element(paths)
+                    self._process_element(paths, tadded=tadded, lane=lane)
+
+                # the files of the request are accepted (journaled) - the request is not replayed after a crash
+                if self.journal is not None:
+                    self.journal.expanded(get_request_paths(paths))
             except Empty:
                 pass
 
@@ -113,22 +228,72 @@ class Starter(Tester):
             except Empty:
                 pass
 
-    def addFilenames(self, *argv):
+    def addFilenames(self, *argv, tadded=None, lane=None):
         """
         Fill the queue with the filenames
+        :param tadded: timestamp of the request
+        :param lane: priority lane, the lane of the path prefix if None
         :return:
         """
         self.debug("Adding files for processing")
         try:
             flist = argv[0]
 
+            # files converted before with the unchanged sources are skipped
+            c = self.getConfigInstance()
+            if self.ledger is not None and len(flist) > 0 and not c.getProcLedgerForce():
+                flist, skipped = self.ledger.filterConverted(flist)
+                if len(skipped) > 0:
+                    self.num_uptodate += len(skipped)
+                    self.info("Skipping ({}) files which were converted before".format(len(skipped)))
+                    if self.journal is not None:
+                        self.journal.done(skipped)
+
             if len(flist) > 0:
-                for fn in argv[0]:
-                    self.debug("Adding file ({}) to the queue".format(fn))
-                    self.qfiles.put(fn)
+                self.debug("Adding ({}) files to the readiness tests".format(len(flist)))
+                if self.journal is not None:
+                    self.journal.accept(flist)
+                self.num_accepted += self.scheduler.addMany(flist, tadded=tadded, lane=lane)
         except IndexError:
             self.error("File list is empty")
 
+    def addElement(self, path, lane=None):
+        """
+        Adds a file or a directory (or a list of them) for processing, the timestamp of the request is kept
+        :param path:
+        :param lane: priority lane (app.common.lanes.LANES), the lane of the path prefix if None
+        :return:
+        """
+        # the request is journaled before it is queued, it is replayed after a crash until its files are accepted
+        lane = check_lane(lane)
+        if self.journal is not None:
+            self.journal.request(get_request_paths(path))
+        self.qunsorted.put({"path": path, "tstamp": time.time(), "lane": lane})
+
+    def getLaneDepth(self, lane):
+        """
+        Returns the number of the ready files waiting in the priority lane
+        :param lane: app.common.lanes.LANES
+        :return:
+        """
+        if self.lanes is None:
+            return 0
+        return self.lanes.getDepth(lane)
+
+    def getNumAccepted(self):
+        """
+        Returns the number of the files passed for conversion, every file ends up converted, skipped or failed
+        :return:
+        """
+        return self.num_accepted
+
+    def getNumUpToDate(self):
+        """
+        Returns the number of the added files skipped as converted before
+        :return:
+        """
+        return self.num_uptodate
+
     def getPreprocessQueue(self):
         """
         Returns the queue used for working with the files
@@ -141,25 +306,533 @@ class Starter(Tester):
         Initialization of the program - starts new processes
         :return:
         """
+        c = self.getConfigInstance()
+
+        # compression of the output and the path rules are resolved before the configuration is passed to the processes
+        check_compression(logger=self, conf=c)
+        try:
+            self.info("Using the path rules ({})".format(get_path_mapper(c)))
+        except PathMapException as e:
+            self.error("{}, using the path replacement ({})".format(e, c.getProcPathReplacement()))
+            c.setConfiguration(PROC_PATH_RULES, None)
+
+        # default lanes of the added files
+        try:
+            self.info("Using the priority lanes ({}), default ({})".format(get_lane_rules(c), check_lane(c.getProcPriorityDefault())))
+        except (LaneException, TypeError, ValueError) as e:
+            self.error("Priority lanes cannot be used ({}), all files use the high lane".format(e))
+            c.setConfiguration(PROC_PRIORITY_PREFIXES, None)
+            c.setConfiguration(PROC_PRIORITY_DEFAULT, LANE_HIGH)
+
+        # counters and histograms of the threads of the server
+        tcounters = self.counters.recorder(0)
+        tstats = self.histograms.recorder(0)
+
+        # write-behind - the uploaders are started before the processes writing into the staging folder
+        if c.getProcStaging():
+            self.startUploaders(tcounters)
+
+        # watch mode - inotify based detection of the closed files
+        watcher = None
+        if c.getProcWatchMode():
+            if InotifyWatcher.isSupported():
+                self.info("Starting the watch mode (inotify)")
+                watcher = InotifyWatcher(logger=self, max_dirs=c.getProcWatchMaxDirs())
+            else:
+                self.info("Watch mode is not supported on this platform, using stat polling")
+
+        # ledger of the converted files
+        if c.getProcLedger():
+            try:
+                self.ledger = ConversionLedger(os.path.join(c.getFolderLog(), c.getProcLedgerFile()), logger=self, conf=c,
+                                               check_output=c.getProcLedgerCheckOutput())
+            except sqlite3.Error as e:
+                self.error("Cannot open the conversion ledger, all files are converted ({})".format(e))
+                self.ledger = None
+
+        # journal of the pending files
+        pending = []
+        if c.getProcJournal():
+            try:
+                self.journal = PendingJournal(os.path.join(c.getFolderLog(), c.getProcJournalFile()), logger=self)
+                pending = self.journal.pending()
+                self.journal.compact()
+                self.thjournal.start()
+            except (IOError, OSError) as e:
+                self.error("Cannot open the journal of the pending files ({})".format(e))
+                self.journal = None
+
+        if self.getDoneQueue() is not None and not self.thdone.is_alive():
+            self.thdone.start()
+
+        # start the priority lanes and the readiness stage
+        self.lanes = PriorityLanes(self.qfiles, c, stats=tstats, logger=self)
+        self.thlanes = threading.Thread(target=self.lanes.run, args=[self.evlanes])
+        self.thlanes.start()
+
+        self.scheduler = ReadinessScheduler(self.lanes, logger=self, conf=c, watcher=watcher, done_queue=self.getDoneQueue(),
+                                            stats=tstats, counters=tcounters)
+        self.thready = threading.Thread(target=self.scheduler.run, args=[self.evready])
+        self.thready.start()
+
+        # files left unfinished by the previous run of the server, requests which were not expanded (journaled already)
+        if len(pending) > 0:
+            self.info("Resuming the conversion of ({}) pending files".format(len(pending)))
+            self.addFilenames(pending)
+
+        requests = self.journal.requests() if self.journal is not None else []
+        if len(requests) > 0:
+            self.info("Resuming ({}) requests which were not expanded".format(len(requests)))
+            for path in requests:
+                self.qunsorted.put({"path": path, "tstamp": time.time(), "lane": None})
+
         # start the thread responsible for file and directories analysis
         self.thsort.start()
+        self.thrates.start()
 
-        c = self.getConfigInstance()
+        if c.getProcPipelineMode():
+            if pipeline.is_supported():
+                self.startPipeline()
+                return
+            self.info("Staged pipeline needs multiprocessing.shared_memory (python >= 3.8), using worker processes")
 
         self.NUM_PROC = c.getProcMaxNumber()
 
         try:
             self.debug("Starting ({}) worker processes".format(self.NUM_PROC))
 
-            for iproc in range(int(self.NUM_PROC)):
-                proc = Process(target=worker, args=(self.qfiles, self.qquit, c.getFolderLog(), self.value_time, self.value_frames))
-                self.procs.append(proc)
-                proc.start()
+            with self.lprocs:
+                for iproc in range(int(self.NUM_PROC)):
+                    self.startWorker()
 
         except StarterException:
             self.debug("Exit on {}".format(StarterException.__class__.__name__))
             # sys.exit(-1)
 
+        if c.getProcAutoscale():
+            self.info("Starting the autoscaling of the workers ({}-{})".format(c.getProcAutoscaleMin(), c.getProcAutoscaleMax()))
+            self.thscale.start()
+
+    def getProcessContext(self):
+        """
+        Returns the multiprocessing context of the configured start method
+        The forkserver imports the preloaded modules once, the workers are forked from this warm state
+        :return:
+        """
+        c = self.getConfigInstance()
+
+        # called before the logs are prepared
+        method = c.getProcStartMethod()
+        if method is not None and method not in get_all_start_methods():
+            c.printBulletMsg01("Start method ({}) is not supported on this platform, using the default".format(method))
+            method = None
+
+        ctx = get_context(method)
+        if ctx.get_start_method() == "forkserver":
+            c.printBulletMsg01("Starting the processes by the forkserver, preloading ({})".format(", ".join(c.getProcStartPreload())))
+            ctx.set_forkserver_preload(list(c.getProcStartPreload()))
+        return ctx
+
+    def startLogListener(self):
+        """
+        Starts the process writing the log records of all the processes into the rotating files
+        :return:
+        """
+        c = self.getConfigInstance()
+        if not c.getLoggingQueue():
+            return
+
+        self.qlog = self.ctx.Queue()
+        self.proclog = self.ctx.Process(target=log_listener, args=(self.qlog,), kwargs={"storage": c.getStorage()},
+                                        name="LogListener")
+        # the listener does not keep the server running if quit() was not called
+        self.proclog.daemon = True
+        self.proclog.start()
+
+        set_log_queue(self.qlog)
+
+    def stopLogListener(self):
+        """
+        Stops the listener once the other processes have finished, the records of the queue are written before
+        :return:
+        """
+        if self.proclog is None:
+            return
+
+        set_log_queue(None)
+        self.qlog.put(None)
+        self.proclog.join()
+        self.proclog = None
+
+    def getLogLevel(self):
+        """
+        Returns the level of the logs (logging.DEBUG, logging.INFO, ...)
+        :return:
+        """
+        return self.log_level.value
+
+    def setLogLevel(self, level):
+        """
+        Changes the level of the logs of the server and of the workers, the workers apply it after the current file
+        :param level: logging.DEBUG, logging.INFO, ...
+        :return:
+        """
+        self.info("Changing the level of the logs to ({})".format(logging.getLevelName(level)))
+        self.log_level.value = int(level)
+        self.setDebugLevel(int(level))
+
+    def startWorker(self):
+        """
+        Starts a new worker process, should be called with self.lprocs acquired
+        :return:
+        """
+        c = self.getConfigInstance()
+
+        slot = self.getStatsSlot()
+        proc = self.ctx.Process(target=worker, args=(self.qfiles, self.qquit, c.getFolderLog(), self.counters),
+                                kwargs={"retire_queue": self.qretire, "done_queue": self.getDoneQueue(),
+                                        "histograms": self.histograms, "stats_slot": slot, "storage": c.getStorage(),
+                                        "log_queue": self.qlog, "log_level": self.log_level,
+                                        "upload_queue": self.getUploadQueue(), "staging_stop": self.evstaging})
+        self.procs.append(proc)
+        self.proc_slots[proc] = slot
+        proc.start()
+        return proc
+
+    def getStatsSlot(self):
+        """
+        Returns a slot of the shared statistics not used by a running process, slots are shared if none is free
+        The counters of a free slot are made consistent, its previous process could have been killed during an update
+        :return:
+        """
+        for proc in [proc for proc in self.proc_slots.keys() if proc.exitcode is not None]:
+            del self.proc_slots[proc]
+
+        used = set(self.proc_slots.values())
+        for slot in range(1, self.histograms.slots):
+            if slot not in used:
+                self.counters.reset(slot)
+                return slot
+
+        # updates of the processes sharing a slot could be lost
+        self.error("No free slot of the statistics for ({}) processes, the slots are shared - "
+                   "increase PROC_STATS_SLOTS".format(len(self.proc_slots) + 1))
+        return 1 + len(self.proc_slots) % (self.histograms.slots - 1)
+
+    def getCounters(self):
+        """
+        Returns the counters summed over the processes since the last reset
+        :return: dict (app.common.stats.COUNTERS)
+        """
+        res = self.counters.snapshot()
+        for (k, v) in self.counters_reset.items():
+            res[k] -= v
+        return res
+
+    def getRate(self, name, window):
+        """
+        Returns the rate of the counter over the last window (1/s)
+        :param name: name of the counter (app.common.stats.COUNTERS)
+        :param window: length of the window (s)
+        :return:
+        """
+        return self.window.rate(name, window)
+
+    def sampleCounters(self, evstop):
+        """
+        Thread function - samples the counters for the sliding window rates once per second
+        :return:
+        """
+        self.window.sample()
+        while not evstop.wait(1.):
+            self.window.sample()
+
+    def getLatency(self, stage):
+        """
+        Returns the percentiles (p50, p95, p99) of the stage duration (s)
+        :param stage: name of the stage (app.common.stats.STAGES)
+        :return:
+        """
+        return self.histograms.percentiles(stage)
+
+    def getNumWorkers(self):
+        """
+        Returns the number of running workers which were not asked to retire
+        :return:
+        """
+        with self.lprocs:
+            nretire = 0
+            try:
+                nretire = self.qretire.qsize()
+            except NotImplementedError:
+                pass
+
+            return max(len([proc for proc in self.procs if proc.is_alive()]) - nretire, 0)
+
+    def setNumWorkers(self, value):
+        """
+        Starts new workers or retires running ones, retiring workers finish their current file
+        :param value: number of workers
+        :return:
+        """
+        c = self.getConfigInstance()
+        value = max(int(value), 0)
+
+        if self.ring is not None:
+            self.error("Number of processes of the staged pipeline cannot be changed")
+            return
+
+        with self.lprocs:
+            # forget the processes which have finished
+            for proc in [proc for proc in self.procs if not proc.is_alive() and proc.exitcode is not None]:
+                proc.join()
+                self.procs.remove(proc)
+
+            current = self.getNumWorkers()
+            self.info("Changing the number of workers ({} -> {})".format(current, value))
+
+            for iproc in range(value - current):
+                self.startWorker()
+
+            for iproc in range(current - value):
+                self.qretire.put(self.STOP_SIGNAL)
+
+            self.NUM_PROC = len(self.procs)
+            c.setProcMaxNum(value)
+
+    def getWaitLatency(self, since):
+        """
+        Returns the p95 of the time the ready files waited for a worker (high lane, queue of the workers)
+        :param since: dict stage -> counts of the histograms at the beginning of the period, updated with the current counts
+        :return: p95 (s) of the period, the longest of the stages
+        """
+        res = 0.
+        for stage in self.AUTOSCALE_STAGES:
+            counts = self.histograms.counts(stage)
+            res = max(res, self.histograms.percentiles(stage, values=(95,), since=since.get(stage))[0])
+            since[stage] = counts
+        return res
+
+    def autoscaleWorkers(self, evstop):
+        """
+        Thread function - grows the pool while the file queue has a backlog or the files wait too long for a worker,
+        shrinks it after an idle period
+        :return:
+        """
+        c = self.getConfigInstance()
+
+        interval = c.getProcAutoscaleInterval()
+        tidle, last_frames = time.time(), self.getCounters()["frames"]
+
+        since = {}
+        self.getWaitLatency(since)
+
+        while not evstop.wait(interval):
+            nmin, nmax = int(c.getProcAutoscaleMin()), int(c.getProcAutoscaleMax())
+
+            try:
+                backlog = self.qfiles.qsize() + self.getLaneDepth(None)
+            except NotImplementedError:
+                self.error("Queue size is not available on this platform, stopping the autoscaling")
+                break
+
+            tstamp, frames = time.time(), self.getCounters()["frames"]
+            if backlog > 0 or frames != last_frames:
+                tidle, last_frames = tstamp, frames
+
+            # waiting time of the files dispatched during the last period
+            latency, max_latency = self.getWaitLatency(since), c.getProcAutoscaleLatency()
+            blatency = max_latency is not None and latency > max_latency
+
+            current = self.getNumWorkers()
+            if (backlog > c.getProcAutoscaleBacklog() * max(current, 1) or blatency) and current < nmax or current < nmin:
+                self.debug("Backlog of ({}) messages for ({}) workers, p95 wait for a worker ({:.3f}s)".format(backlog, current,
+                                                                                                     latency))
+                self.setNumWorkers(max(min(current + 1, nmax), nmin))
+            elif tstamp - tidle > c.getProcAutoscaleIdle() and current > nmin:
+                self.debug("Workers were idle for ({}s)".format(tstamp - tidle))
+                self.setNumWorkers(current - 1)
+                tidle = tstamp
+
+    def startPipeline(self):
+        """
+        Starts the staged pipeline - reader processes decode the frames into a shared memory ring,
+        writer processes convert and write them, only slot indices pass through the queues
+        :return:
+        """
+        c = self.getConfigInstance()
+
+        nreaders, nwriters = int(c.getProcPipelineReaders()), int(c.getProcPipelineWriters())
+        self.ring = pipeline.FrameRing(c.getProcPipelineSlots(), c.getProcPipelineSlotSize(), queue_class=self.ctx.Queue)
+        self.NUM_PROC = nreaders + nwriters
+
+        # files in the ring - frames in the slots, frames being written, files being read,
+        # kept by the Starter - its lock should exist until the spawned processes have started
+        self.tracker = pipeline.FileTracker(self.ring.slots + nreaders + nwriters, ctx=self.ctx)
+
+        self.debug("Starting ({}) reader and ({}) writer processes, ({}) slots of ({}) bytes".format(nreaders, nwriters,
+                                                                                             self.ring.slots, self.ring.slot_size))
+
+        for iproc in range(nreaders):
+            slot = self.getStatsSlot()
+            proc = self.ctx.Process(target=pipeline.reader, args=(self.qfiles, self.qquit, self.ring.free_queue, self.ring.filled_queue,
+                                                                   self.tracker, self.ring.name, self.ring.slot_size, c.getFolderLog(),
+                                                                   self.counters),
+                                    kwargs={"done_queue": self.getDoneQueue(), "histograms": self.histograms, "stats_slot": slot,
+                                            "storage": c.getStorage(), "log_queue": self.qlog, "log_level": self.log_level,
+                                            "upload_queue": self.getUploadQueue(), "staging_stop": self.evstaging})
+            self.procs.append(proc)
+            self.proc_slots[proc] = slot
+            proc.start()
+
+        for iproc in range(nwriters):
+            slot = self.getStatsSlot()
+            proc = self.ctx.Process(target=pipeline.writer, args=(self.qquit, self.ring.free_queue, self.ring.filled_queue,
+                                                                   self.tracker, self.ring.name, self.ring.slot_size, c.getFolderLog(),
+                                                                   self.counters),
+                                    kwargs={"done_queue": self.getDoneQueue(), "histograms": self.histograms, "stats_slot": slot,
+                                            "storage": c.getStorage(), "log_queue": self.qlog, "log_level": self.log_level,
+                                            "upload_queue": self.getUploadQueue(), "staging_stop": self.evstaging})
+            self.procs.append(proc)
+            self.proc_slots[proc] = slot
+            proc.start()
+
+    def startUploaders(self, tcounters):
+        """
+        Starts the uploader processes moving the files of the staging folder to their destination,
+        the files left by the previous run are uploaded first
+        :param tcounters: app.common.stats.CounterRecorder of the server, the recovered files are counted as staged
+        :return:
+        """
+        c = self.getConfigInstance()
+        folder = c.getProcStagingFolder()
+
+        try:
+            os.makedirs(folder, exist_ok=True)
+        except OSError as e:
+            self.error("Cannot create the staging folder, the files are written to their destination ({}:{})".format(folder, e))
+            return
+
+        recovered = recover_staged(folder, logger=self)
+        if len(recovered) > 0:
+            self.info("Uploading ({}) files left in the staging folder ({})".format(len(recovered), folder))
+        for (staged, fn, size) in recovered:
+            tcounters.add(staged=1, staged_bytes=size)
+            self.qupload.put((staged, fn, time.time()))
+
+        nuploaders = max(int(c.getProcStagingUploaders()), 1)
+        self.debug("Starting ({}) uploader processes, staging folder ({})".format(nuploaders, folder))
+
+        for iproc in range(nuploaders):
+            slot = self.getStatsSlot()
+            proc = self.ctx.Process(target=uploader, args=(self.qupload, self.qupload_quit, c.getFolderLog(), self.counters),
+                                    kwargs={"histograms": self.histograms, "stats_slot": slot, "storage": c.getStorage(),
+                                            "log_queue": self.qlog, "log_level": self.log_level})
+            self.uploaders.append(proc)
+            self.proc_slots[proc] = slot
+            proc.start()
+
+        # placeholders written by the readiness stage of the server
+        start_staging(self.qupload, self.counters, tcounters, logger=self, conf=c, stop=self.evstaging)
+
+    def stopUploaders(self):
+        """
+        Stops the uploaders once the staged files are uploaded, should be called after the writing processes have stopped
+        :return:
+        """
+        if len(self.uploaders) == 0:
+            return
+
+        start_staging(None, None, None)
+
+        self.info("Waiting for the uploads, ({}) files are staged".format(self.getStagingBacklog()[0]))
+        for proc in self.uploaders:
+            self.qupload_quit.put(self.STOP_SIGNAL)
+        for proc in self.uploaders:
+            proc.join()
+        del self.uploaders[:]
+
+    def getUploadQueue(self):
+        """
+        Returns the queue of the uploaders, None if the files are written to their destination
+        :return:
+        """
+        res = None
+        if len(self.uploaders) > 0:
+            res = self.qupload
+        return res
+
+    def getStagingBacklog(self):
+        """
+        Returns the files waiting in the staging folder for the upload
+        :return: (files, bytes)
+        """
+        return get_staging_backlog(self.counters.snapshot())
+
+    def getDoneQueue(self):
+        """
+        Returns the queue for the reports of the converted files, None if nothing consumes the reports
+        :return:
+        """
+        res = None
+        if self.ledger is not None or self.journal is not None or self.getConfigInstance().getProcFileSkipLearn():
+            res = self.qdone
+        return res
+
+    def recordConverted(self, qdone, evstop):
+        """
+        Thread function - records the files reported by the workers as finished,
+        a ledger transaction per collected batch, the journal records are synced by syncJournal()
+        Shapes of the converted frames are passed to the placeholders of the scheduler
+        :return:
+        """
+        tdelay = min(self.getConfigInstance().getProcThreadSleepDelay(), 1)
+        placeholders = get_placeholder_cache(self.getConfigInstance(), logger=self)
+
+        bstop = False
+        while not bstop:
+            bstop = evstop.is_set()
+
+            items = []
+            try:
+                items.append(qdone.get(True, tdelay))
+                while len(items) < 1000:
+                    items.append(qdone.get(False))
+            except Empty:
+                pass
+
+            if len(items) > 0 and self.ledger is not None:
+                self.debug("Recording ({}) converted files".format(len(items)))
+                try:
+                    self.ledger.record(items)
+                except sqlite3.Error as e:
+                    self.error("Cannot record the converted files ({})".format(e))
+
+            for item in items:
+                placeholders.learn(item[0], item[4])
+
+            # the ledger is updated first - a file finished on both is not converted again after a crash
+            if len(items) > 0 and self.journal is not None:
+                self.journal.done([item[0] for item in items])
+
+            # the reports left after the stop are recorded before exit
+            if bstop and len(items) > 0:
+                bstop = False
+
+    def syncJournal(self, evstop):
+        """
+        Thread function - group commit of the journal records, compaction of the journal
+        :return:
+        """
+        c = self.getConfigInstance()
+
+        while not evstop.wait(c.getProcJournalSyncInterval()):
+            try:
+                self.journal.sync()
+                self.journal.compact(c.getProcJournalCompact())
+            except (IOError, OSError) as e:
+                self.error("Cannot write the journal of the pending files ({})".format(e))
+
     def prepare_additional_arguments(self, argv):
         """
         Prepares additional arguments
@@ -201,22 +874,21 @@ class Starter(Tester):
 
     def cleanLogs(self):
         """
-        Cleans up the logs
+        Rotates the logs of the previous run - kept as <name>.log.1, <name>.log.2, ...
         :return:
         """
         c = self.getConfigInstance()
-        c.printHeaderMsg("Cleaning log files")
+        c.printHeaderMsg("Rotating log files")
         c.printBulletMsg01("Log directory is ({})".format(c.getFolderLog()))
         log_folder = c.getFolderLog()
 
+        # only the log files are rotated, the ledger is kept
         if log_folder is not None:
             for fn in os.listdir(c.getFolderLog()):
                 fn = os.path.join(log_folder, fn)
-                if os.path.isfile(fn):
-                    print(" - Deleting old log file ({})".format(fn))
-                    os.unlink(fn)
-        # TODO - keep previous log
-        pass
+                if os.path.isfile(fn) and fn.endswith(".log") and os.path.getsize(fn) > 0:
+                    c.printBulletMsg01("Keeping the previous log file ({}.1)".format(fn))
+                    rotate_file(fn, c.getLoggingRotateBackups())
 
     def quit_debug(self):
         """
@@ -260,6 +932,13 @@ class Starter(Tester):
         """
         self.info("Quitting the application now")
 
+        if self.thscale.is_alive():
+            self.evscale.set()
+            self.thscale.join()
+
+        # the writers waiting for a full staging folder (e.g. the destination is down) would not receive the stop signal
+        self.evstaging.set()
+
         if self.NUM_PROC is not None:
             for iproc in range(self.NUM_PROC+1):
                 self.qquit.put(self.STOP_SIGNAL)
@@ -284,13 +963,57 @@ class Starter(Tester):
                         break
             del self.procs[:]
 
-        # close the thread
-        if self.thsort.isAlive():
+        # close the threads
+        if self.thsort.is_alive():
             self.info("Stopping the sorting thread")
             self.qquit.put(self.STOP_SIGNAL)
             self.thsort.join()
 
+        if self.thready is not None and self.thready.is_alive():
+            self.info("Stopping the readiness thread")
+            self.evready.set()
+            self.thready.join()
+
+        if self.thlanes is not None and self.thlanes.is_alive():
+            self.info("Stopping the priority lanes, ({}) ready files are not dispatched".format(self.lanes.getDepth()))
+            self.evlanes.set()
+            self.lanes.wake()
+            self.thlanes.join()
+
+        # the readiness stage and the writing processes are stopped, the staging folder is drained
+        self.stopUploaders()
+
+        if self.thrates.is_alive():
+            self.evrates.set()
+            self.thrates.join()
+
+        if self.thdone.is_alive():
+            self.info("Stopping the ledger thread")
+            self.evdone.set()
+            self.thdone.join()
+
+        if self.ledger is not None:
+            self.ledger.close()
+            self.ledger = None
+
+        if self.thjournal.is_alive():
+            self.info("Stopping the journal thread")
+            self.evjournal.set()
+            self.thjournal.join()
+
+        if self.journal is not None:
+            self.info("Closing the journal, ({}) files are pending".format(len(self.journal)))
+            self.journal.close()
+            self.journal = None
+
+        if self.ring is not None:
+            self.info("Releasing the shared memory of the pipeline")
+            self.ring.close()
+            self.ring = None
+            self.tracker = None
+
         self.info("Cleaning process is finished")
+        self.stopLogListener()
 
     def getConfigInstance(self):
         """
@@ -308,11 +1031,8 @@ class Starter(Tester):
         Resets the statistics
         :return:
         """
-        self.debug("Resetting the stat. multiprocessing.Values")
-        if self.value_time is not None:
-            with self.value_time.get_lock():
-                self.value_time.value = 0.
+        self.debug("Resetting the statistics")
 
-        if self.value_frames is not None:
-            with self.value_frames.get_lock():
-                self.value_frames.value = 0
+        # the shared counters are written only by their processes, the current values are used as the new origin
+        self.counters_reset = self.counters.snapshot()
+        self.histograms.reset()
@@ -1,5 +1,10 @@
 from app.common.imports import *
 
+# tango is imported only by the server - the workers and the command line tools start without it
+from tango import AttrQuality, AttrWriteType, DispLevel, DevState
+from tango.server import Device, attribute, command
+from tango.server import class_property, device_property
+
 class TangoServer(Device):
 
     # Vars
@@ -24,7 +29,7 @@ class TangoServer(Device):
 
     def error(self, msg):
         if self.s is not None:
-            self.error(msg)
+            self.s.error(msg)
         self.error_stream(msg)
 
     def info(self, msg):
@@ -0,0 +1,143 @@
+import os
+import time
+import heapq
+from multiprocessing import current_process
+from queue import Empty
+
+import app.config.main_config as config
+from app.common.tester import Tester, set_log_queue
+from app.common.staging import upload_file, STAGING_BACKOFF_MAX
+from app.common.pathmap import get_dir_cache
+from app.worker import test_stop
+
+
+def get_size(fn):
+    """
+    Returns the size of the file, 0 if it does not exist
+    :return:
+    """
+    try:
+        return os.path.getsize(fn)
+    except OSError:
+        return 0
+
+
+def get_retry_delay(backoff, attempt):
+    """
+    Returns the delay before the next attempt of a failed upload, doubled with every attempt up to STAGING_BACKOFF_MAX
+    :param backoff: delay before the first retry (s)
+    :param attempt: number of the failed attempts
+    :return: delay (s)
+    """
+    return min(backoff * 2 ** min(attempt, 32), STAGING_BACKOFF_MAX)
+
+
+def uploader(upload_queue, stop_queue, log_folder, counters, histograms=None, stats_slot=0, storage=None, log_queue=None,
+             log_level=None):
+    """
+    Function serving as a process - moves the files of the staging folder to their destination (write-behind)
+    Files which could not be uploaded after the retries are requeued with a delay doubled up to STAGING_BACKOFF_MAX
+    and stay in the backlog of the staging folder until they are uploaded
+    The queue is drained before the process stops, the requeued files are tried once more, files which could not be
+    uploaded stay in the staging folder and are uploaded after a restart of the server
+    :param upload_queue: (staged path, destination filename, timestamp of the staging)
+    :param stop_queue: stop signal, sent by the Starter after the writing processes have stopped
+    :param counters: app.common.stats.SharedCounters, the counters are updated in the given slot
+    :param histograms: app.common.stats.StageHistograms, durations of the uploads are recorded in the given slot
+    :param storage: configuration of the Starter, needed unless the process is forked
+    :param log_queue: records are written by the listener process of the Starter
+    :param log_level: shared level of the logs, changed at runtime by the Starter
+    :return:
+    """
+    local_name = current_process().name
+
+    c = config.get_instance()
+    if storage is not None:
+        c.updateStorage(storage)
+    tdelay = max(float(c.getProcSleepDelay())/10., 0.01)
+    retries, backoff = int(c.getProcStagingRetries()), float(c.getProcStagingBackoff())
+
+    # destination directories known to exist
+    get_dir_cache(c.getProcPathDirCache())
+
+    if log_queue is not None:
+        set_log_queue(log_queue)
+
+    t = Tester(def_file=local_name, log_folder=log_folder)
+    if log_level is not None:
+        t.setDebugLevel(log_level.value)
+    t.debug("Uploader {} has started, ({}) retries", local_name, retries)
+
+    stats = None
+    if histograms is not None:
+        stats = histograms.recorder(stats_slot)
+
+    tcounters = None
+    if counters is not None:
+        tcounters = counters.recorder(stats_slot)
+
+    # requeued uploads - heap of (time of the next attempt, sequence, failed attempts, staged path, filename,
+    # timestamp of the staging)
+    deferred = []
+    seq = 0
+
+    bstop = False
+    while True:
+        item = None
+        try:
+            item = upload_queue.get(True, tdelay)
+        except Empty:
+            pass
+
+        due = []
+        if item is not None:
+            due.append((retries + 1, item, retries))
+        while len(deferred) > 0 and deferred[0][0] <= time.time():
+            tnext, _, attempt, staged, fn, tstaged = heapq.heappop(deferred)
+            due.append((attempt + 1, (staged, fn, tstaged), 0))
+
+        for (attempt, (staged, fn, tstaged), tretries) in due:
+            try:
+                nbytes = upload_file(staged, fn, retries=tretries, backoff=backoff, logger=t)
+            except (IOError, OSError) as e:
+                # the file stays in the backlog, the writers keep waiting while it is full
+                delay = get_retry_delay(backoff, attempt)
+                t.warning("Upload of ({}) has failed ({}), requeued, next attempt in ({:.1f}s)".format(fn, e, delay))
+                seq += 1
+                heapq.heappush(deferred, (time.time() + delay, seq, attempt, staged, fn, tstaged))
+                continue
+
+            t.debug("Uploaded ({})", fn)
+            if tcounters is not None:
+                tcounters.add(uploaded=1, uploaded_bytes=nbytes)
+            if stats is not None:
+                stats.record("upload", time.time() - tstaged)
+
+        # the level of the logs is changed at runtime
+        if log_level is not None and log_level.value != t.debug_level:
+            t.setDebugLevel(log_level.value)
+
+        # the received files are uploaded before stopping
+        if not bstop and test_stop(stop_queue):
+            t.info("Process ({}) has received the stop signal, uploading the staged files".format(local_name))
+            bstop = True
+
+        if bstop and item is None:
+            break
+
+    # last attempt of the requeued files, the failed ones are uploaded after a restart
+    for (tnext, _, attempt, staged, fn, tstaged) in sorted(deferred):
+        try:
+            nbytes = upload_file(staged, fn, retries=0, backoff=backoff, logger=t)
+            t.debug("Uploaded ({})", fn)
+            if tcounters is not None:
+                tcounters.add(uploaded=1, uploaded_bytes=nbytes)
+        except (IOError, OSError) as e:
+            t.error("Cannot upload ({}), the file is kept in the staging folder ({}:{})".format(fn, staged, e))
+            if tcounters is not None:
+                tcounters.add(upload_errors=1, upload_errors_bytes=get_size(staged))
+
+        if stats is not None:
+            stats.record("upload", time.time() - tstaged)
+
+    t.debug("Uploader ({}) is stopped ", local_name)
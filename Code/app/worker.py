@@ -1,21 +1,462 @@
+import os
+import sys
+import time
+import threading
+from collections import deque
+from concurrent.futures import ThreadPoolExecutor
+from multiprocessing import Queue, current_process
+from queue import Empty
+
+# only the modules needed for the conversion - every worker process imports them
+import numpy as np
 import fabio
-from app.common.imports import *
+
 import app.config.main_config as config
+from app.config.keys import PROC_FILE_COMPRESSION
+from app.common.tester import Tester, set_log_queue
+from app.common.conversion import OrientationPlan, get_conversion_buffer
+from app.common import tifwriter
+from app.common.staging import StagingArea, set_staging, get_staging
+from app.common.pathmap import get_path_mapper, get_dir_cache
+from app.common.placeholder import get_placeholder_cache
+
+def check_compression(logger=None, conf=None):
+    """
+    Tests the compression of the output, an unknown mode or a missing codec is reported and the process writes uncompressed files
+    :return: compression mode used by the process
+    """
+    t = logger
+
+    c = conf
+    if c is None:
+        c = config.get_instance()
+
+    res = str(c.getProcFileCompression()).lower()
+    if not tifwriter.is_compression_supported(res):
+        if t is not None:
+            t.error("Compression ({}) is not supported or its codec is not installed, writing uncompressed files".format(res))
+        res = tifwriter.COMPRESSION_NONE
+    c.setConfiguration(PROC_FILE_COMPRESSION, res)
+    return res
+
+
+def get_writer_options(conf=None):
+    """
+    Returns the compression options of the native writer
+    :return: dict - keyword arguments of app.common.tifwriter.write_tiff() and TiffStackWriter
+    """
+    c = conf
+    if c is None:
+        c = config.get_instance()
+
+    return {"compression": c.getProcFileCompression(), "level": c.getProcFileCompressionLevel(),
+            "threads": c.getProcFileCompressionThreads(), "strip_size": c.getProcFileCompressionStrip()}
+
 
-class WorkerFileException(Exception):
+def start_staging(upload_queue, counters, recorder, logger=None, conf=None, stop=None):
     """
-    Dummy class for the conversion process related exception
+    Sets the staging area of the process (write-behind), the written files are passed to the uploaders
+    :param upload_queue: queue of the uploader processes (app.uploader.uploader), files are written to their destination if None
+    :param counters: app.common.stats.SharedCounters
+    :param recorder: app.common.stats.CounterRecorder of the process
+    :param stop: multiprocessing.Event set when the Starter stops, the writers stop waiting for the uploads
+    :return: app.common.staging.StagingArea or None
     """
-    pass
+    c = conf
+    if c is None:
+        c = config.get_instance()
+
+    res = None
+    if upload_queue is not None:
+        res = StagingArea(c.getProcStagingFolder(), upload_queue, counters, recorder, max_files=c.getProcStagingMaxFiles(),
+                          max_bytes=c.getProcStagingMaxBytes(), logger=logger, stop=stop)
+        if logger is not None:
+            logger.debug("Writing the files into the staging folder ({})", res.folder)
+    set_staging(res)
+    return res
+
 
-def convert_file(fn, fh, value_time, value_frames, logger=None, conf=None):
+def write_frame(fn, data, logger=None, conf=None):
+    """
+    Writes the frame as a TIFF file - native writer with cached headers, fabio for the unsupported data
+    Compressed output needs the native writer, with the staging area the file is written locally and uploaded later
+    :param fn: filename
+    :param data: numpy.ndarray
+    :return: number of the written bytes
+    """
+    c = conf
+    if c is None:
+        c = config.get_instance()
+
+    area = get_staging()
+    target = fn if area is None else area.reserve(fn)
+
+    try:
+        bnative = c.getProcFileWriter() == "native" or c.getProcFileCompression() != tifwriter.COMPRESSION_NONE
+        if bnative and tifwriter.is_supported(data):
+            res = tifwriter.write_tiff(target, data, **get_writer_options(c))
+        else:
+            if logger is not None:
+                logger.debug("Using fabio for writing ({}, {}:{})", fn, data.shape, data.dtype)
+            tfh = fabio.tifimage.TifImage(data)
+            tfh.write(target)
+            tfh.close()
+            res = os.path.getsize(target)
+    except (IOError, OSError):
+        if area is not None:
+            area.discard(target)
+        else:
+            # the directory could be removed meanwhile - created again for the next file
+            get_dir_cache().discard(os.path.dirname(fn))
+        raise
+
+    if area is not None:
+        area.commit(target, fn)
+    return res
+
+class BackgroundWriter(object):
+    """
+    Writes the converted frames in a thread pool while the next frame is converted
+    Frames are converted into a ring of buffers, a buffer is reused only after its previous frame was written
+    """
+    def __init__(self, executor, nbuffers=2, logger=None, conf=None, stats=None, counters=None):
+        self.executor = executor
+        self.t = logger
+        self.c = conf
+        self.stats = stats
+        self.counters = counters
+
+        self._futures = [None] * nbuffers
+        self._slot = 0
+
+    def buffer(self, shape, dtype):
+        """
+        Returns the next free conversion buffer
+        :return:
+        """
+        self._wait(self._slot)
+        return get_conversion_buffer(shape, dtype, slot=self._slot)
+
+    def write(self, fn, data, tadded=None, completion=None):
+        """
+        Writes the data placed in the buffer returned by the last buffer() call
+        :param tadded: timestamp of the file announcement, the end-to-end latency is recorded once the frame is written
+        :param completion: FileCompletion of the source file, released once the frame is written
+        :return:
+        """
+        if completion is not None:
+            completion.hold()
+        self._futures[self._slot] = self.executor.submit(self._write, fn, data, tadded, completion)
+        self._slot = (self._slot + 1) % len(self._futures)
+
+    def _write(self, fn, data, tadded=None, completion=None):
+        tstart = time.time()
+        bwritten = False
+        try:
+            nbytes = write_frame(fn, data, logger=self.t, conf=self.c)
+            bwritten = True
+            if self.counters is not None:
+                self.counters.add(bytes_written=nbytes)
+        except (OSError, IOError) as e:
+            if self.t is not None:
+                self.t.error("Error while writing new data ({}:{})".format(fn, e))
+            if self.counters is not None and completion is None:
+                self.counters.add(errors=1)
+        finally:
+            if completion is not None:
+                completion.release(bwritten)
+
+        if self.stats is not None:
+            tstop = time.time()
+            self.stats.record("write", tstop - tstart)
+            if tadded is not None:
+                self.stats.record("total", tstop - tadded)
+
+    def _wait(self, slot):
+        future = self._futures[slot]
+        if future is not None:
+            future.result()
+            self._futures[slot] = None
+
+    def flush(self):
+        """
+        Waits for all frames to be written
+        :return:
+        """
+        for slot in range(len(self._futures)):
+            self._wait(slot)
+
+class FileCompletion(object):
+    """
+    Counts and reports a source file once all its frames are written - directly or by the background writer
+    A failed write of any frame marks the file as failed, it is counted as an error and reported without an output
+    """
+    def __init__(self, fn, counters, done_queue=None, shape=None, logger=None):
+        """
+        :param fn: source filename
+        :param counters: app.common.stats.CounterRecorder
+        :param done_queue: queue of the finished files, see report_done()
+        :param shape: (rows, columns) of the converted frames
+        """
+        self.fn = fn
+        self.counters = counters
+        self.done_queue = done_queue
+        self.shape = shape
+        self.t = logger
+
+        self.fn_new = None
+        self.tconversion = 0.
+        self.nframes = 0
+
+        # the converting thread holds the file until all its frames are passed to the writer
+        self._pending = 1
+        self._failed = False
+        self._lock = threading.Lock()
+
+    def hold(self):
+        """
+        Adds a pending write
+        :return:
+        """
+        with self._lock:
+            self._pending += 1
+
+    def release(self, ok=True):
+        """
+        Finishes a pending write, the file is counted and reported after the last one
+        :param ok: the write has succeeded
+        :return:
+        """
+        with self._lock:
+            self._pending -= 1
+            self._failed = self._failed or not ok
+            bdone = self._pending == 0
+
+        if bdone:
+            fn_new = None if self._failed else self.fn_new
+            report_stats(self.counters, self.tconversion, self.nframes, files=int(fn_new is not None),
+                         errors=int(fn_new is None), logger=self.t)
+            report_done(self.done_queue, self.fn, fn_new, logger=self.t, shape=self.shape)
+
+    def finish(self, fn_new, tconversion, nframes):
+        """
+        Called by the converting thread once all the frames are converted, the pending writes are waited for
+        :param fn_new: path of the last written file, None if the conversion has failed
+        :param tconversion: time of the conversion (s)
+        :param nframes: number of the converted frames
+        :return:
+        """
+        self.fn_new, self.tconversion, self.nframes = fn_new, tconversion, nframes
+        self.release(fn_new is not None)
+
+def convert_frame(fn_new, data, plan, conv_type, writer=None, logger=None, conf=None, stats=None, tadded=None, counters=None,
+                  completion=None):
+    """
+    Converts a frame and writes it - directly or by the background writer
+    :param stats: app.common.stats.StageRecorder, durations of the stages are recorded if not None
+    :param counters: app.common.stats.CounterRecorder, written bytes are counted if not None
+    :param tadded: timestamp of the file announcement, passed to the background writer
+    :param completion: FileCompletion of the source file, passed to the background writer
+    :return:
+    """
+    tstart = time.time()
+    if writer is None:
+        tdata = plan.apply(data, conv_type)
+    else:
+        tdata = plan.apply(data, conv_type, out=writer.buffer(plan.view(data).shape, conv_type))
+
+    if stats is not None:
+        tstop = time.time()
+        stats.record("transform", tstop - tstart)
+        tstart = tstop
+
+    if writer is None:
+        nbytes = write_frame(fn_new, tdata, logger=logger, conf=conf)
+        if counters is not None:
+            counters.add(bytes_written=nbytes)
+        if stats is not None:
+            tstop = time.time()
+            stats.record("write", tstop - tstart)
+            if tadded is not None:
+                stats.record("total", tstop - tadded)
+    else:
+        writer.write(fn_new, tdata, tadded=tadded, completion=completion)
+
+def get_output_path(fn, logger=None, conf=None):
+    """
+    Returns the path of the converted file (app.common.pathmap.PathMapper), creates its directory
+    The directories known to exist are not created again
+    :param fn: source filename
+    :return: path of the converted file, None if no rule matches or the path is the source - the source is never overwritten
+    """
+    t = logger
+
+    c = conf
+    if c is None:
+        c = config.get_instance()
+
+    # initial parameters
+    fn_new = get_path_mapper(c).map(fn)
+    if fn_new is None:
+        if t is not None:
+            t.error("No path rule matches ({}), the file is not written".format(fn))
+        return None
+
+    if os.path.abspath(fn_new) == os.path.abspath(fn):
+        if t is not None:
+            t.error("Path rules map the file onto itself ({}), the file is not written".format(fn))
+        return None
+    dir_new = os.path.dirname(fn_new)
+
+    if t is not None:
+        t.debug("The old ({}) and the new ({}) paths", fn, fn_new)
+
+    # write-behind - the destination directory is created by the uploader
+    if get_staging() is not None:
+        return fn_new
+
+    try:
+        # creating the tree of the new directory
+        get_dir_cache(c.getProcPathDirCache()).makedirs(dir_new)
+    except OSError as e:
+        if t is not None:
+            t.error("Error while creating a new directory ({}:{})".format(dir_new, e))
+
+    return fn_new
+
+def get_frame_path(fn_new, frame, nframes):
+    """
+    Returns the output path of a frame of a multi-frame file converted into a file per frame
+    :return:
+    """
+    if nframes == 1:
+        return fn_new
+
+    base, ext = os.path.splitext(fn_new)
+    return "{}_{:05d}{}".format(base, frame, ext)
+
+def get_nframes(fh):
+    """
+    Returns the number of frames in the opened file
+    :param fh: fabio handle
+    :return:
+    """
+    res = getattr(fh, "nframes", 1)
+    if res is None or res < 1:
+        res = 1
+    return res
+
+def iter_frames(fh, nframes=None):
+    """
+    Yields the frames of the opened file one by one, the frames after the first one are read on demand
+    :param fh: fabio handle
+    :return: numpy.ndarray
+    """
+    if nframes is None:
+        nframes = get_nframes(fh)
+
+    yield fh.data
+    for i in range(1, nframes):
+        yield fh.getframe(i).data
+
+def convert_frames(fn_new, fh, nframes, plan, conv_type, logger=None, conf=None, writer=None, stats=None, tadded=None,
+                   counters=None, completion=None):
+    """
+    Converts a multi-frame file frame by frame - a file per frame (<name>_<frame>.tif) or a multi-page file
+    Only the current frame and its converted copy are kept in memory
+    :param fn_new: output filename
+    :param fh: fabio handle
+    :param nframes: number of frames
+    :param completion: FileCompletion of the source file, the frames written by the background writer are tracked
+    :return: (number of the converted frames, path of the last written file)
+    """
+    t = logger
+
+    c = conf
+    if c is None:
+        c = config.get_instance()
+
+    # multi-page output needs the native writer, the whole stack should fit into a classic TIFF file
+    bstack = c.getProcFileMultiframe() == "stack"
+    if bstack:
+        tshape = plan.view(fh.data).shape
+        nbytes = int(np.prod(tshape)) * np.dtype(conv_type).itemsize
+        bstack = tifwriter.is_supported(np.empty((1, 1), dtype=conv_type)) and len(tshape) == 2 and \
+                 (nbytes + 512) * nframes < tifwriter.TIFF_MAX_SIZE
+        if not bstack and t is not None:
+            t.info("Frames of ({}) cannot be written as a multi-page file, using a file per frame".format(fn_new))
+
+    if t is not None:
+        t.debug("Converting ({}) frames into ({}), multi-page ({})", nframes, fn_new, bstack)
+
+    res, fn_last = 0, fn_new
+    if not bstack:
+        fn_last = get_frame_path(fn_new, nframes - 1, nframes)
+
+    area = get_staging()
+
+    stack, fn_stack = None, None
+    try:
+        if bstack:
+            # the frames of the stack are converted into the buffer of the process (slot 0),
+            # the background writer could still be writing the previous file from it
+            if writer is not None:
+                writer.flush()
+
+            fn_stack = fn_new if area is None else area.reserve(fn_new)
+            stack = tifwriter.TiffStackWriter(fn_stack, **get_writer_options(c))
+
+        for (i, data) in enumerate(iter_frames(fh, nframes)):
+            if stack is not None:
+                tstart = time.time()
+                tdata = plan.apply(data, conv_type)
+                tstop = time.time()
+                nbytes = stack.write(tdata)
+                if counters is not None:
+                    counters.add(bytes_written=nbytes)
+                if stats is not None:
+                    stats.record("transform", tstop - tstart)
+                    stats.record("write", time.time() - tstop)
+            else:
+                convert_frame(get_frame_path(fn_new, i, nframes), data, plan, conv_type, writer=writer, logger=t, conf=c,
+                              stats=stats, tadded=tadded if i == nframes - 1 else None, counters=counters,
+                              completion=completion)
+            res += 1
+    except (OSError, IOError, tifwriter.TiffWriterException) as e:
+        if t is not None:
+            t.error("Error while writing new data ({}:{})".format(fn_new, e))
+    finally:
+        if stack is not None:
+            stack.close()
+
+    # the complete multi-page file is uploaded, an incomplete one is removed
+    if stack is not None and area is not None:
+        if res == nframes:
+            area.commit(fn_stack, fn_new)
+        else:
+            area.discard(fn_stack)
+
+    if stack is not None and stats is not None and tadded is not None:
+        stats.record("total", time.time() - tadded)
+
+    return res, fn_last
+
+def convert_file(fn, fh, counters, logger=None, conf=None, plan=None, writer=None, stats=None, tadded=None, done_queue=None):
     """
     Open file, report the pixel type, convert file and rotate if needed
+    The file is counted and reported (report_done()) once its output is written, with the background writer
+    this happens in the thread of the writer after the last frame
     :param fn: filename
     :param fh: fabio handle
+    :param counters: app.common.stats.CounterRecorder
     :param logger:
     :param c: config object
-    :return:
+    :param plan: OrientationPlan resolved from the configuration, created from the config object if None
+    :param writer: BackgroundWriter, frames are written directly if None
+    :param stats: app.common.stats.StageRecorder, durations of the stages are recorded if not None
+    :param tadded: timestamp of the file announcement (AddFileOrDir), used for the end-to-end latency
+    :param done_queue: finished files are reported to the Starter, see report_done()
+    :return: path of the last written (or still written by the background writer) file, None if the conversion has failed
     """
     # timestamp
     tstart, tstop = time.time(), 0
@@ -23,7 +464,7 @@ def convert_file(fn, fh, value_time, value_frames, logger=None, conf=None):
     # save the file
     t = logger
     if t is not None:
-        t.debug("Starting file conversion ({})".format(fn))
+        t.debug("Starting file conversion ({})", fn)
 
     c = None
     if conf is None:
@@ -32,106 +473,165 @@ def convert_file(fn, fh, value_time, value_frames, logger=None, conf=None):
         c = conf
 
     # get configuration parameters
-    rot = c.getProcFileRotation()
-    flip = c.getProcFileFlip()
     conv_type = c.getProcFileConvType()
-    path_replace = c.getProcPathReplacement()
-    '''t.debug("\nReplacement configuration:\n"
-            "\t - Rotation ({})\n"
-            "\t - Flip axis ({})\n"
-            "\t - Conversion type ({})\n"
-            "\t - Path replacement ({})\n".format(rot, flip, conv_type, path_replace))'''
+
+    if plan is None:
+        plan = OrientationPlan(c.getProcFileRotation(), c.getProcFileFlip())
 
     # initial parameters
-    fn_origin, fn_new = fn, fn.replace(path_replace[0], path_replace[1])
-    dir_new = os.path.dirname(fn_new)
+    fn_new = get_output_path(fn, logger=t, conf=c)
+    if stats is not None:
+        stats.record("makedirs", time.time() - tstart)
 
-    if t is not None:
-        t.debug("The old ({}) and the new ({}) paths".format(fn_origin, fn_new))
+    if fn_new is None:
+        report_stats(counters, 0., 0, files=0, errors=1, logger=t)
+        report_done(done_queue, fn, None, logger=t)
+        return None
 
-    try:
-        # creating the tree of the new directory
-        os.makedirs(dir_new, exist_ok=True)
-    except OSError as e:
+    if fh.data is None:
         if t is not None:
-            t.error("Error while creating a new directory ({}:{})".format(dir_new, e))
+            t.error("Data is invalid")
+        report_stats(counters, 0., 0, files=0, errors=1, logger=t)
+        report_done(done_queue, fn, None, logger=t)
+        return None
+
+    completion = FileCompletion(fn, counters, done_queue=done_queue, shape=get_output_shape(fh, plan), logger=t)
 
     # we consider the file to be opened
-    dtype = None
+    d1, d2 = fh.shape[-1], fh.shape[-2] # previously it was dim1 + dim2
     if t is not None:
-        d1, d2 = fh.shape[-1], fh.shape[-2] # previously it was dim1 + dim2
-        # t.debug("Dimensions ({}:{})".format(fh.dim1, fh.dim2))
-        t.debug("Dimensions ({}:{})".format(d1, d2))
-        if d1 > 0 and d2 > 0:
-            dtype = type(fh.data[0, 0])
-            t.debug("Inner file format ({}:{})".format(type(dtype), fh.nbits))
-
-    # remove the negative values before the transformation into uints
-    d1, d2 = fh.shape[-1], fh.shape[-2]
-    if d1 > 0 and d2 > 0 and dtype is not None:
-        if conv_type in (np.uint, np.uint0, np.uint8, np.uint16, np.uint32, np.uint64) and dtype in (np.float, np.float16, np.float32, np.int, np.int8, np.int16, np.int32, np.long):
-            fh.data[fh.data < 0] = 0
-
-    if fh.data is None:
-        t.error("Data is invalid")
-        return
-
-    # apply the transformation
-    tdata = deepcopy(fh.data.astype(conv_type))
+        t.debug("Dimensions ({}:{})", d1, d2)
+        t.debug("Inner file format ({}:{})", fh.data.dtype, fh.nbits)
 
-    d1, d2 = fh.shape[-1], fh.shape[-2]
-    if d1 > 0 and d2 > 0:
+    if t is not None and not plan.isIdentity():
+        t.debug("Orienting the image ({})", plan)
 
-        # if rotation angle is a multiple of 90 - do rotation
-        if rot % 90. == 0 and rot != 0:
-            if t is not None:
-                t.debug("Rotating the image by ({}) degrees".format(rot))
-            tdata = np.rot90(tdata, int(rot/90.))
+    nframes = get_nframes(fh)
+    if nframes == 1:
+        # apply the transformation - negative values are removed before the transformation into uints,
+        # orientation and conversion are done in one pass into a contiguous buffer
+        # create new file - saving transformed data
+        if t is not None:
+            t.debug("Writing the new file ({})", fn_new)
 
-        # perform flipping
-        if flip is not None:
+        res = fn_new
+        try:
+            convert_frame(fn_new, fh.data, plan, conv_type, writer=writer, logger=t, conf=c, stats=stats, tadded=tadded,
+                          counters=counters, completion=completion)
+        except (OSError, IOError) as e:
+            res = None
             if t is not None:
-                t.debug("Flipping the image by axis/axes ({})".format(flip))
-            tdata = np.flip(tdata, axis=flip)
-
-    # create new file - saving transformed data
-    if t is not None:
-        t.debug("Writing the new file ({})".format(fn_new))
-
-    try:
-        tfh = fabio.tifimage.TifImage(tdata)
-        tfh.write(fn_new)
-        tfh.close()
-    except (OSError, IOError) as e:
-        if t is not None:
-            t.error("Error while writing new data ({})".format(fn_new, e))
+                t.error("Error while writing new data ({}:{})".format(fn_new, e))
+    else:
+        tframes, res = convert_frames(fn_new, fh, nframes, plan, conv_type, logger=t, conf=c, writer=writer, stats=stats,
+                                      tadded=tadded, counters=counters, completion=completion)
+        if tframes < nframes:
+            res = None
+        nframes = tframes
 
     # time of conversion
     tstop = time.time()
     tconversion = tstop-tstart
     if t is not None:
-        t.debug("Time of conversion ({}s)".format(tconversion))
+        t.debug("Time of conversion ({}s)", tconversion)
 
-    # report the values via multiprocessing.Value
-    if value_time is not None:
-        with value_time.get_lock():
-            value_time.value += tconversion
-            t.debug("Total conversion time ({})".format(value_time.value))
+    # counted and reported now or after the pending writes of the background writer
+    completion.finish(res, tconversion, nframes)
 
-    # report the number of frames collected via multiprocessing.Value
-    if value_frames is not None:
-        with value_frames.get_lock():
-            value_frames.value += 1
-            t.debug("Total conversion frames ({})".format(value_frames.value))
+    return res
 
-def create_skip(fn, logger=None, conf=None, shapex=2048, shapey=2048):
+def get_output_shape(fh, plan):
     """
-    If the file is not existing - create its substitution as empty file
+    Returns the shape of the converted frames of the opened file
+    :param fh: fabio handle
+    :param plan: OrientationPlan
+    :return: (rows, columns) or None if the frames are not images
+    """
+    data = fh.data
+    if data is None or data.ndim != 2:
+        return None
+    return plan.view(data).shape
+
+def report_done(done_queue, fn, fn_new, logger=None, shape=None):
+    """
+    Reports a finished file to the Starter (app.common.ledger.ConversionLedger, app.common.journal.PendingJournal,
+    app.common.placeholder.PlaceholderCache)
+    :param done_queue: queue of (source, size, mtime, output, shape), nothing is reported if None
+    :param fn: source filename
+    :param fn_new: path of the last written file, None if the file was skipped or its conversion has failed
+    :param shape: (rows, columns) of the converted frames, the shape of the placeholders of the directory
     :return:
     """
+    if done_queue is None:
+        return
+
+    size, mtime = None, None
+    if fn_new is not None:
+        try:
+            st = os.stat(fn)
+            size, mtime = st.st_size, st.st_mtime
+        except OSError as e:
+            fn_new = None
+            if logger is not None:
+                logger.error("Cannot report the converted file ({}:{})".format(fn, e))
+
+    if fn_new is None:
+        shape = None
+    done_queue.put((fn, size, mtime, fn_new, shape))
+
+def report_stats(counters, tconversion, nframes, files=1, errors=0, logger=None):
+    """
+    Reports the conversion time, the number of converted frames and files via the slot of the shared counters
+    :param counters: app.common.stats.CounterRecorder, nothing is reported if None
+    :return:
+    """
+    t = logger
+
+    if counters is not None:
+        counters.add(time=tconversion, frames=nframes, files=files, errors=errors)
+        if t is not None:
+            t.debug("Conversion time ({}), frames ({})", tconversion, nframes)
+
+def write_placeholder(fn, shape, dtype, logger=None, conf=None):
+    """
+    Writes the placeholder of a missing file - encoded once per (shape, type, compression), cloned or copied
+    With the staging area the file is written locally and uploaded later
+    :param fn: filename
+    :param shape: (rows, columns)
+    :param dtype: type of the pixels
+    :return: number of the written bytes
+    """
+    c = conf
+    if c is None:
+        c = config.get_instance()
+
+    area = get_staging()
+    target = fn if area is None else area.reserve(fn)
+
+    try:
+        res = get_placeholder_cache(c, logger=logger).write(target, shape, dtype, get_writer_options(c))
+    except (IOError, OSError):
+        if area is not None:
+            area.discard(target)
+        else:
+            get_dir_cache().discard(os.path.dirname(fn))
+        raise
+
+    if area is not None:
+        area.commit(target, fn)
+    return res
+
+def create_skip(fn, logger=None, conf=None, shape=None, counters=None):
+    """
+    If the file is not existing - create its substitution as empty file
+    :param shape: (rows, columns) of the placeholder, the shape learned for the directory of the file if None
+    :param counters: app.common.stats.CounterRecorder, the placeholder is counted if not None,
+                     a file without an output path is counted as an error
+    :return: path of the placeholder, None if the file has no output path
+    """
     t = logger
     if t is not None:
-        t.debug("Starting skip file process ({})".format(fn))
+        t.debug("Starting skip file process ({})", fn)
 
     c = None
     if conf is None:
@@ -140,177 +640,235 @@ def create_skip(fn, logger=None, conf=None, shapex=2048, shapey=2048):
         c = conf
 
     conv_type = c.getProcFileConvType()
-    path_replace = c.getProcPathReplacement()
+    if shape is None:
+        shape = get_placeholder_cache(c, logger=t).getShape(fn)
 
     # initial parameters
-    fn_origin, fn_new = fn, fn.replace(path_replace[0], path_replace[1])
-    dir_new = os.path.dirname(fn_new)
+    fn_new = get_output_path(fn, logger=t, conf=c)
+    if fn_new is None:
+        if counters is not None:
+            counters.add(errors=1)
+        return None
 
     if t is not None:
-        t.error("Skipping file. The old ({}) and the new skip dummy ({}) paths".format(fn_origin, fn_new))
+        t.error("Skipping file. The old ({}) and the new skip dummy ({}) paths".format(fn, fn_new))
 
+    # saves the empty TIF file - fabio writes the types unsupported by the native writer
+    nbytes = 0
     try:
-        # creating the tree of the new directory
-        os.makedirs(dir_new, exist_ok=True)
-    except OSError as e:
+        if tifwriter.is_supported(np.empty((1, 1), dtype=conv_type)):
+            nbytes = write_placeholder(fn_new, shape, conv_type, logger=t, conf=c)
+        else:
+            nbytes = write_frame(fn_new, np.zeros(shape, dtype=conv_type), logger=t, conf=c)
+    except (OSError, IOError) as e:
         if t is not None:
-            t.error("Error while creating a new directory ({}:{})".format(dir_new, e))
+            t.error("Error while writing new data ({}:{})".format(fn_new, e))
 
-    tdata = np.zeros([shapex, shapey], dtype=conv_type)
+    if counters is not None:
+        counters.add(skips=1, bytes_written=nbytes)
+    return fn_new
 
-    # saves the empty TIF file
-    try:
-        tfh = fabio.tifimage.TifImage(tdata)
-        tfh.write(fn_new)
-        tfh.close()
-    except (OSError, IOError) as e:
+def open_file(fn, stats=None, counters=None):
+    """
+    Opens the file with fabio, the data of the first frame is decoded
+    :param fn: filename
+    :param stats: app.common.stats.StageRecorder
+    :param counters: app.common.stats.CounterRecorder, size of the file is counted if not None
+    :return: fabio handle
+    """
+    tstart = time.time()
+    res = fabio.openimage.openimage(fn)
+    if stats is not None:
+        stats.record("open", time.time() - tstart)
+    if counters is not None:
+        counters.add(bytes_read=os.path.getsize(fn))
+    return res
+
+def get_next_file(file_queue, local, timeout, logger=None, stats=None):
+    """
+    Returns the next file - from the local batch first, then from the queue
+    :param file_queue: queue with files or lists of files - filenames or (filename, announcement, dispatch timestamps)
+    :param local: collections.deque with the files of the received batch
+    :param timeout: time to wait for the queue (s)
+    :param stats: app.common.stats.StageRecorder, time spent in the queue is recorded if not None
+    :return: (filename, timestamp of the announcement) or None
+    """
+    t = logger
+
+    if len(local) == 0:
+        try:
+            item = file_queue.get(True, timeout)
+            if isinstance(item, list):
+                if t is not None:
+                    t.debug("Got a batch of ({}) files", len(item))
+                local.extend(item)
+            else:
+                local.append(item)
+        except Empty:
+            pass
+
+    res = None
+    if len(local) > 0:
+        item = local.popleft()
+
+        if isinstance(item, tuple):
+            fn, tadded, tdispatch = item
+            if stats is not None:
+                stats.record("queue", time.time() - tdispatch)
+        else:
+            fn, tadded = item, None
+
+        res = (fn, tadded)
         if t is not None:
-            t.error("Error while writing new data ({})".format(fn_new, e))
+            t.debug("Got filename ({})", fn)
+    return res
 
-def worker(file_queue, stop_queue, log_folder, value_time, value_frames, debug=None):
+def test_stop(stop_queue):
+    """
+    Tests the stop queue for the stop signal
+    :return: True if the process should stop
+    """
+    try:
+        stop_queue.get(False)
+        return True
+    except Empty:
+        return False
+
+def worker(file_queue, stop_queue, log_folder, counters, debug=None, retire_queue=None, done_queue=None,
+           histograms=None, stats_slot=0, storage=None, log_queue=None, log_level=None, upload_queue=None,
+           staging_stop=None):
     """
     Function serving as a process
+    The files obtained from the queue passed the readiness tests (app.scheduler.ReadinessScheduler)
     :param file_queue:
     :param stop_queue:
+    :param counters: app.common.stats.SharedCounters, the counters are updated in the given slot
+    :param retire_queue: signals stopping a single worker when the pool shrinks
+    :param done_queue: converted files are reported to the Starter
+    :param histograms: app.common.stats.StageHistograms, durations of the stages are recorded in the given slot
+    :param storage: configuration of the Starter (app.config.main_config.Config.getStorage()), needed unless the process is forked
+    :param log_queue: records are written by the listener process of the Starter (app.common.tester.log_listener)
+    :param log_level: shared level of the logs, changed at runtime by the Starter
+    :param upload_queue: write-behind - files are written into the staging folder and passed to the uploaders (app.uploader.uploader)
+    :param staging_stop: multiprocessing.Event set when the Starter stops, a full staging folder fails the file instead of waiting
     :return:
     """
     local_name = current_process().name
 
+    if log_queue is not None:
+        set_log_queue(log_queue)
+
     # get static information from config file - remain unmodified through the program operation
     c = config.get_instance()
+    if storage is not None:
+        c.updateStorage(storage)
     delay = c.getProcSleepDelay()
-    ftimeout = c.getProcFileTimeout()
-    ftestsize = c.getProcFileTestSize()
-    ftestmod = c.getProcFileTestModTime()
     rot = c.getProcFileRotation()
     flip = c.getProcFileFlip()
     conv_type = c.getProcFileConvType()
-    path_replace = c.getProcPathReplacement()
+    path_replace = get_path_mapper(c)
 
     t = Tester(def_file=local_name, log_folder=log_folder)
+    if log_level is not None:
+        t.setDebugLevel(log_level.value)
 
     t.info("\nReplacement configuration:\n"
            "\t - Process sleep delay ({})\n"
-           "\t - Process file timeout ({})\n"
-           "\t - Process file size test ({})\n"
-           "\t - Process file test modification time ({}s)\n"
             "\t - Rotation ({})\n"
             "\t - Flip axis ({})\n"
             "\t - Conversion type ({})\n"
-            "\t - Path replacement ({})\n".format(delay, ftimeout, ftestsize, ftestmod, rot, flip, conv_type, path_replace))
+            "\t - Path replacement ({})\n".format(delay, rot, flip, conv_type, path_replace))
 
-    t.debug("Worker {} has started, setting the delay to ({})".format(local_name, delay))
+    t.debug("Worker {} has started, setting the delay to ({})", local_name, delay)
+
+    compression = check_compression(logger=t, conf=c)
+    t.debug("Using the compression ({})", compression)
+
+    # orientation of the frames is resolved once
+    plan = OrientationPlan(rot, flip)
+    t.debug("Using the orientation plan ({})", plan)
 
-    bstop = False
     debug_cnt = 0
 
-    fn = None
+    # waiting for a file no longer than a fraction of the delay - the stop queue is tested in between
+    tdelay = max(float(delay)/10., 0.01)
 
-    # timestamp for file to be converted - if the file is not existing within
-    # 10s - consider it as missing
-    fnts_start = None
+    # files received as a batch are converted one by one
+    local = deque()
 
-    while True:
+    stats = None
+    if histograms is not None:
+        stats = histograms.recorder(stats_slot)
 
-        # obtaining the filename
-        if fn is None:
-            try:
-                fn = file_queue.get(False)
-                t.debug("Got filename ({})".format(fn))
-                fnts_start = time.time()
-            except Empty:
-                # t.debug("Empty on filename")
-                pass
+    tcounters = None
+    if counters is not None:
+        tcounters = counters.recorder(stats_slot)
 
-        # process if we have some input
-        try:
-            if fn is not None:
-                # after certain timeout - consider the file to be non existing
-                ftstamp = time.time()
-
-                if ftstamp - fnts_start > ftimeout:
-                    t.error("Timeout ({}), considering the file ({}) as non existing. Skipping..".format(ftimeout, fn))
-                    # creating an empty file - skip file
-                    create_skip(fn, logger=t, conf=c)
-                    fn, fnts_start = None, None
-                    raise WorkerFileException
-
-                # convert the file if the file exist
-                bexist = False
-                if os.path.exists(fn):
-                    # make a test - size, modification time
-                    try:
-                        # file size test - passed or Exception
-                        fsize = os.path.getsize(fn)
-                        t.debug("Size of the file ({}) vs test size ({}). Test ({})".format(fsize, ftestsize, fsize > ftestsize))
-                        if fsize < ftestsize:
-                            raise WorkerFileException
-
-                        # file modification time test
-                        fmodtime = os.path.getmtime(fn)
-                        t.debug("Modification time of the file ({}) vs timestamp ({}). Delay: ({}). Test({})".format(fmodtime, ftstamp, ftestmod, ftstamp - fmodtime>ftestmod))
-                        if ftstamp - fmodtime < ftestmod:
-                            raise WorkerFileException
-
-                    except OSError: # raised based on the file access status
-                        t.error("OSError exception ({})".format(fn))
-                        raise WorkerFileException
-
-                    # final test - we can open the file by fabio and convert itx
-                    fh = None
-                    try:
-                        fh = fabio.openimage.openimage(fn)
-
-                        # if all the tests passed - convert
-                        convert_file(fn, fh, value_time, value_frames, logger=t, conf=c)
-
-                        fh.close()
-                    except IOError:
-                        t.error("File ({}) was not recognized by fabio. Skipping..".format(fn))
-
-                        # redundant cleanup
-                        if fh is not None:
-                            fh.close()
-                    # cleanup the information, wait for the next file
-                    fn, fnts_start = None, None
-                else:
-                    t.error("File ({}) does not exist".format(fn))
-                    raise WorkerFileException
-        except WorkerFileException:
-            # - file does not satisfy some criterion - size of modification time
-            t.debug("Got the WorkerFileException")
-            pass
+    start_staging(upload_queue, counters, tcounters, logger=t, conf=c, stop=staging_stop)
 
-        # work with file - wait until the file gets proper status - X seconds modified,
-        # decent size - if not, wait
-        tdelay = float(delay)/10.
+    # prefetch - the next files are opened and the converted frames are written by a thread pool
+    prefetch = int(c.getProcPrefetchDepth())
+    executor, bwriter = None, None
+    if prefetch > 0:
+        t.debug("Using ({}) prefetched files", prefetch)
+        executor = ThreadPoolExecutor(max_workers=prefetch + 1)
+        bwriter = BackgroundWriter(executor, logger=t, conf=c, stats=stats, counters=tcounters)
 
-        for i in range(10):
-            # get stop queue
-            try:
-                stop_queue.get(False)
-                bstop = True
-                break
-            except Empty:
-                pass
+    # ((filename, timestamp of the announcement), future of the fabio handle)
+    prefetched = deque()
 
-            if delay == 0:
-                break
+    while True:
 
-            time.sleep(tdelay)
+        # obtaining the filename - the local batch first
+        if executor is None:
+            item, ffh = get_next_file(file_queue, local, tdelay, logger=t, stats=stats), None
+        else:
+            # keep the requested number of files opening while the current one is converted
+            while len(prefetched) <= prefetch:
+                titem = get_next_file(file_queue, local, 0 if len(prefetched) > 0 else tdelay, logger=t, stats=stats)
+                if titem is None:
+                    break
+                prefetched.append((titem, executor.submit(open_file, titem[0], stats, tcounters)))
+
+            item, ffh = None, None
+            if len(prefetched) > 0:
+                item, ffh = prefetched.popleft()
 
-            # get stop queue
+        # process if we have some input
+        if item is not None:
+            fn, tadded = item
+            fh = None
             try:
-                stop_queue.get(False)
-                bstop = True
-                break
-            except Empty:
-                pass
-
-        if bstop:
+                if ffh is not None:
+                    fh = ffh.result()
+                else:
+                    fh = open_file(fn, stats, tcounters)
+
+                # file is ready - convert, the file is reported once it is written
+                convert_file(fn, fh, tcounters, logger=t, conf=c, plan=plan, writer=bwriter, stats=stats, tadded=tadded,
+                             done_queue=done_queue)
+            except (IOError, OSError):
+                t.error("File ({}) was not recognized by fabio. Skipping..".format(fn))
+                report_done(done_queue, fn, None, logger=t)
+                report_stats(tcounters, 0., 0, files=0, errors=1, logger=t)
+            finally:
+                if fh is not None:
+                    fh.close()
+
+        # the level of the logs is changed at runtime
+        if log_level is not None and log_level.value != t.debug_level:
+            t.setDebugLevel(log_level.value)
+
+        # get stop queue
+        if test_stop(stop_queue):
             t.info("Process ({}) has received the stop signal".format(local_name))
             break
 
+        # the pool shrinks - finish the received files first
+        if retire_queue is not None and len(local) == 0 and len(prefetched) == 0 and test_stop(retire_queue):
+            t.info("Process ({}) is retired".format(local_name))
+            break
+
         # debugging purposes
         if debug:
             t.debug("New cycle")
@@ -318,11 +876,21 @@ def worker(file_queue, stop_queue, log_folder, value_time, value_frames, debug=N
                 stop_queue.put("stop")
             debug_cnt = debug_cnt + 1
 
-    t.debug("Worker ({}) is stopped ".format(local_name))
+    if executor is not None:
+        bwriter.flush()
+        executor.shutdown(wait=True)
+
+    t.debug("Worker ({}) is stopped ", local_name)
 
 if __name__ == "__main__":
+    # converts the files given on the command line by a single worker, stops after 10 cycles (debug mode)
+    # python -m app.worker <file.tif> [<file.tif> ...], see benchmark.throughput for the measurements
+    import tempfile
+    from app.common.stats import SharedCounters
+
     qfile = Queue()
-    qfile.put("123.tif")
+    for fn in sys.argv[1:]:
+        qfile.put(fn)
     qquit = Queue()
 
-    worker(qfile, qquit, "C:\\Users\\lorcat\\Dropbox\\Mine\\PyCharm\\_by_hosts\\win\\ConvertServer\\log", debug=True)
+    worker(qfile, qquit, tempfile.gettempdir(), SharedCounters(1), debug=True)
@@ -0,0 +1,106 @@
+"""
+Synthetic detector frames - powder rings and Bragg peaks on a decaying background, Poisson statistics,
+dark subtracted readout noise (negative pixels for the signed and float types)
+
+Usage (from the Code directory):
+    python -m benchmark.frames --folder /tmp/raw [--shape 2048 2048] [--type float32] [--files 10] [--frames 1]
+"""
+import argparse
+import os
+
+import numpy as np
+
+from app.common import tifwriter
+
+# powder rings - (radius, width) relative to the frame size, height (counts)
+RINGS = ((0.12, 0.004, 900.), (0.21, 0.005, 400.), (0.29, 0.006, 650.), (0.37, 0.008, 200.), (0.44, 0.008, 120.))
+
+# Bragg peaks - number of peaks, half size of a peak (pixels), maximal height (counts)
+PEAKS = (200, 4, 50000.)
+
+# mean dark level subtracted from the frames, readout noise (counts)
+DARK_LEVEL = 10.
+READOUT_NOISE = 3.
+
+# value ranges of the integer types
+TYPE_LIMITS = {"int32": (-2**31, 2**31 - 1), "uint16": (0, 2**16 - 1), "uint32": (0, 2**32 - 1)}
+
+
+def make_frame(shape, dtype, seed=0):
+    """
+    Returns a synthetic detector frame
+    :param shape: (rows, columns)
+    :param dtype: numpy type of the frame
+    :param seed: seed of the random generator
+    :return: numpy.ndarray
+    """
+    rng = np.random.default_rng(seed)
+    rows, cols = shape
+    size = float(max(shape))
+
+    y, x = np.ogrid[:rows, :cols]
+    r = np.hypot(y - rows * 0.52, x - cols * 0.47) / size
+
+    frame = 150. * np.exp(-r / 0.6)
+    for (radius, width, height) in RINGS:
+        frame += height * np.exp(-((r - radius) / width) ** 2)
+
+    npeaks, half, height = PEAKS
+    py, px = np.mgrid[-half:half + 1, -half:half + 1]
+    spot = np.exp(-(py ** 2 + px ** 2) / (half / 2.) ** 2)
+    for (cy, cx, h) in zip(rng.integers(half, rows - half, npeaks), rng.integers(half, cols - half, npeaks),
+                           rng.random(npeaks) * height):
+        frame[cy - half:cy + half + 1, cx - half:cx + half + 1] += h * spot
+
+    frame = rng.poisson(frame).astype(np.float64) - DARK_LEVEL + rng.normal(0., READOUT_NOISE, shape)
+
+    dtype = np.dtype(dtype)
+    if dtype.kind in "ui":
+        low, high = TYPE_LIMITS.get(dtype.name, (np.iinfo(dtype).min, np.iinfo(dtype).max))
+        frame = np.clip(np.rint(frame), low, high)
+    return frame.astype(dtype)
+
+
+def write_files(folder, nfiles, shape, dtype, nframes=1, prefix="frame", seed=0):
+    """
+    Writes synthetic TIFF files - single frame or multi-page files, the frames differ by a shift of the base frame
+    :param folder: output folder, created if needed
+    :param nfiles: number of the files
+    :param nframes: number of frames per file
+    :return: list of the written files
+    """
+    if not os.path.isdir(folder):
+        os.makedirs(folder)
+
+    base = make_frame(shape, dtype, seed=seed)
+
+    res = []
+    for i in range(nfiles):
+        fn = os.path.join(folder, "{}_{:05d}.tif".format(prefix, i))
+        frames = [np.roll(base, 7 * (i * nframes + j), axis=1) for j in range(nframes)]
+
+        if nframes == 1:
+            tifwriter.write_tiff(fn, frames[0])
+        else:
+            with tifwriter.TiffStackWriter(fn) as stack:
+                for frame in frames:
+                    stack.write(frame)
+        res.append(fn)
+    return res
+
+
+def main(argv=None):
+    parser = argparse.ArgumentParser(description=__doc__.strip().split("\n")[0])
+    parser.add_argument("--folder", required=True, help="output folder")
+    parser.add_argument("--shape", type=int, nargs=2, default=(2048, 2048))
+    parser.add_argument("--type", default="float32", help="numpy type of the frames")
+    parser.add_argument("--files", type=int, default=10)
+    parser.add_argument("--frames", type=int, default=1, help="frames per file")
+    args = parser.parse_args(argv)
+
+    fns = write_files(args.folder, args.files, args.shape, args.type, nframes=args.frames)
+    print("Written ({}) files into ({})".format(len(fns), args.folder))
+
+
+if __name__ == "__main__":
+    main()
@@ -0,0 +1,70 @@
+"""
+Micro-benchmark of the frame orientation - per frame cost of every of the 8 orientations
+previous path (astype + rot90 + flip + contiguous copy made by the writer) vs OrientationPlan.apply
+
+Usage (from the Code directory):
+    python -m benchmark.orientation [--shape 2048 2048] [--type float32] [--conv uint32] [--repeat 20]
+"""
+import argparse
+import time
+
+import numpy as np
+
+from app.common.conversion import OrientationPlan
+
+# rotation/flip pairs producing the 8 distinct orientations
+ORIENTATIONS = [(rot, flip) for flip in (None, 1) for rot in (0., 90., 180., 270.)]
+
+
+def previous_path(data, conv_type, rot, flip):
+    tdata = data.copy()
+    tdata[tdata < 0] = 0
+    tdata = tdata.astype(conv_type)
+    if rot % 90. == 0 and rot != 0:
+        tdata = np.rot90(tdata, int(rot/90.))
+    if flip is not None:
+        tdata = np.flip(tdata, axis=flip)
+    return np.ascontiguousarray(tdata)
+
+
+def measure(func, repeat):
+    """
+    Returns the best and the median time of the function (s)
+    """
+    res = []
+    for i in range(repeat):
+        tstart = time.perf_counter()
+        func()
+        res.append(time.perf_counter() - tstart)
+    res.sort()
+    return res[0], res[len(res) // 2]
+
+
+def main(argv=None):
+    parser = argparse.ArgumentParser(description=__doc__.strip().split("\n")[0])
+    parser.add_argument("--shape", type=int, nargs=2, default=(2048, 2048))
+    parser.add_argument("--type", default="float32", help="numpy type of the input frame")
+    parser.add_argument("--conv", default="uint32", help="numpy type of the output frame")
+    parser.add_argument("--repeat", type=int, default=20)
+    args = parser.parse_args(argv)
+
+    conv_type = np.dtype(args.conv)
+    data = (np.random.default_rng(0).random(args.shape) * 2000 - 100).astype(args.type)
+
+    print("Frame {} {} -> {}, {} repeats, median (best) ms per frame".format(args.shape, data.dtype, conv_type, args.repeat))
+    print("{:>6} {:>6} | {:>18} | {:>18}".format("rot", "flip", "previous", "plan"))
+
+    for (rot, flip) in ORIENTATIONS:
+        plan = OrientationPlan(rot, flip)
+        assert np.array_equal(plan.apply(data, conv_type), previous_path(data, conv_type, rot, flip))
+
+        tprev = measure(lambda: previous_path(data, conv_type, rot, flip), args.repeat)
+        tplan = measure(lambda: plan.apply(data, conv_type), args.repeat)
+
+        print("{:>6} {:>6} | {:>8.2f} ({:>7.2f}) | {:>8.2f} ({:>7.2f})".format(rot, str(flip),
+                                                                              tprev[1]*1e3, tprev[0]*1e3,
+                                                                              tplan[1]*1e3, tplan[0]*1e3))
+
+
+if __name__ == "__main__":
+    main()
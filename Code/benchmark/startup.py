@@ -0,0 +1,146 @@
+"""
+Startup benchmark of the worker processes - time till the first converted file and the memory of the workers per start method
+A pool is started twice (initial start, restart of the pool), every worker converts a single small file
+
+Usage (from the Code directory):
+    python -m benchmark.startup [--method fork spawn forkserver] [--workers 4]
+"""
+import argparse
+import os
+import shutil
+import tempfile
+import time
+from multiprocessing import Process, Queue, get_all_start_methods, get_context
+
+import app.config.main_config as config
+from app.config.keys import *
+from app.common.stats import SharedCounters
+from app.worker import worker
+from benchmark.frames import write_files
+
+# time limit of a pool start (s)
+START_TIMEOUT = 120.
+
+
+def get_memory(pid):
+    """
+    Returns the resident and the unique (private pages) memory of the process (MB), Linux only
+    :return: (rss, uss) or (None, None)
+    """
+    res = [None, None]
+    try:
+        with open("/proc/{}/smaps_rollup".format(pid), "r") as fh:
+            private = 0
+            for line in fh:
+                key, value = line.split(":", 1)
+                if key == "Rss":
+                    res[0] = int(value.split()[0]) / 1024.
+                elif key in ("Private_Clean", "Private_Dirty"):
+                    private += int(value.split()[0])
+            res[1] = private / 1024.
+    except (IOError, OSError, ValueError):
+        pass
+    return tuple(res)
+
+
+def start_pool(ctx, nworkers, fns, log_folder, counters, storage):
+    """
+    Starts the workers, every worker converts a file
+    :return: (seconds till all the files were converted, processes, file queue, stop queue)
+    """
+    qfiles, qquit = ctx.Queue(), ctx.Queue()
+    procs = [ctx.Process(target=worker, args=(qfiles, qquit, log_folder, counters),
+                         kwargs={"stats_slot": i, "storage": storage}) for i in range(nworkers)]
+
+    done = counters.snapshot()["files"]
+
+    tstart = time.time()
+    for proc in procs:
+        proc.start()
+    for fn in fns:
+        qfiles.put(fn)
+
+    while counters.snapshot()["files"] - done < len(fns) and time.time() - tstart < START_TIMEOUT:
+        time.sleep(0.002)
+    return time.time() - tstart, procs, qfiles, qquit
+
+
+def stop_pool(procs, qfiles, qquit):
+    """
+    Stops the workers, the queues are kept till the slow workers have started (spawn)
+    :return:
+    """
+    for proc in procs:
+        qquit.put("stop")
+    for proc in procs:
+        proc.join()
+
+
+def run_method(method, nworkers, raw, log_folder, queue):
+    """
+    Process function - starts the pool twice with the start method, the result is put into the queue
+    :return:
+    """
+    try:
+        c = config.get_instance()
+        c.setConfiguration(PROC_PATH_REPLACE, ("raw", "processed"))
+        c.setConfiguration(PROC_SLEEP_DELAY, 0.1)
+        c.setConfiguration(PROC_PREFETCH_DEPTH, 0)
+
+        ctx = get_context(method)
+        if method == "forkserver":
+            ctx.set_forkserver_preload(list(c.getProcStartPreload()))
+
+        fns = sorted(os.path.join(raw, fn) for fn in os.listdir(raw))[:nworkers]
+        counters = SharedCounters(nworkers)
+
+        res = {"method": method, "workers": nworkers}
+        for key in ("start", "restart"):
+            tstart, procs, qfiles, qquit = start_pool(ctx, nworkers, fns, log_folder, counters, c.getStorage())
+            memory = [get_memory(proc.pid) for proc in procs]
+            stop_pool(procs, qfiles, qquit)
+
+            res[key] = tstart
+            if all(m[0] is not None for m in memory):
+                res["{}_rss_mb".format(key)] = sum(m[0] for m in memory) / len(memory)
+                res["{}_uss_mb".format(key)] = sum(m[1] for m in memory) / len(memory)
+        queue.put(res)
+    except Exception as e:
+        queue.put({"method": method, "error": "{}: {}".format(e.__class__.__name__, e)})
+
+
+def main(argv=None):
+    parser = argparse.ArgumentParser(description=__doc__.strip().split("\n")[0])
+    parser.add_argument("--method", nargs="+", default=[m for m in ("fork", "spawn", "forkserver") if m in get_all_start_methods()],
+                        choices=get_all_start_methods())
+    parser.add_argument("--workers", type=int, default=4)
+    args = parser.parse_args(argv)
+
+    folder = tempfile.mkdtemp()
+    raw, log_folder = os.path.join(folder, "raw"), os.path.join(folder, "log")
+    os.makedirs(log_folder)
+    write_files(raw, args.workers, (256, 256), "float32")
+
+    print("{:>10} {:>3} | {:>9} {:>9} | {:>12} {:>12}".format("method", "n", "start (s)", "restart", "RSS/worker", "USS/worker"))
+    try:
+        for method in args.method:
+            # a fresh process per method - the forkserver and the imports of the previous method are not reused
+            queue = Queue()
+            proc = Process(target=run_method, args=(method, args.workers, raw, log_folder, queue))
+            proc.start()
+            res = queue.get()
+            proc.join()
+
+            if "error" in res:
+                print("{:>10} {:>3} - {}".format(method, args.workers, res["error"]))
+                continue
+
+            print("{:>10} {:>3} | {:>9.3f} {:>9.3f} | {:>9.1f} MB {:>9.1f} MB".format(
+                method, args.workers, res["start"], res["restart"], res.get("restart_rss_mb", float("nan")),
+                res.get("restart_uss_mb", float("nan"))))
+    finally:
+        shutil.rmtree(folder, ignore_errors=True)
+
+
+if __name__ == "__main__":
+    main()
@@ -0,0 +1,311 @@
+"""
+Throughput benchmark without Tango - convert_file in the current process, a single worker() process and the Starter pool
+Reports frames/s, MB/s (source data), latency percentiles of the stages and the peak RSS, optionally saved as JSON
+
+Usage (from the Code directory):
+    python -m benchmark.throughput [--suite convert worker pool] [--shape 2048 2048] [--type float32 int32 uint16]
+                                   [--frames 1] [--files 40] [--workers 1 2 4] [--orientation 0 none 90 1]
+                                   [--compression none deflate]
+                                   [--output report.json] [--compare previous.json]
+"""
+import argparse
+import json
+import os
+import platform
+import resource
+import shutil
+import sys
+import tempfile
+import time
+from multiprocessing import Process, Queue
+
+import fabio
+import numpy as np
+
+import app.config.main_config as config
+from app.config.keys import *
+from app.common.stats import StageHistograms, SharedCounters, STAGES
+from app.common.tester import Tester
+from app.worker import convert_file, open_file, worker
+from benchmark.frames import write_files
+
+SUITES = ("convert", "worker", "pool")
+
+# time limit of a single case (s)
+CASE_TIMEOUT = 600.
+
+# values of the case keys missing in the reports of the previous versions
+CASE_DEFAULTS = {"compression": "none"}
+
+
+def get_rss():
+    """
+    Returns the peak resident set size (MB) of the process and of its finished children
+    :return: dict
+    """
+    scale = 1024. if sys.platform != "darwin" else 1024. * 1024.
+    return {"self": resource.getrusage(resource.RUSAGE_SELF).ru_maxrss / scale,
+            "children": resource.getrusage(resource.RUSAGE_CHILDREN).ru_maxrss / scale}
+
+
+def configure(case, raw, processed):
+    """
+    Sets the configuration of the case - the files already exist, the readiness tests pass immediately
+    :return: config.Config
+    """
+    c = config.get_instance()
+    c.setConfiguration(PROC_FILE_ROTATE, case["rotation"])
+    c.setConfiguration(PROC_FILE_FLIP, case["flip"])
+    c.setConfiguration(PROC_FILE_CONVERSION_TYPE, np.dtype(case["conv"]).type)
+    c.setConfiguration(PROC_FILE_MULTIFRAME, case["multiframe"])
+    c.setConfiguration(PROC_FILE_COMPRESSION, case["compression"])
+    c.setConfiguration(PROC_PATH_REPLACE, (raw, processed))
+    c.setConfiguration(PROC_FILE_TEST_SIZE, 0)
+    c.setConfiguration(PROC_FILE_TEST_MOD_TIME, 0.)
+    c.setConfiguration(PROC_LEDGER, False)
+    c.setConfiguration(PROC_JOURNAL, False)
+    c.setProcMaxNum(case["workers"])
+    return c
+
+
+def summarize(case, fns, tconversion, histograms, rss):
+    """
+    Returns the result of the case
+    :return: dict
+    """
+    nbytes = sum(os.path.getsize(fn) for fn in fns)
+    nframes = len(fns) * case["frames"]
+
+    res = dict(case)
+    res.update({"files": len(fns), "seconds": tconversion,
+                "frames_per_s": nframes / tconversion if tconversion > 0 else 0.,
+                "mb_per_s": nbytes / 1e6 / tconversion if tconversion > 0 else 0.,
+                "latency": dict((stage, histograms.percentiles(stage)) for stage in STAGES
+                                if sum(histograms.counts(stage)) > 0),
+                "rss_mb": rss})
+    return res
+
+
+def run_convert(case, fns, raw, processed, log_folder):
+    """
+    convert_file() called in the current process
+    :return: dict
+    """
+    c = configure(case, raw, processed)
+    t = Tester(def_file="benchmark", log_folder=log_folder, debug_level=Tester.ERROR)
+    t.setDebugLevel(Tester.ERROR)
+
+    histograms, counters = StageHistograms(1), SharedCounters(1)
+    stats, tcounters = histograms.recorder(0), counters.recorder(0)
+
+    tstart = time.time()
+    for fn in fns:
+        fh = open_file(fn, stats, tcounters)
+        try:
+            convert_file(fn, fh, tcounters, logger=t, conf=c, stats=stats, tadded=time.time())
+        finally:
+            fh.close()
+    tconversion = time.time() - tstart
+
+    return summarize(case, fns, tconversion, histograms, get_rss())
+
+
+def run_worker(case, fns, raw, processed, log_folder):
+    """
+    A single worker() process fed with all the files
+    :return: dict
+    """
+    c = configure(case, raw, processed)
+
+    histograms, counters = StageHistograms(2), SharedCounters(2)
+    qfiles, qquit = Queue(), Queue()
+
+    # the configuration of the case is passed as by the Starter, a spawned worker would start with the defaults
+    proc = Process(target=worker, args=(qfiles, qquit, log_folder, counters),
+                   kwargs={"histograms": histograms, "stats_slot": 1, "storage": c.getStorage()})
+    proc.start()
+
+    tstart = time.time()
+    for fn in fns:
+        qfiles.put((fn, tstart, tstart))
+
+    while time.time() - tstart < CASE_TIMEOUT:
+        snapshot = counters.snapshot()
+        if snapshot["files"] + snapshot["errors"] >= len(fns):
+            break
+        time.sleep(0.005)
+    tconversion = time.time() - tstart
+
+    qquit.put("stop")
+    proc.join()
+
+    return summarize(case, fns, tconversion, histograms, get_rss())
+
+
+def run_pool(case, fns, raw, processed, log_folder):
+    """
+    Starter with its pool of workers, the folder is added as by AddFileOrDir
+    :return: dict
+    """
+    from app.starter import Starter
+
+    configure(case, raw, processed)
+
+    s = Starter([os.path.join(os.path.dirname(log_folder), "benchmark.py")])
+    s.setDebugLevel(Tester.ERROR)
+    s.startTiffApplication()
+
+    tstart = time.time()
+    s.addElement(raw)
+    while True:
+        counters = s.getCounters()
+        if counters["files"] + counters["errors"] + counters["skips"] >= len(fns) or time.time() - tstart > CASE_TIMEOUT:
+            break
+        time.sleep(0.005)
+    tconversion = time.time() - tstart
+
+    res = summarize(case, fns, tconversion, s.histograms, None)
+    s.quit()
+
+    res["rss_mb"] = get_rss()
+    return res
+
+
+def run_case(func, case, fns, raw, processed, log_folder, queue):
+    """
+    Process function - runs the case in a fresh process, the peak RSS belongs to the case only
+    :return:
+    """
+    try:
+        queue.put(func(case, fns, raw, processed, log_folder))
+    except Exception as e:
+        queue.put({"error": "{}: {}".format(e.__class__.__name__, e)})
+
+
+def isolated(func, case, fns, raw, processed, log_folder):
+    """
+    Runs the case in a child process
+    :return: dict
+    """
+    queue = Queue()
+    proc = Process(target=run_case, args=(func, case, fns, raw, processed, log_folder, queue))
+    proc.start()
+    res = queue.get()
+    proc.join()
+
+    if "error" in res:
+        res.update(case)
+    return res
+
+
+def parse_orientations(values):
+    """
+    Converts (rotation, flip) pairs given on the command line
+    :return: list of (float, int or None)
+    """
+    res = []
+    for i in range(0, len(values) - 1, 2):
+        flip = values[i + 1].lower()
+        res.append((float(values[i]), None if flip == "none" else int(flip)))
+    return res
+
+
+def compare(results, fn):
+    """
+    Prints the frames/s of the matching cases of a previous report
+    :return:
+    """
+    with open(fn, "r") as fh:
+        previous = json.load(fh)
+
+    keys = ("suite", "workers", "shape", "type", "conv", "frames", "multiframe", "rotation", "flip", "compression")
+    lookup = dict((tuple(json.dumps(r.get(k, CASE_DEFAULTS.get(k))) for k in keys), r) for r in previous["results"])
+
+    print("\nComparison with ({}, {})".format(fn, previous["meta"].get("date")))
+    for r in results:
+        old = lookup.get(tuple(json.dumps(r.get(k, CASE_DEFAULTS.get(k))) for k in keys))
+        if old is None or "error" in old or "error" in r:
+            continue
+        ratio = r["frames_per_s"] / old["frames_per_s"] if old["frames_per_s"] > 0 else 0.
+        print("{:>8} {:>3} {:>11} {:>8} rot {:>5} flip {:>4} {:>7} | {:>8.1f} -> {:>8.1f} frames/s ({:+.1f}%)".format(
+            r["suite"], r["workers"], "x".join(str(v) for v in r["shape"]), r["type"], r["rotation"], str(r["flip"]),
+            r["compression"], old["frames_per_s"], r["frames_per_s"], (ratio - 1.) * 100.))
+
+
+def main(argv=None):
+    parser = argparse.ArgumentParser(description=__doc__.strip().split("\n")[0])
+    parser.add_argument("--suite", nargs="+", default=list(SUITES), choices=SUITES)
+    parser.add_argument("--shape", type=int, nargs="+", default=[2048], help="sizes of the square frames, e.g. 2048 4096")
+    parser.add_argument("--type", nargs="+", default=["float32", "int32", "uint16"], help="numpy types of the input frames")
+    parser.add_argument("--conv", default="uint32", help="numpy type of the output frames")
+    parser.add_argument("--frames", type=int, nargs="+", default=[1], help="frames per input file, e.g. 1 8")
+    parser.add_argument("--multiframe", default="split", choices=("split", "stack"))
+    parser.add_argument("--files", type=int, default=40, help="number of the input files per case")
+    parser.add_argument("--workers", type=int, nargs="+", default=[1, 2, 4], help="numbers of workers of the pool suite")
+    parser.add_argument("--orientation", nargs="+", default=["0", "none"], help="pairs of rotation and flip, e.g. 0 none 90 1")
+    parser.add_argument("--compression", nargs="+", default=["none"], help="compression modes of the output, e.g. none deflate zstd")
+    parser.add_argument("--folder", default=None, help="folder for the generated files (temporary folder by default)")
+    parser.add_argument("--output", default=None, help="JSON report")
+    parser.add_argument("--compare", default=None, help="JSON report of a previous run")
+    args = parser.parse_args(argv)
+
+    funcs = {"convert": run_convert, "worker": run_worker, "pool": run_pool}
+    results = []
+
+    folder = tempfile.mkdtemp(dir=args.folder)
+    log_folder = os.path.join(folder, "log")
+    os.makedirs(log_folder)
+
+    print("{:>8} {:>3} {:>11} {:>8} {:>6} {:>6} {:>4} {:>7} | {:>9} {:>8} | {:>9} {:>9} | {:>8}".format(
+        "suite", "n", "shape", "type", "frames", "rot", "flip", "compr", "frames/s", "MB/s", "p50 (ms)", "p99 (ms)", "RSS (MB)"))
+
+    try:
+        for size in args.shape:
+            for dtype in args.type:
+                for nframes in args.frames:
+                    raw = os.path.join(folder, "raw")
+                    fns = write_files(raw, args.files, (size, size), dtype, nframes=nframes)
+
+                    for (rot, flip) in parse_orientations(args.orientation):
+                        for compression in args.compression:
+                            for suite in args.suite:
+                                for nworkers in (args.workers if suite == "pool" else [1]):
+                                    case = {"suite": suite, "workers": nworkers, "shape": [size, size], "type": dtype,
+                                            "conv": args.conv, "frames": nframes, "multiframe": args.multiframe,
+                                            "rotation": rot, "flip": flip, "compression": compression}
+
+                                    processed = os.path.join(folder, "processed")
+                                    shutil.rmtree(processed, ignore_errors=True)
+                                    os.makedirs(processed)
+
+                                    res = isolated(funcs[suite], case, fns, raw, processed, log_folder)
+                                    results.append(res)
+
+                                    if "error" in res:
+                                        print("{:>8} {:>3} {:>11} {:>8} - {}".format(suite, nworkers, size, dtype, res["error"]))
+                                        continue
+
+                                    total = res["latency"].get("total", [0., 0., 0.])
+                                    print("{:>8} {:>3} {:>11} {:>8} {:>6} {:>6} {:>4} {:>7} | {:>9.1f} {:>8.1f} | {:>9.1f} {:>9.1f} | {:>8.0f}".format(
+                                        suite, nworkers, "{}x{}".format(size, size), dtype, nframes, rot, str(flip), compression,
+                                        res["frames_per_s"], res["mb_per_s"], total[0] * 1e3, total[2] * 1e3,
+                                        max(res["rss_mb"]["self"], res["rss_mb"]["children"])))
+
+                    shutil.rmtree(raw)
+    finally:
+        shutil.rmtree(folder, ignore_errors=True)
+
+    meta = {"date": time.strftime("%Y-%m-%d %H:%M:%S"), "python": platform.python_version(), "numpy": np.__version__,
+            "fabio": fabio.version, "platform": platform.platform(), "cpus": os.cpu_count(), "argv": argv or sys.argv[1:]}
+
+    if args.output is not None:
+        with open(args.output, "w") as fh:
+            json.dump({"meta": meta, "results": results}, fh, indent=1)
+        print("\nReport is saved ({})".format(args.output))
+
+    if args.compare is not None:
+        compare(results, args.compare)
+
+
+if __name__ == "__main__":
+    main()
@@ -0,0 +1,133 @@
+"""
+Benchmark of the TIFF output - fabio.tifimage.TifImage vs the native writer with cached headers,
+compression modes of the native writer on synthetic detector frames (ms per frame, MB/s, compression ratio)
+Every written file and a multi-page file of each mode are read back (round trip) and compared with the source frames,
+the uncompressed files by fabio as well - fabio reads the compressed files through PIL, which returns uint32 frames as int32
+and only the first page
+
+Usage (from the Code directory):
+    python -m benchmark.tifwriter [--shape 2048 2048] [--type uint32] [--repeat 20] [--folder /tmp]
+                                  [--compression none deflate lzw zstd] [--threads 1 4]
+"""
+import argparse
+import os
+import shutil
+import tempfile
+
+import fabio
+import numpy as np
+
+from app.common import tifwriter
+from benchmark.frames import make_frame
+from benchmark.orientation import measure
+
+
+def write_fabio(fn, data):
+    tfh = fabio.tifimage.TifImage(data)
+    tfh.write(fn)
+    tfh.close()
+
+
+def verify(fn, frames):
+    """
+    Reads the pages of the file back (app.common.tifwriter.read_tiff) and compares them with the source frames,
+    the types and the values should be the same
+    :param frames: list of numpy.ndarray
+    :return: True, False or None if the file cannot be read back
+    """
+    try:
+        pages = tifwriter.read_tiff(fn)
+    except (tifwriter.TiffWriterException, OSError, ValueError, KeyError):
+        return None
+
+    return len(pages) == len(frames) and all(page.dtype == frame.dtype and np.array_equal(page, frame)
+                                             for (page, frame) in zip(pages, frames))
+
+
+def verify_fabio(fn, data):
+    """
+    Reads the file back with fabio and compares it with the source frame
+    :return: True, False or None if the file cannot be read back
+    """
+    try:
+        fh = fabio.open(fn)
+    except Exception:
+        return None
+
+    try:
+        res = fh.data.dtype == data.dtype and np.array_equal(fh.data, data)
+    finally:
+        fh.close()
+    return res
+
+
+def run_compression(folder, shape, dtypes, modes, threads, repeat):
+    """
+    Prints the speed and the ratio of the compression modes
+    :return:
+    """
+    print("\nSynthetic frame {}, {} repeats, median ms per frame".format(shape, repeat))
+    print("{:>8} {:>8} {:>3} | {:>9} {:>9} | {:>6} | {:>10} {:>10} | {}".format("type", "mode", "n", "ms", "MB/s", "ratio",
+                                                                            "round trip", "multi-page", "fabio"))
+
+    states = {True: "ok", False: "MISMATCH", None: "not readable"}
+    fn, fn_stack = os.path.join(folder, "compressed.tif"), os.path.join(folder, "stack.tif")
+    for dtype in dtypes:
+        data = make_frame(shape, dtype)
+        for mode in modes:
+            if not tifwriter.is_compression_supported(mode):
+                print("{:>8} {:>8} {:>3} | codec is not installed".format(dtype, mode, "-"))
+                continue
+
+            for nthreads in (threads if mode != tifwriter.COMPRESSION_NONE else [1]):
+                tbest, tmedian = measure(lambda: tifwriter.write_tiff(fn, data, compression=mode, threads=nthreads), repeat)
+                ratio = data.nbytes / float(os.path.getsize(fn))
+
+                frames = [data, np.roll(data, 7, axis=1)]
+                with tifwriter.TiffStackWriter(fn_stack, compression=mode, threads=nthreads) as stack:
+                    for frame in frames:
+                        stack.write(frame)
+
+                print("{:>8} {:>8} {:>3} | {:>9.2f} {:>9.1f} | {:>6.2f} | {:>10} {:>10} | {}".format(
+                    dtype, mode, nthreads, tmedian*1e3, data.nbytes / 1e6 / tmedian, ratio,
+                    states[verify(fn, [data])], states[verify(fn_stack, frames)], states[verify_fabio(fn, data)]))
+
+
+def main(argv=None):
+    parser = argparse.ArgumentParser(description=__doc__.strip().split("\n")[0])
+    parser.add_argument("--shape", type=int, nargs=2, default=(2048, 2048))
+    parser.add_argument("--type", nargs="+", default=["uint16", "uint32", "int32", "float32"], help="numpy types of the frame")
+    parser.add_argument("--repeat", type=int, default=20)
+    parser.add_argument("--folder", default=None, help="folder for the written files (temporary folder by default)")
+    parser.add_argument("--compression", nargs="+", default=["none", "deflate", "lzw", "zstd"],
+                        choices=sorted(tifwriter.COMPRESSION_CODES), help="compression modes of the native writer")
+    parser.add_argument("--threads", type=int, nargs="+", default=[1, 4], help="numbers of the encoding threads")
+    args = parser.parse_args(argv)
+
+    folder = tempfile.mkdtemp(dir=args.folder)
+    try:
+        print("Frame {}, {} repeats, median (best) ms per frame".format(args.shape, args.repeat))
+        print("{:>8} | {:>18} | {:>18}".format("type", "fabio", "native"))
+
+        for dtype in args.type:
+            data = (np.random.default_rng(0).random(args.shape) * 1000).astype(dtype)
+            fn_fabio, fn_native = os.path.join(folder, "fabio.tif"), os.path.join(folder, "native.tif")
+
+            tfabio = measure(lambda: write_fabio(fn_fabio, data), args.repeat)
+            tnative = measure(lambda: tifwriter.write_tiff(fn_native, data), args.repeat)
+
+            for fn in (fn_fabio, fn_native):
+                fh = fabio.open(fn)
+                assert fh.data.dtype == data.dtype and np.array_equal(fh.data, data), fn
+                fh.close()
+
+            print("{:>8} | {:>8.2f} ({:>7.2f}) | {:>8.2f} ({:>7.2f})".format(dtype, tfabio[1]*1e3, tfabio[0]*1e3,
+                                                                          tnative[1]*1e3, tnative[0]*1e3))
+
+        run_compression(folder, args.shape, args.type, args.compression, args.threads, args.repeat)
+    finally:
+        shutil.rmtree(folder)
+
+
+if __name__ == "__main__":
+    main()